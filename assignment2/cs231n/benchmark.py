@@ -0,0 +1,405 @@
+from __future__ import print_function, division
+import argparse
+import importlib
+import json
+import platform
+import re
+import sys
+import time
+import timeit
+
+import numpy as np
+
+"""
+This file implements micro-benchmarks for the layer implementations in
+layers.py, fast_layers.py and rnn_layers.py and for the update rules in
+optim.py, so that the naive, im2col, strides, reshape and Cython variants can
+be compared with each other and performance changes can be measured.
+
+Every benchmark case runs one layer over a matrix of configurations (shapes,
+strides, pool sizes), batch sizes and dtypes. For each point of the matrix the
+forward and backward passes are timed separately; update rules are timed for a
+single step. Functions that do not exist in this copy of cs231n (for example
+rnn_layers in assignment 2) are skipped.
+
+The results form a JSON report that can be stored as a baseline and compared
+with later runs:
+
+python -m cs231n.benchmark --out baseline.json
+... change some layers ...
+python -m cs231n.benchmark --out report.json --baseline baseline.json
+
+The comparison lists every timing that got slower or faster by more than the
+threshold, and the command exits with status 1 if anything got slower.
+"""
+
+
+BATCH_SIZES = (16, 64)
+DTYPES = ('float64', 'float32')
+
+
+def _randn(rng, shape, dtype):
+    return rng.standard_normal(shape).astype(dtype)
+
+
+def _affine_inputs(rng, N, dtype, D, M):
+    return (_randn(rng, (N, D), dtype), _randn(rng, (D, M), dtype),
+            _randn(rng, (M,), dtype))
+
+
+def _elementwise_inputs(rng, N, dtype, D):
+    return (_randn(rng, (N, D), dtype),)
+
+
+def _dropout_inputs(rng, N, dtype, D, p=0.5):
+    return (_randn(rng, (N, D), dtype), {'mode': 'train', 'p': p})
+
+
+def _batchnorm_inputs(rng, N, dtype, D):
+    return (_randn(rng, (N, D), dtype), np.ones(D, dtype=dtype),
+            np.zeros(D, dtype=dtype), {'mode': 'train'})
+
+
+def _spatial_batchnorm_inputs(rng, N, dtype, C, H, W):
+    return (_randn(rng, (N, C, H, W), dtype), np.ones(C, dtype=dtype),
+            np.zeros(C, dtype=dtype), {'mode': 'train'})
+
+
+def _conv_inputs(rng, N, dtype, C, H, F, HH, stride, pad):
+    return (_randn(rng, (N, C, H, H), dtype), _randn(rng, (F, C, HH, HH), dtype),
+            _randn(rng, (F,), dtype), {'stride': stride, 'pad': pad})
+
+
+def _pool_inputs(rng, N, dtype, C, H, pool, stride):
+    return (_randn(rng, (N, C, H, H), dtype),
+            {'pool_height': pool, 'pool_width': pool, 'stride': stride})
+
+
+def _loss_inputs(rng, N, dtype, C):
+    return (_randn(rng, (N, C), dtype), rng.integers(C, size=N))
+
+
+def _rnn_step_inputs(rng, N, dtype, D, H):
+    return (_randn(rng, (N, D), dtype), _randn(rng, (N, H), dtype),
+            _randn(rng, (D, H), dtype), _randn(rng, (H, H), dtype),
+            _randn(rng, (H,), dtype))
+
+
+def _rnn_inputs(rng, N, dtype, T, D, H):
+    return (_randn(rng, (N, T, D), dtype), _randn(rng, (N, H), dtype),
+            _randn(rng, (D, H), dtype), _randn(rng, (H, H), dtype),
+            _randn(rng, (H,), dtype))
+
+
+def _lstm_step_inputs(rng, N, dtype, D, H):
+    return (_randn(rng, (N, D), dtype), _randn(rng, (N, H), dtype),
+            _randn(rng, (N, H), dtype), _randn(rng, (D, 4 * H), dtype),
+            _randn(rng, (H, 4 * H), dtype), _randn(rng, (4 * H,), dtype))
+
+
+def _lstm_inputs(rng, N, dtype, T, D, H):
+    return (_randn(rng, (N, T, D), dtype), _randn(rng, (N, H), dtype),
+            _randn(rng, (D, 4 * H), dtype), _randn(rng, (H, 4 * H), dtype),
+            _randn(rng, (4 * H,), dtype))
+
+
+def _embedding_inputs(rng, N, dtype, T, V, D):
+    return (rng.integers(V, size=(N, T)), _randn(rng, (V, D), dtype))
+
+
+def _temporal_affine_inputs(rng, N, dtype, T, D, M):
+    return (_randn(rng, (N, T, D), dtype), _randn(rng, (D, M), dtype),
+            _randn(rng, (M,), dtype))
+
+
+def _temporal_loss_inputs(rng, N, dtype, T, V):
+    return (_randn(rng, (N, T, V), dtype), rng.integers(V, size=(N, T)),
+            rng.random((N, T)) > 0.2)
+
+
+def _optim_inputs(rng, N, dtype, size):
+    return (_randn(rng, (size,), dtype), _randn(rng, (size,), dtype), None)
+
+
+AFFINE = [dict(D=3072, M=100), dict(D=500, M=500)]
+ELEMENTWISE = [dict(D=4096)]
+CONV = [
+  dict(C=3, H=32, F=32, HH=3, stride=1, pad=1),
+  dict(C=32, H=16, F=64, HH=3, stride=1, pad=1),
+  dict(C=3, H=32, F=32, HH=4, stride=2, pad=1),
+]
+# The naive layers loop over every output pixel in Python
+CONV_NAIVE = [dict(C=3, H=16, F=8, HH=3, stride=1, pad=1)]
+POOL = [dict(C=32, H=32, pool=2, stride=2), dict(C=32, H=31, pool=3, stride=2)]
+POOL_TILED = [dict(C=32, H=32, pool=2, stride=2)]
+POOL_NAIVE = [dict(C=8, H=16, pool=2, stride=2)]
+SPATIAL = [dict(C=32, H=16, W=16)]
+LOSS = [dict(C=10), dict(C=1000)]
+RNN_STEP = [dict(D=512, H=512)]
+RNN = [dict(T=16, D=256, H=512)]
+EMBEDDING = [dict(T=16, V=1004, D=256)]
+TEMPORAL_AFFINE = [dict(T=16, D=512, M=1004)]
+TEMPORAL_LOSS = [dict(T=16, V=1004)]
+OPTIM = [dict(size=10 ** 4), dict(size=10 ** 6)]
+
+
+# Each case is a tuple of (module, forward, backward, inputs, configs). The
+# backward function receives arrays shaped like the outputs of the forward
+# function, followed by its cache. Cases without a backward function are only
+# timed forward; update rules are timed as a single 'step'.
+CASES = [
+  ('cs231n.layers', 'affine_forward', 'affine_backward', _affine_inputs, AFFINE),
+  ('cs231n.layers', 'relu_forward', 'relu_backward', _elementwise_inputs, ELEMENTWISE),
+  ('cs231n.layers', 'leaky_relu_forward', 'leaky_relu_backward', _elementwise_inputs, ELEMENTWISE),
+  ('cs231n.layers', 'dropout_forward', 'dropout_backward', _dropout_inputs, ELEMENTWISE),
+  ('cs231n.layers', 'batchnorm_forward', 'batchnorm_backward', _batchnorm_inputs, ELEMENTWISE),
+  ('cs231n.layers', 'spatial_batchnorm_forward', 'spatial_batchnorm_backward', _spatial_batchnorm_inputs, SPATIAL),
+  ('cs231n.layers', 'conv_forward_naive', 'conv_backward_naive', _conv_inputs, CONV_NAIVE),
+  ('cs231n.layers', 'max_pool_forward_naive', 'max_pool_backward_naive', _pool_inputs, POOL_NAIVE),
+  ('cs231n.layers', 'svm_loss', None, _loss_inputs, LOSS),
+  ('cs231n.layers', 'softmax_loss', None, _loss_inputs, LOSS),
+  ('cs231n.fast_layers', 'conv_forward_im2col', 'conv_backward_im2col', _conv_inputs, CONV),
+  ('cs231n.fast_layers', 'conv_forward_strides', 'conv_backward_strides', _conv_inputs, CONV),
+  ('cs231n.fast_layers', 'max_pool_forward_fast', 'max_pool_backward_fast', _pool_inputs, POOL),
+  ('cs231n.fast_layers', 'max_pool_forward_reshape', 'max_pool_backward_reshape', _pool_inputs, POOL_TILED),
+  ('cs231n.fast_layers', 'max_pool_forward_im2col', 'max_pool_backward_im2col', _pool_inputs, POOL),
+  ('cs231n.rnn_layers', 'rnn_step_forward', 'rnn_step_backward', _rnn_step_inputs, RNN_STEP),
+  ('cs231n.rnn_layers', 'rnn_forward', 'rnn_backward', _rnn_inputs, RNN),
+  ('cs231n.rnn_layers', 'lstm_step_forward', 'lstm_step_backward', _lstm_step_inputs, RNN_STEP),
+  ('cs231n.rnn_layers', 'lstm_forward', 'lstm_backward', _lstm_inputs, RNN),
+  ('cs231n.rnn_layers', 'word_embedding_forward', 'word_embedding_backward', _embedding_inputs, EMBEDDING),
+  ('cs231n.rnn_layers', 'temporal_affine_forward', 'temporal_affine_backward', _temporal_affine_inputs, TEMPORAL_AFFINE),
+  ('cs231n.rnn_layers', 'temporal_softmax_loss', None, _temporal_loss_inputs, TEMPORAL_LOSS),
+  ('cs231n.optim', 'sgd', 'step', _optim_inputs, OPTIM),
+  ('cs231n.optim', 'sgd_momentum', 'step', _optim_inputs, OPTIM),
+  ('cs231n.optim', 'rmsprop', 'step', _optim_inputs, OPTIM),
+  ('cs231n.optim', 'adagrad', 'step', _optim_inputs, OPTIM),
+  ('cs231n.optim', 'adam', 'step', _optim_inputs, OPTIM),
+]
+
+
+def _resolve(module_name, name):
+    """
+    Return the function name of the given module, or None if either is
+    missing.
+    """
+    if name is None:
+        return None
+    try:
+        module = importlib.import_module(module_name)
+    except ImportError:
+        return None
+    return getattr(module, name, None)
+
+
+def _measure(fn, repeat, min_time):
+    """
+    Time calls of fn the way timeit does: calls are grouped into loops that
+    take at least min_time seconds, and repeat loops are run.
+
+    Returns a tuple (median, best) of seconds per call.
+    """
+    timer = timeit.Timer(fn)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time or number >= 10 ** 6:
+            break
+        number *= max(2, min(10, int(min_time / max(elapsed, 1e-9)) + 1))
+    times = [elapsed] + timer.repeat(repeat=repeat - 1, number=number)
+    times = np.array(times) / number
+    return float(np.median(times)), float(np.min(times))
+
+
+def _time_case(forward, backward, is_optim, args, rng, repeat, min_time):
+    """
+    Time the passes of one benchmark case on the given inputs.
+
+    Returns a dictionary mapping each pass to its median time per call and
+    '<pass>_min' to its best time per call.
+    """
+    if is_optim:
+        # Run one step first so that the config holds the state of the update
+        # rule, as during training
+        w, dw, config = args
+        w, config = forward(w, dw, config)
+        timings = {'step': lambda: forward(w, dw, config)}
+    else:
+        timings = {'forward': lambda: forward(*args)}
+        if backward is not None:
+            out = forward(*args)
+            douts = [_randn(rng, o.shape, o.dtype) for o in out[:-1]]
+            cache = out[-1]
+            timings['backward'] = lambda: backward(*(douts + [cache]))
+
+    result = {}
+    for stage, fn in timings.items():
+        result[stage], result[stage + '_min'] = _measure(fn, repeat, min_time)
+    return result
+
+
+def _key(name, config, batch_size, dtype):
+    params = ','.join('%s=%s' % (k, config[k]) for k in sorted(config))
+    if batch_size is not None:
+        params += ',N=%d' % batch_size
+    return '%s[%s,%s]' % (name, params, dtype)
+
+
+def run(pattern=None, batch_sizes=BATCH_SIZES, dtypes=DTYPES, repeat=5,
+        min_time=0.05, seed=0, verbose=False):
+    """
+    Run the benchmark cases.
+
+    Inputs:
+    - pattern: If not None, only run cases whose function name matches this
+      regular expression.
+    - batch_sizes: Batch sizes to run layers with; update rules are run once
+      per parameter size instead.
+    - dtypes: Names of the dtypes to run with.
+    - repeat: Number of timed loops per measurement.
+    - min_time: Minimum duration in seconds of each timed loop.
+    - seed: Seed for the random inputs.
+    - verbose: If True, print each result as it is measured.
+
+    Returns a report dictionary with keys:
+    - 'meta': Versions and settings the benchmarks were run with
+    - 'results': List with one dictionary per benchmark, with keys key, name,
+      module, config, batch_size, dtype, and for every timed pass
+      ('forward', 'backward' or 'step') the median and best seconds per call
+      as '<pass>' and '<pass>_min'; cases that raise an exception have an
+      'error' message instead of timings
+    """
+    results = []
+    for module_name, fwd_name, bwd_name, inputs, configs in CASES:
+        if pattern is not None and not re.search(pattern, fwd_name):
+            continue
+        forward = _resolve(module_name, fwd_name)
+        if forward is None:
+            continue
+        is_optim = bwd_name == 'step'
+        backward = None if is_optim else _resolve(module_name, bwd_name)
+
+        for config in configs:
+            for dtype in dtypes:
+                for N in ([None] if is_optim else batch_sizes):
+                    rng = np.random.default_rng(seed)
+                    args = inputs(rng, N, dtype, **config)
+                    result = {
+                      'key': _key(fwd_name, config, N, dtype),
+                      'name': fwd_name,
+                      'module': module_name,
+                      'config': dict(config),
+                      'batch_size': N,
+                      'dtype': dtype,
+                    }
+
+                    try:
+                        result.update(_time_case(forward, backward, is_optim,
+                                                 args, rng, repeat, min_time))
+                    except Exception as e:
+                        result['error'] = '%s: %s' % (type(e).__name__, e)
+                    results.append(result)
+                    if verbose:
+                        print(_format_result(result))
+                        sys.stdout.flush()
+
+    return {
+      'meta': {
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'repeat': repeat,
+        'min_time': min_time,
+      },
+      'results': results,
+    }
+
+
+def _format_result(result):
+    times = ['%s %9.3f ms' % (stage, 1e3 * result[stage])
+             for stage in ('forward', 'backward', 'step') if stage in result]
+    if 'error' in result:
+        times = ['error: ' + result['error']]
+    return '%-72s %s' % (result['key'], '  '.join(times))
+
+
+def compare(report, baseline, threshold=0.1):
+    """
+    Compare the median timings of a report with those of a baseline report.
+
+    Inputs:
+    - report, baseline: Reports returned by run.
+    - threshold: Relative change below which timings count as unchanged.
+
+    Returns a list of dictionaries, one per timing present in both reports
+    whose ratio to the baseline is outside [1 - threshold, 1 + threshold],
+    with keys key, stage, baseline, current, ratio and status ('slower' or
+    'faster'), sorted by decreasing ratio.
+    """
+    old = {r['key']: r for r in baseline['results']}
+    changes = []
+    for result in report['results']:
+        base = old.get(result['key'])
+        if base is None:
+            continue
+        for stage in ('forward', 'backward', 'step'):
+            if stage not in result or stage not in base:
+                continue
+            ratio = result[stage] / base[stage]
+            if abs(ratio - 1) <= threshold:
+                continue
+            changes.append({
+              'key': result['key'],
+              'stage': stage,
+              'baseline': base[stage],
+              'current': result[stage],
+              'ratio': ratio,
+              'status': 'slower' if ratio > 1 else 'faster',
+            })
+    return sorted(changes, key=lambda c: -c['ratio'])
+
+
+def save_report(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+
+def load_report(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the cs231n layers.')
+    parser.add_argument('--filter', default=None,
+                        help='only run functions matching this regular expression')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=list(BATCH_SIZES))
+    parser.add_argument('--dtypes', nargs='+', default=list(DTYPES))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.05)
+    parser.add_argument('--out', default=None, help='path of the JSON report to write')
+    parser.add_argument('--baseline', default=None, help='JSON report to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    report = run(args.filter, args.batch_sizes, args.dtypes, args.repeat,
+                 args.min_time, verbose=True)
+    if args.out is not None:
+        save_report(report, args.out)
+
+    if args.baseline is None:
+        return 0
+    changes = compare(report, load_report(args.baseline), args.threshold)
+    print()
+    print('%d timings changed by more than %.0f%%' % (len(changes), 100 * args.threshold))
+    for c in changes:
+        print('%-6s %-8s %-72s %9.3f ms -> %9.3f ms (%.2fx)' % (
+            c['status'], c['stage'], c['key'], 1e3 * c['baseline'],
+            1e3 * c['current'], c['ratio']))
+    return 1 if any(c['status'] == 'slower' for c in changes) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
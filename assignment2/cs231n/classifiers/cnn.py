@@ -1,11 +1,12 @@
 from builtins import object
 import numpy as np
-import math
 
 from cs231n.layers import *
 from cs231n.fast_layers import *
 from cs231n.layer_utils import *
 from cs231n.classifiers.fc_net import *
+from cs231n.flat_params import FlatParams
+from cs231n.precision import add_reg_grad
 
 
 class ThreeLayerConvNet(object):
@@ -21,7 +22,7 @@ class ThreeLayerConvNet(object):
 
     def __init__(self, input_dim=(3, 32, 32), num_filters=32, filter_size=7,
                  hidden_dim=100, num_classes=10, weight_scale=1e-3, reg=0.0,
-                 dtype=np.float32):
+                 dtype=np.float32, flat_params=False):
         """
         Initialize a new network.
 
@@ -35,6 +36,9 @@ class ThreeLayerConvNet(object):
           of weights.
         - reg: Scalar giving L2 regularization strength
         - dtype: numpy datatype to use for computation.
+        - flat_params: If True, every entry of self.params is a view into one
+          contiguous buffer of this dtype, self.flat.data, and loss writes the
+          gradients into the matching buffer self.flat.grad.
         """
         self.params = {}
         self.reg = reg
@@ -65,6 +69,11 @@ class ThreeLayerConvNet(object):
         for k, v in self.params.items():
             self.params[k] = v.astype(dtype)
 
+        self.flat = None
+        if flat_params:
+            self.flat = FlatParams(self.params, dtype)
+            self.params = self.flat.params
+
 
     def loss(self, X, y=None):
         """
@@ -120,13 +129,16 @@ class ThreeLayerConvNet(object):
         _  , grads['W1'], grads['b1'] = conv_relu_pool_backward(dx2,cache1)
 
         # Agrego regularización a los gradientes
-        grads['W3'] += reg * W3
-        grads['W2'] += reg * W2
-        grads['W1'] += reg * W1
+        add_reg_grad(grads['W3'], W3, reg)
+        add_reg_grad(grads['W2'], W2, reg)
+        add_reg_grad(grads['W1'], W1, reg)
         ############################################################################
         #                             END OF YOUR CODE                             #
         ############################################################################
 
+        if self.flat is not None:
+            self.flat.pack_grads(grads)
+
         return loss, grads
 
 class FullyConnectedConvNet(object):
@@ -193,7 +205,7 @@ class FullyConnectedConvNet(object):
 
         #########
         affine_input_dim  = conv_filter_number[-1]*input_dim[1]*input_dim[2]
-        affine_input_dim /= math.pow(2, 2*len(conv_filter_number))
+        affine_input_dim //= 4**len(conv_filter_number)
 
         self.FullyConnectedNet = FullyConnectedNet(affine_hidden_dims, affine_input_dim, num_classes, dropout, True, 1e-4, weight_scale)
 
@@ -208,11 +220,34 @@ class FullyConnectedConvNet(object):
         # pass of the second batch normalization layer, etc.
         self.bn_params = []
         self.bn_params = [{'mode': 'train'} for i in range(self.num_conv_layers)]
+        self.folded_params = None
         
         for k, v in self.params.items():
             self.params[k] = v.astype(dtype)
 
 
+    def fold_batchnorm(self):
+        """
+        Fold the spatial batch normalization of every conv block into its conv
+        filters and biases, and the batchnorm of the affine layers into their
+        weights.
+
+        After this is called, test-time forward passes run [conv-relu-pool]
+        blocks on the folded weights and skip batchnorm entirely. A training-time
+        call to loss discards the folded weights.
+        """
+        folded = {}
+        for conv_layer in range(self.num_conv_layers):
+            index = conv_layer+1+self.num_affine_layers
+            W_i = self.params['W'+str(index)]
+            b_i = self.params['b'+str(index)]
+            gamma_i = self.params['gamma'+str(index)]
+            beta_i  = self.params['beta'+str(index)]
+            folded['W'+str(index)], folded['b'+str(index)] = batchnorm_fold(W_i, b_i, gamma_i, beta_i, self.bn_params[conv_layer])
+        self.folded_params = folded
+        self.FullyConnectedNet.fold_batchnorm()
+
+
     def loss(self, X, y=None):
         """
         Evaluate loss and gradient for the three-layer convolutional network.
@@ -235,6 +270,10 @@ class FullyConnectedConvNet(object):
         for bn_param in self.bn_params:
             bn_param['mode'] = mode
 
+        # Folded weights are only valid for the parameters they were built from
+        if mode == 'train':
+            self.folded_params = None
+
         # pass pool_param to the forward pass for the max-pooling layer
         pool_param = {'pool_height': 2, 'pool_width': 2, 'stride': 2}
 
@@ -261,12 +300,16 @@ class FullyConnectedConvNet(object):
             bn_params   = self.bn_params[conv_layer]
 
             # Hago el forward pass para cada capa de convolución
-            input_conv, cache[index] = conv_batchnorm_relu_pool_forward(input_conv, W_i, b_i, gamma_i, beta_i, conv_param, bn_params, pool_param)
+            if self.folded_params is not None:
+                W_f, b_f = self.folded_params['W'+str(index)], self.folded_params['b'+str(index)]
+                input_conv, cache[index] = conv_relu_pool_forward(input_conv, W_f, b_f, conv_param, pool_param)
+            else:
+                input_conv, cache[index] = conv_batchnorm_relu_pool_forward(input_conv, W_i, b_i, gamma_i, beta_i, conv_param, bn_params, pool_param)
 
         # Genero la entrada de la FullyConnectedLayer a partir de la salida de la última capa
         # de convolución, guardo el shape de la salida de la última capa para usar en el backward
         input_conv_shape = input_conv.shape
-        input_fully_connected = input_conv.reshape(input_conv_shape[0], np.prod(input_conv_shape)/input_conv_shape[0])
+        input_fully_connected = input_conv.reshape(input_conv_shape[0], np.prod(input_conv_shape)//input_conv_shape[0])
         ############################################################################
         #                             END OF YOUR CODE                             #
         ############################################################################
@@ -299,7 +342,7 @@ class FullyConnectedConvNet(object):
         # Agrego regularización a los gradientes
         for i in range(1,self.num_conv_layers+1):
             W_i = self.params['W'+str(i+self.num_affine_layers)]
-            grads['W'+str(i+self.num_affine_layers)] += reg * W_i
+            add_reg_grad(grads['W'+str(i+self.num_affine_layers)], W_i, reg)
         ############################################################################
         #                             END OF YOUR CODE                             #
         ############################################################################
@@ -400,7 +443,7 @@ class FullyConnectedConvNet2(object):
 
         #########
         affine_input_dim  = conv_filter_number[-1]*input_dim[1]*input_dim[2]
-        affine_input_dim /= math.pow(2, 2*len(conv_filter_number))
+        affine_input_dim //= 4**len(conv_filter_number)
 
         self.FullyConnectedNet = FullyConnectedNet(affine_hidden_dims, affine_input_dim, num_classes, dropout, True, reg, weight_scale)
 
@@ -486,7 +529,7 @@ class FullyConnectedConvNet2(object):
         # Genero la entrada de la FullyConnectedLayer a partir de la salida de la última capa
         # de convolución, guardo el shape de la salida de la última capa para usar en el backward
         input_conv_shape = input_conv.shape
-        input_fully_connected = input_conv.reshape(input_conv_shape[0], np.prod(input_conv_shape)/input_conv_shape[0])
+        input_fully_connected = input_conv.reshape(input_conv_shape[0], np.prod(input_conv_shape)//input_conv_shape[0])
         ############################################################################
         #                             END OF YOUR CODE                             #
         ############################################################################
@@ -541,11 +584,11 @@ class FullyConnectedConvNet2(object):
 
             # Primera Capa Interna
             W_i = self.params['W'+str(index)]
-            grads['W'+str(index)] += reg * W_i
+            add_reg_grad(grads['W'+str(index)], W_i, reg)
 
             # Segunda Capa Interna
             W_i = self.params['W'+str(index+1)]
-            grads['W'+str(index+1)] += reg * W_i
+            add_reg_grad(grads['W'+str(index+1)], W_i, reg)
 
             # Acumulador Capas Internas
             capas_internas += 1
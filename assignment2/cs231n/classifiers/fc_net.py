@@ -4,6 +4,8 @@ import numpy as np
 
 from cs231n.layers import *
 from cs231n.layer_utils import *
+from cs231n.flat_params import FlatParams
+from cs231n.precision import add_reg_grad
 
 
 class TwoLayerNet(object):
@@ -114,8 +116,8 @@ class TwoLayerNet(object):
         _,  grads['W1'], grads['b1'] = affine_relu_backward(dh, cache1)
 
         # Agrego regularización a los gradientes
-        grads['W2'] += reg * W2
-        grads['W1'] += reg * W1
+        add_reg_grad(grads['W2'], W2, reg)
+        add_reg_grad(grads['W1'], W1, reg)
         ############################################################################
         #                             END OF YOUR CODE                             #
         ############################################################################
@@ -141,7 +143,7 @@ class FullyConnectedNet(object):
 
     def __init__(self, hidden_dims, input_dim=3*32*32, num_classes=10,
                  dropout=0, use_batchnorm=False, reg=0.0,
-                 weight_scale=1e-2, dtype=np.float32, seed=None):
+                 weight_scale=1e-2, dtype=np.float32, seed=None, flat_params=False):
         """
         Initialize a new FullyConnectedNet.
 
@@ -161,6 +163,9 @@ class FullyConnectedNet(object):
         - seed: If not None, then pass this random seed to the dropout layers. This
           will make the dropout layers deteriminstic so we can gradient check the
           model.
+        - flat_params: If True, every entry of self.params is a view into one
+          contiguous buffer of this dtype, self.flat.data, and loss writes the
+          gradients into the matching buffer self.flat.grad.
         """
         self.use_batchnorm = use_batchnorm
         self.use_dropout = dropout > 0
@@ -168,6 +173,7 @@ class FullyConnectedNet(object):
         self.num_layers = 1 + len(hidden_dims)
         self.dtype = dtype
         self.params = {}
+        self.folded_params = None
 
         ############################################################################
         # TODO: Initialize the parameters of the network, storing all values in    #
@@ -205,12 +211,14 @@ class FullyConnectedNet(object):
 
         # When using dropout we need to pass a dropout_param dictionary to each
         # dropout layer so that the layer knows the dropout probability and the mode
-        # (train / test). You can pass the same dropout_param to each dropout layer.
-        self.dropout_param = {}
+        # (train / test). Each dropout layer gets its own dropout_param, since the
+        # layer keeps its random generator there.
+        self.dropout_params = []
         if self.use_dropout:
-            self.dropout_param = {'mode': 'train', 'p': dropout}
+            self.dropout_params = [{'mode': 'train', 'p': dropout} for i in range(self.num_layers - 1)]
             if seed is not None:
-                self.dropout_param['seed'] = seed
+                for i, dropout_param in enumerate(self.dropout_params):
+                    dropout_param['seed'] = seed + i
 
         # With batch normalization we need to keep track of running means and
         # variances, so we need to pass a special bn_param object to each batch
@@ -225,6 +233,34 @@ class FullyConnectedNet(object):
         for k, v in self.params.items():
             self.params[k] = v.astype(dtype)
 
+        self.flat = None
+        if flat_params:
+            self.flat = FlatParams(self.params, dtype)
+            self.params = self.flat.params
+
+
+    def fold_batchnorm(self):
+        """
+        Fold every batch normalization layer into the affine layer before it.
+
+        After this is called, test-time forward passes run a plain
+        {affine - relu} x (L - 1) - affine network on the folded weights and
+        skip batchnorm entirely. A training-time call to loss discards the
+        folded weights, since they go stale as soon as the parameters change.
+        """
+        if not self.use_batchnorm:
+            self.folded_params = None
+            return
+
+        folded = {}
+        for i in range(1, self.num_layers):
+            W_i, b_i = self.params['W'+str(i)], self.params['b'+str(i)]
+            gamma_i, beta_i = self.params['gamma'+str(i)], self.params['beta'+str(i)]
+            folded['W'+str(i)], folded['b'+str(i)] = batchnorm_fold(W_i, b_i, gamma_i, beta_i, self.bn_params[i-1])
+        folded['W'+str(self.num_layers)] = self.params['W'+str(self.num_layers)]
+        folded['b'+str(self.num_layers)] = self.params['b'+str(self.num_layers)]
+        self.folded_params = folded
+
 
     def loss(self, X, y=None):
         """
@@ -235,10 +271,21 @@ class FullyConnectedNet(object):
         X = X.astype(self.dtype)
         mode = 'test' if y is None else 'train'
 
+        # Folded weights are only valid for the parameters they were built from
+        if mode == 'train':
+            self.folded_params = None
+        elif self.folded_params is not None:
+            out = X
+            for i in range(1, self.num_layers):
+                out, _ = affine_relu_forward(out, self.folded_params['W'+str(i)], self.folded_params['b'+str(i)])
+            scores, _ = affine_forward(out, self.folded_params['W'+str(self.num_layers)], self.folded_params['b'+str(self.num_layers)])
+            return scores
+
         # Set train/test mode for batchnorm params and dropout param since they
         # behave differently during training and testing.
         if self.use_dropout:
-            self.dropout_param['mode'] = mode
+            for dropout_param in self.dropout_params:
+                dropout_param['mode'] = mode
         if self.use_batchnorm:
             for bn_param in self.bn_params:
                 bn_param['mode'] = mode
@@ -248,8 +295,8 @@ class FullyConnectedNet(object):
         # TODO: Implement the forward pass for the fully-connected net, computing  #
         # the class scores for X and storing them in the scores variable.          #
         #                                                                          #
-        # When using dropout, you'll need to pass self.dropout_param to each       #
-        # dropout forward pass.                                                    #
+        # When using dropout, you'll need to pass self.dropout_params[0] to the    #
+        # first dropout forward pass, self.dropout_params[1] to the second, etc.   #
         #                                                                          #
         # When using batch normalization, you'll need to pass self.bn_params[0] to #
         # the forward pass for the first batch normalization layer, pass           #
@@ -279,12 +326,12 @@ class FullyConnectedNet(object):
             
             out[1], cache[1]  = affine_batchnorm_relu_forward(X,W[1],b[1],gamma[1],beta[1],self.bn_params[0])
             if self.use_dropout:
-                out[1], dropout_cache[1] = dropout_forward(out[1],self.dropout_param)
+                out[1], dropout_cache[1] = dropout_forward(out[1],self.dropout_params[0])
 
             for i in range(2,num_layers):
                 out[i], cache[i]  = affine_batchnorm_relu_forward(out[i-1],W[i],b[i],gamma[i],beta[i],self.bn_params[i-1])
                 if self.use_dropout:
-                    out[i], dropout_cache[i] = dropout_forward(out[i],self.dropout_param)
+                    out[i], dropout_cache[i] = dropout_forward(out[i],self.dropout_params[i-1])
 
             scores, cache[num_layers] = affine_forward(out[num_layers-1],W[num_layers],b[num_layers])
         else:
@@ -295,12 +342,12 @@ class FullyConnectedNet(object):
             
             out[1], cache[1]  = affine_relu_forward(X,W[1],b[1])
             if self.use_dropout:
-                out[1], dropout_cache[1] = dropout_forward(out[1],self.dropout_param)
+                out[1], dropout_cache[1] = dropout_forward(out[1],self.dropout_params[0])
 
             for i in range(2,num_layers):
                 out[i], cache[i]  = affine_relu_forward(out[i-1],W[i],b[i])
                 if self.use_dropout:
-                    out[i], dropout_cache[i] = dropout_forward(out[i],self.dropout_param)
+                    out[i], dropout_cache[i] = dropout_forward(out[i],self.dropout_params[i-1])
 
             scores, cache[num_layers] = affine_forward(out[num_layers-1],W[num_layers],b[num_layers])
         ############################################################################
@@ -354,11 +401,14 @@ class FullyConnectedNet(object):
 
         # Agrego regularización a los gradientes
         for i in range(1,num_layers+1):
-            grads['W'+str(i)] += reg * W[i]
+            add_reg_grad(grads['W'+str(i)], W[i], reg)
 
 
         # Guardo el gradiente según la entrada inicial, esto se usa en cnn.py
         grads['dInput'] = dh[1]
+
+        if self.flat is not None:
+            self.flat.pack_grads(grads)
         ############################################################################
         #                             END OF YOUR CODE                             #
         ############################################################################
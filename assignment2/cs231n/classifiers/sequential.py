@@ -0,0 +1,443 @@
+from builtins import range
+from builtins import object
+import numpy as np
+
+from cs231n.layers import *
+from cs231n.fast_layers import *
+from cs231n.flat_params import FlatParams
+from cs231n.precision import add_reg_grad
+
+
+"""
+This file implements a model built from a list of layers, so that networks of
+any depth can be put together from the layer functions without writing a new
+loss() for each architecture.
+
+The layers are declared by what they compute, not by the shapes of their
+weights: the model infers the shape of every layer's input from the layers
+before it, and allocates all parameters once, when it is built. Parameters are
+named as in FullyConnectedNet: the k-th affine or conv layer has weights Wk and
+biases bk, and a batch normalization layer following it has gammak and betak.
+
+Example usage:
+
+model = SequentialNet([
+    Conv(32, 3), SpatialBatchNorm(), ReLU(), MaxPool(2),
+    Conv(64, 3), SpatialBatchNorm(), ReLU(), MaxPool(2),
+    Affine(256), BatchNorm(), ReLU(), Dropout(0.5),
+    Affine(10),
+  ], input_dim=(3, 32, 32), weight_scale=1e-2, reg=1e-3)
+print(model.summary())
+solver = Solver(model, data, ...)
+"""
+
+
+class Layer(object):
+    """
+    Base class of the layers of a SequentialNet.
+
+    A layer is built once with the shape of a single input (without the batch
+    dimension); build returns the shape of its output and the parameters it
+    needs. After that, forward and backward run the layer functions on a
+    minibatch. Every layer implements:
+
+    - forward(x, params, buffers=None): Returns a tuple (out, cache) as the
+      layer functions do.
+    - backward(dout, cache, buffers=None): Returns a tuple (dx, dparams), where
+      dparams is a tuple of gradients in the order of self.names.
+
+    During training SequentialNet passes each layer a dictionary of its own,
+    buffers, that persists across calls; layers whose functions accept out=
+    arrays keep their outputs in it (see _buffer), the others ignore it.
+    """
+    names = ()
+
+    def build(self, input_shape, index, weight_scale):
+        """
+        Inputs:
+        - input_shape: Tuple giving the shape of one input to this layer.
+        - index: Number k of the last affine or conv layer up to this one,
+          used to name the parameters.
+        - weight_scale: Standard deviation of the initial weights.
+
+        Returns a tuple of:
+        - output_shape: Tuple giving the shape of one output of this layer
+        - params: Dictionary of initial values of the parameters of this layer
+        """
+        self.input_shape = input_shape
+        return input_shape, {}
+
+
+def _buffer(buffers, name, shape, dtype):
+    """
+    Return the array buffers[name] if it has the given shape and datatype, or
+    replace it with a new one; returns None if buffers is None.
+    """
+    if buffers is None:
+        return None
+    buf = buffers.get(name)
+    if buf is None or buf.shape != shape or buf.dtype != dtype:
+        buf = buffers[name] = np.empty(shape, dtype=dtype)
+    return buf
+
+
+class Affine(Layer):
+    """
+    Fully-connected layer with num_units outputs; inputs of any shape are
+    flattened.
+    """
+
+    def __init__(self, num_units):
+        self.num_units = num_units
+
+
+    def build(self, input_shape, index, weight_scale):
+        self.input_shape = input_shape
+        self.names = ('W%d' % index, 'b%d' % index)
+        D = int(np.prod(input_shape))
+        params = {
+          self.names[0]: np.random.normal(0, weight_scale, (D, self.num_units)),
+          self.names[1]: np.zeros(self.num_units),
+        }
+        return (self.num_units,), params
+
+
+    def forward(self, x, params, buffers=None):
+        w, b = params[self.names[0]], params[self.names[1]]
+        out = _buffer(buffers, 'out', (x.shape[0], self.num_units), np.result_type(x, w))
+        return affine_forward(x, w, b, out=out)
+
+
+    def backward(self, dout, cache, buffers=None):
+        x, w, _ = cache
+        dx = _buffer(buffers, 'dx', (x.shape[0], w.shape[0]), np.result_type(dout, w))
+        dx, dw, db = affine_backward(dout, cache, dx_out=dx)
+        return dx, (dw, db)
+
+
+class Conv(Layer):
+    """
+    Convolutional layer with num_filters square filters. The padding defaults
+    to (filter_size - 1) // 2, which keeps the spatial size for odd filter
+    sizes and stride 1.
+    """
+
+    def __init__(self, num_filters, filter_size, stride=1, pad=None):
+        self.num_filters = num_filters
+        self.filter_size = filter_size
+        self.conv_param = {
+          'stride': stride,
+          'pad': (filter_size - 1) // 2 if pad is None else pad,
+        }
+
+
+    def build(self, input_shape, index, weight_scale):
+        if len(input_shape) != 3:
+            raise ValueError('Conv expects inputs of shape (C, H, W), got %s' % (input_shape,))
+        C, H, W = input_shape
+        F, HH = self.num_filters, self.filter_size
+        stride, pad = self.conv_param['stride'], self.conv_param['pad']
+        if (H + 2 * pad - HH) % stride != 0 or (W + 2 * pad - HH) % stride != 0:
+            raise ValueError('Conv with filter %d, stride %d and pad %d does not tile inputs of shape %s'
+                             % (HH, stride, pad, input_shape))
+
+        self.input_shape = input_shape
+        self.names = ('W%d' % index, 'b%d' % index)
+        params = {
+          self.names[0]: np.random.normal(0, weight_scale, (F, C, HH, HH)),
+          self.names[1]: np.zeros(F),
+        }
+        H_out = (H + 2 * pad - HH) // stride + 1
+        W_out = (W + 2 * pad - HH) // stride + 1
+        return (F, H_out, W_out), params
+
+
+    def forward(self, x, params, buffers=None):
+        return conv_forward_fast(x, params[self.names[0]], params[self.names[1]], self.conv_param)
+
+
+    def backward(self, dout, cache, buffers=None):
+        dx, dw, db = conv_backward_fast(dout, cache)
+        return dx, (dw, db)
+
+
+class MaxPool(Layer):
+    """
+    Max pooling over pool_size x pool_size regions; the stride defaults to the
+    pool size.
+    """
+
+    def __init__(self, pool_size=2, stride=None):
+        self.pool_param = {
+          'pool_height': pool_size,
+          'pool_width': pool_size,
+          'stride': pool_size if stride is None else stride,
+        }
+
+
+    def build(self, input_shape, index, weight_scale):
+        if len(input_shape) != 3:
+            raise ValueError('MaxPool expects inputs of shape (C, H, W), got %s' % (input_shape,))
+        C, H, W = input_shape
+        size, stride = self.pool_param['pool_height'], self.pool_param['stride']
+        if (H - size) % stride != 0 or (W - size) % stride != 0:
+            raise ValueError('MaxPool of size %d and stride %d does not tile inputs of shape %s'
+                             % (size, stride, input_shape))
+        self.input_shape = input_shape
+        return (C, (H - size) // stride + 1, (W - size) // stride + 1), {}
+
+
+    def forward(self, x, params, buffers=None):
+        return max_pool_forward_fast(x, self.pool_param)
+
+
+    def backward(self, dout, cache, buffers=None):
+        return max_pool_backward_fast(dout, cache), ()
+
+
+class ReLU(Layer):
+
+    def forward(self, x, params, buffers=None):
+        return relu_forward(x, out=_buffer(buffers, 'out', x.shape, x.dtype))
+
+
+    def backward(self, dout, cache, buffers=None):
+        # relu_backward already works in place on dout
+        return relu_backward(dout, cache), ()
+
+
+class LeakyReLU(Layer):
+
+    def forward(self, x, params, buffers=None):
+        return leaky_relu_forward(x)
+
+
+    def backward(self, dout, cache, buffers=None):
+        return leaky_relu_backward(dout, cache), ()
+
+
+class Dropout(Layer):
+    """
+    Inverted dropout that drops each unit with probability p.
+    """
+
+    def __init__(self, p):
+        self.dropout_param = {'mode': 'train', 'p': p}
+
+
+    def forward(self, x, params, buffers=None):
+        return dropout_forward(x, self.dropout_param)
+
+
+    def backward(self, dout, cache, buffers=None):
+        return dropout_backward(dout, cache), ()
+
+
+class BatchNorm(Layer):
+    """
+    Batch normalization of the features of a (D,) shaped input. It takes its
+    parameter names from the affine or conv layer before it.
+    """
+
+    def __init__(self, momentum=0.9, eps=1e-5):
+        self.bn_param = {'mode': 'train', 'momentum': momentum, 'eps': eps}
+
+
+    def num_features(self, input_shape):
+        if len(input_shape) != 1:
+            raise ValueError('BatchNorm expects inputs of shape (D,), got %s; use SpatialBatchNorm'
+                             % (input_shape,))
+        return input_shape[0]
+
+
+    def build(self, input_shape, index, weight_scale):
+        if index == 0:
+            raise ValueError('%s must follow an affine or conv layer' % type(self).__name__)
+        D = self.num_features(input_shape)
+        self.input_shape = input_shape
+        self.names = ('gamma%d' % index, 'beta%d' % index)
+        return input_shape, {self.names[0]: np.ones(D), self.names[1]: np.zeros(D)}
+
+
+    def forward(self, x, params, buffers=None):
+        return batchnorm_forward(x, params[self.names[0]], params[self.names[1]], self.bn_param)
+
+
+    def backward(self, dout, cache, buffers=None):
+        dx, dgamma, dbeta = batchnorm_backward(dout, cache)
+        return dx, (dgamma, dbeta)
+
+
+class SpatialBatchNorm(BatchNorm):
+    """
+    Batch normalization of the channels of a (C, H, W) shaped input.
+    """
+
+    def num_features(self, input_shape):
+        if len(input_shape) != 3:
+            raise ValueError('SpatialBatchNorm expects inputs of shape (C, H, W), got %s'
+                             % (input_shape,))
+        return input_shape[0]
+
+
+    def forward(self, x, params, buffers=None):
+        return spatial_batchnorm_forward(x, params[self.names[0]], params[self.names[1]], self.bn_param)
+
+
+    def backward(self, dout, cache, buffers=None):
+        dx, dgamma, dbeta = spatial_batchnorm_backward(dout, cache)
+        return dx, (dgamma, dbeta)
+
+
+class SequentialNet(object):
+    """
+    A network that applies a list of layers in order, followed by a softmax
+    or SVM loss on the output of the last layer; see the top of this file.
+
+    The model exposes the same attributes as FullyConnectedNet to the Solver:
+    params, reg, dtype, flat, bn_params and dropout_params.
+    """
+
+    def __init__(self, layers, input_dim=(3, 32, 32), weight_scale=1e-3,
+                 reg=0.0, loss='softmax', dtype=np.float32, seed=None,
+                 flat_params=False):
+        """
+        Build the network and initialize its parameters.
+
+        Inputs:
+        - layers: List of Layer objects. The number of outputs of the last
+          layer is the number of classes.
+        - input_dim: Tuple giving the shape of one input, for example (C, H, W)
+          for images or (D,) for vectors.
+        - weight_scale: Scalar giving the standard deviation for random
+          initialization of the weights.
+        - reg: Scalar giving L2 regularization strength; only the weights W
+          are regularized.
+        - loss: Either 'softmax' or 'svm'.
+        - dtype: numpy datatype to use for computation.
+        - seed: If not None, then pass this random seed to the dropout layers.
+        - flat_params: If True, every entry of self.params is a view into one
+          contiguous buffer of this dtype, self.flat.data, and loss writes the
+          gradients into the matching buffer self.flat.grad.
+        """
+        if loss not in ('softmax', 'svm'):
+            raise ValueError('Invalid loss "%s"' % loss)
+        self.layers = list(layers)
+        self.reg = reg
+        self.loss_type = loss
+        self.dtype = dtype
+        self.params = {}
+
+        # Infer the shape of every layer's input, and allocate its parameters
+        self.shapes = [tuple(input_dim)]
+        index = 0
+        for layer in self.layers:
+            if isinstance(layer, (Affine, Conv)):
+                index += 1
+            shape, params = layer.build(self.shapes[-1], index, weight_scale)
+            for k in params:
+                if k in self.params:
+                    raise ValueError('Parameter %s is used by two layers' % k)
+            self.params.update(params)
+            self.shapes.append(tuple(shape))
+        if len(self.shapes[-1]) != 1:
+            raise ValueError('The last layer must output scores of shape (C,), got %s'
+                             % (self.shapes[-1],))
+        self.num_classes = self.shapes[-1][0]
+        self.weight_names = [k for k in self.params if k.startswith('W')]
+
+        self.bn_params = [l.bn_param for l in self.layers if isinstance(l, BatchNorm)]
+        self.dropout_params = [l.dropout_param for l in self.layers if isinstance(l, Dropout)]
+        if seed is not None:
+            for i, dropout_param in enumerate(self.dropout_params):
+                dropout_param['seed'] = seed + i
+
+        # Cast all parameters to the correct datatype
+        for k, v in self.params.items():
+            self.params[k] = v.astype(dtype)
+
+        self.flat = None
+        if flat_params:
+            self.flat = FlatParams(self.params, dtype)
+            self.params = self.flat.params
+
+        # The caches of a training-time forward pass, one slot per layer; each
+        # slot is released as soon as its layer has run backward
+        self.caches = [None] * len(self.layers)
+
+        # Buffers of every layer, reused by all training-time calls with the
+        # same batch size. Affine layers keep their outputs and input
+        # gradients there and ReLU layers their outputs; no buffer outlives
+        # the call that fills it, since the caches are released by backward
+        # and neither the loss nor the gradients returned refer to them. Test
+        # time outputs are always new arrays, since callers may keep them
+        self.buffers = [{} for layer in self.layers]
+
+
+    def summary(self):
+        """
+        Return a text table of the layers with their output shapes and their
+        numbers of parameters.
+        """
+        lines = ['%-4s %-18s %-16s %-22s %10s' % ('', 'layer', 'output shape', 'params', 'size')]
+        lines.append('%-4s %-18s %-16s' % ('', 'input', 'x'.join(str(d) for d in self.shapes[0])))
+        for i, layer in enumerate(self.layers):
+            size = sum(self.params[k].size for k in layer.names)
+            lines.append('%-4d %-18s %-16s %-22s %10d' % (
+                i, type(layer).__name__, 'x'.join(str(d) for d in self.shapes[i + 1]),
+                ','.join(layer.names), size))
+        lines.append('total parameters: %d' % sum(v.size for v in self.params.values()))
+        return '\n'.join(lines)
+
+
+    def loss(self, X, y=None):
+        """
+        Evaluate loss and gradient for the network.
+
+        Input / output: Same API as TwoLayerNet in fc_net.py.
+        """
+        X = X.astype(self.dtype, copy=False)
+        if X.shape[1:] != self.shapes[0]:
+            raise ValueError('Expected inputs of shape (N,) + %s, got %s' % (self.shapes[0], X.shape))
+        mode = 'test' if y is None else 'train'
+        for bn_param in self.bn_params:
+            bn_param['mode'] = mode
+        for dropout_param in self.dropout_params:
+            dropout_param['mode'] = mode
+
+        params = self.params
+        out = X
+        if mode == 'test':
+            for layer in self.layers:
+                out, _ = layer.forward(out, params)
+            return out
+
+        caches, buffers = self.caches, self.buffers
+        for i, layer in enumerate(self.layers):
+            out, caches[i] = layer.forward(out, params, buffers[i])
+        scores = out
+
+        if self.loss_type == 'softmax':
+            loss, dout = softmax_loss(scores, y)
+        else:
+            loss, dout = svm_loss(scores, y)
+        for k in self.weight_names:
+            loss += 0.5 * self.reg * np.sum(params[k] * params[k])
+
+        # With flat parameters the gradients go straight into self.flat.grad
+        grads = {} if self.flat is None else self.flat.grads
+        for i in range(len(self.layers) - 1, -1, -1):
+            layer = self.layers[i]
+            dout, dparams = layer.backward(dout, caches[i], buffers[i])
+            caches[i] = None
+            for k, dp in zip(layer.names, dparams):
+                if self.flat is None:
+                    grads[k] = dp
+                else:
+                    grads[k][...] = dp
+
+        # Add the gradients of the regularization of the weights
+        for k in self.weight_names:
+            add_reg_grad(grads[k], params[k], self.reg)
+
+        return loss, dict(grads)
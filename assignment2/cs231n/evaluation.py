@@ -0,0 +1,82 @@
+from __future__ import division
+from builtins import range
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+
+import numpy as np
+
+
+def evaluate(model, X, y, batch_size=1000, num_threads=1, top_k=5,
+             num_classes=None, dtype=None):
+    """
+    Evaluate a classification model on a whole dataset in one pass.
+
+    The data is split into batches of batch_size which are run through
+    model.loss(X_batch) on a pool of num_threads threads; the large matrix
+    multiplies release the GIL, so batches overlap. Each batch writes its
+    predictions into slices of preallocated arrays, so no per-batch results are
+    kept around.
+
+    Inputs:
+    - model: A model whose loss(X) returns scores of shape (N, C), as expected
+      by the Solver. With num_threads > 1 the test-time forward pass of the
+      model must not modify shared state beyond setting layer modes.
+    - X: Array of data, of shape (N, d_1, ..., d_k)
+    - y: Array of labels, of shape (N,)
+    - batch_size: Number of samples per forward pass.
+    - num_threads: Number of threads to run batches on.
+    - top_k: A sample counts as correct for top-k accuracy if its label is
+      among the top_k highest scores.
+    - num_classes: Number of classes C for per-class accuracy; by default the
+      number of columns of the scores.
+    - dtype: If not None, batches are cast to this datatype.
+
+    Returns a dictionary with keys:
+    - 'top1': Fraction of samples whose highest score is the correct class
+    - 'top<k>': Fraction of samples whose label is among the top_k scores
+    - 'per_class': Array of shape (C,) giving the top-1 accuracy on the
+      samples of each class; nan for classes without samples
+    - 'predictions': Array of shape (N,) of predicted labels
+    """
+    N = X.shape[0]
+    pred = np.zeros(N, dtype=np.intp)
+    in_top_k = np.zeros(N, dtype=bool)
+
+    def run_batch(start):
+        end = min(start + batch_size, N)
+        X_batch = X[start:end]
+        if dtype is not None:
+            X_batch = X_batch.astype(dtype)
+        scores = model.loss(X_batch)
+        C = scores.shape[1]
+        pred[start:end] = np.argmax(scores, axis=1)
+        if top_k >= C:
+            in_top_k[start:end] = True
+        else:
+            top = np.argpartition(scores, C - top_k, axis=1)[:, C - top_k:]
+            in_top_k[start:end] = np.any(top == y[start:end, np.newaxis], axis=1)
+        return C
+
+    starts = list(range(0, N, batch_size))
+    if num_threads > 1 and len(starts) > 1 and ThreadPoolExecutor is not None:
+        with ThreadPoolExecutor(max_workers=num_threads) as pool:
+            score_dims = list(pool.map(run_batch, starts))
+    else:
+        score_dims = [run_batch(start) for start in starts]
+
+    if num_classes is None:
+        num_classes = max(score_dims) if score_dims else 0
+    correct = pred == y
+    counts = np.bincount(y, minlength=num_classes)
+    hits = np.bincount(y, weights=correct, minlength=num_classes)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        per_class = np.where(counts > 0, hits / counts, np.nan)
+
+    return {
+      'top1': float(np.mean(correct)) if N > 0 else 0.0,
+      'top%d' % top_k: float(np.mean(in_top_k)) if N > 0 else 0.0,
+      'per_class': per_class,
+      'predictions': pred,
+    }
@@ -9,6 +9,15 @@ except ImportError:
     print('You may also need to restart your iPython kernel')
 
 from cs231n.im2col import *
+from cs231n.precision import accum_dtype
+
+
+def _cython_array(a):
+    """
+    The Cython kernels are compiled for float32 and float64 only, so half
+    precision arrays are passed to them as float32.
+    """
+    return a.astype(accum_dtype(a.dtype), copy=False)
 
 
 def conv_forward_im2col(x, w, b, conv_param):
@@ -30,7 +39,8 @@ def conv_forward_im2col(x, w, b, conv_param):
     out = np.zeros((N, num_filters, out_height, out_width), dtype=x.dtype)
 
     # x_cols = im2col_indices(x, w.shape[2], w.shape[3], pad, stride)
-    x_cols = im2col_cython(x, w.shape[2], w.shape[3], pad, stride)
+    x_cols = im2col_cython(_cython_array(x), w.shape[2], w.shape[3], pad, stride)
+    x_cols = x_cols.astype(x.dtype, copy=False)
     res = w.reshape((w.shape[0], -1)).dot(x_cols) + b.reshape(-1, 1)
 
     out = res.reshape(w.shape[0], out.shape[2], out.shape[3], x.shape[0])
@@ -98,7 +108,8 @@ def conv_backward_strides(dout, cache):
 
     dx_cols = w.reshape(F, -1).T.dot(dout_reshaped)
     dx_cols.shape = (C, HH, WW, N, out_h, out_w)
-    dx = col2im_6d_cython(dx_cols, N, C, H, W, HH, WW, pad, stride)
+    dx = col2im_6d_cython(_cython_array(dx_cols), N, C, H, W, HH, WW, pad, stride)
+    dx = dx.astype(dout.dtype, copy=False)
 
     return dx, dw, db
 
@@ -119,8 +130,9 @@ def conv_backward_im2col(dout, cache):
 
     dx_cols = w.reshape(num_filters, -1).T.dot(dout_reshaped)
     # dx = col2im_indices(dx_cols, x.shape, filter_height, filter_width, pad, stride)
-    dx = col2im_cython(dx_cols, x.shape[0], x.shape[1], x.shape[2], x.shape[3],
-                       filter_height, filter_width, pad, stride)
+    dx = col2im_cython(_cython_array(dx_cols), x.shape[0], x.shape[1], x.shape[2],
+                       x.shape[3], filter_height, filter_width, pad, stride)
+    dx = dx.astype(dout.dtype, copy=False)
 
     return dx, dw, db
 
@@ -239,7 +251,7 @@ def max_pool_forward_im2col(x, pool_param):
     out_width = (W - pool_width) // stride + 1
 
     x_split = x.reshape(N * C, 1, H, W)
-    x_cols = im2col(x_split, pool_height, pool_width, padding=0, stride=stride)
+    x_cols = im2col_indices(x_split, pool_height, pool_width, padding=0, stride=stride)
     x_cols_argmax = np.argmax(x_cols, axis=0)
     x_cols_max = x_cols[x_cols_argmax, np.arange(x_cols.shape[1])]
     out = x_cols_max.reshape(out_height, out_width, N, C).transpose(2, 3, 0, 1)
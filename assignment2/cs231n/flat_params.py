@@ -0,0 +1,88 @@
+import numpy as np
+
+
+class FlatParams(object):
+    """
+    Keeps a set of named parameter arrays as views into one contiguous vector,
+    together with a matching vector for their gradients.
+
+    Any operation on all parameters at once (an optimizer step, a norm, a copy
+    for checkpointing) then becomes a single vectorized call on self.data or
+    self.grad instead of a loop over a dictionary of small arrays.
+
+    Example usage:
+
+    flat = FlatParams(model.params)
+    model.params = flat.params       # model now reads and writes the views
+    loss, grads = model.loss(X, y)
+    flat.pack_grads(grads)           # gradients are now in flat.grad
+    flat.data -= 1e-3 * flat.grad    # updates every parameter of the model
+    """
+
+    def __init__(self, params, dtype=None, data=None):
+        """
+        Copy a dictionary of parameters into a new flat buffer.
+
+        Inputs:
+        - params: Dictionary mapping parameter names to numpy arrays.
+        - dtype: Datatype of the flat buffers. Defaults to the common datatype
+          of the given parameters.
+        - data: If not None, a 1-dimensional array of this dtype and of the
+          total size of the parameters, used as self.data instead of a newly
+          allocated buffer; for example an array in shared memory.
+        """
+        self.keys = list(params)
+        if dtype is None:
+            dtype = np.result_type(*[params[k] for k in self.keys])
+        self.dtype = np.dtype(dtype)
+
+        self.shapes = {}
+        self.slices = {}
+        offset = 0
+        for k in self.keys:
+            size = params[k].size
+            self.shapes[k] = params[k].shape
+            self.slices[k] = slice(offset, offset + size)
+            offset += size
+
+        if data is None:
+            data = np.empty(offset, dtype=self.dtype)
+        elif data.shape != (offset,) or data.dtype != self.dtype:
+            raise ValueError('Buffer of shape %s and dtype %s does not fit the parameters'
+                             % (data.shape, data.dtype))
+        self.data = data
+        self.grad = np.zeros(offset, dtype=self.dtype)
+        self.params = self.views(self.data)
+        self.grads = self.views(self.grad)
+        self.load(params)
+
+
+    def views(self, flat):
+        """
+        Return a dictionary of views into a flat array laid out like self.data.
+        """
+        return {k: flat[self.slices[k]].reshape(self.shapes[k]) for k in self.keys}
+
+
+    def load(self, params):
+        """
+        Copy the values of a dictionary of parameters into the flat buffer.
+        """
+        for k in self.keys:
+            self.params[k][...] = params[k]
+
+
+    def pack_grads(self, grads):
+        """
+        Copy a dictionary of gradients into self.grad, and replace the entries
+        of grads with the matching views into self.grad. Gradients that are
+        already views into self.grad are left alone, and keys that are not
+        parameters are ignored.
+
+        Returns the flat gradient vector self.grad.
+        """
+        for k in self.keys:
+            if grads[k] is not self.grads[k]:
+                self.grads[k][...] = grads[k]
+                grads[k] = self.grads[k]
+        return self.grad
@@ -1,8 +1,10 @@
 from builtins import range
 import numpy as np
 
+from cs231n.precision import accum_dtype, scale_loss_grad
 
-def affine_forward(x, w, b):
+
+def affine_forward(x, w, b, out=None):
     """
     Computes the forward pass for an affine (fully-connected) layer.
 
@@ -15,6 +17,9 @@ def affine_forward(x, w, b):
     - x: A numpy array containing input data, of shape (N, d_1, ..., d_k)
     - w: A numpy array of weights, of shape (D, M)
     - b: A numpy array of biases, of shape (M,)
+    - out: Optional C-contiguous array of shape (N, M) and the datatype of the
+      result to write the output into, for example a buffer reused across
+      calls.
 
     Returns a tuple of:
     - out: output, of shape (N, M)
@@ -25,7 +30,7 @@ def affine_forward(x, w, b):
     # TODO: Implement the affine forward pass. Store the result in out. You   #
     # will need to reshape the input into rows.                               #
     ###########################################################################
-    out = np.dot(x.reshape(x.shape[0],-1),w)
+    out = np.dot(x.reshape(x.shape[0],-1),w,out=out)
     out += b
     ###########################################################################
     #                             END OF YOUR CODE                            #
@@ -34,7 +39,7 @@ def affine_forward(x, w, b):
     return out, cache
 
 
-def affine_backward(dout, cache):
+def affine_backward(dout, cache, dx_out=None):
     """
     Computes the backward pass for an affine layer.
 
@@ -43,6 +48,8 @@ def affine_backward(dout, cache):
     - cache: Tuple of:
       - x: Input data, of shape (N, d_1, ... d_k)
       - w: Weights, of shape (D, M)
+    - dx_out: Optional C-contiguous array of shape (N, D) and the datatype of
+      the result to write dx into.
 
     Returns a tuple of:
     - dx: Gradient with respect to x, of shape (N, d1, ..., d_k)
@@ -54,7 +61,7 @@ def affine_backward(dout, cache):
     ###########################################################################
     # TODO: Implement the affine backward pass.                               #
     ###########################################################################
-    dx = np.dot(dout,w.T)
+    dx = np.dot(dout,w.T,out=dx_out)
     dx = np.reshape(dx,x.shape)
     dw = np.dot(x.reshape(x.shape[0],-1).T,dout)
     db = np.sum(dout,axis=0)
@@ -64,12 +71,13 @@ def affine_backward(dout, cache):
     return dx, dw, db
 
 
-def relu_forward(x):
+def relu_forward(x, out=None):
     """
     Computes the forward pass for a layer of rectified linear units (ReLUs).
 
     Input:
     - x: Inputs, of any shape
+    - out: Optional array of the shape of x to write the output into
 
     Returns a tuple of:
     - out: Output, of the same shape as x
@@ -79,7 +87,7 @@ def relu_forward(x):
     ###########################################################################
     # TODO: Implement the ReLU forward pass.                                  #
     ###########################################################################
-    out = np.maximum(0,x)
+    out = np.maximum(0,x,out=out)
     ###########################################################################
     #                             END OF YOUR CODE                            #
     ###########################################################################
@@ -342,7 +350,7 @@ def batchnorm_backward(dout, cache):
     dv = 0.5 * dvsqrt / np.sqrt(v + eps)
   
     # Step 4. v = 1 / N \sum xcsq_i
-    dxcsq = 1.0 / N * np.ones((N, D)) * dv
+    dxcsq = 1.0 / N * np.ones((N, D), dtype=dout.dtype) * dv
   
     # Step 3. xcsq = xc ^ 2
     dxc2 = 2.0 * dxcsq * xc
@@ -352,7 +360,7 @@ def batchnorm_backward(dout, cache):
     dm = - np.sum(dxc1 + dxc2, axis=0, keepdims=True)
   
     # Step 1. m = 1 / N \sum x_i
-    dx2 = 1.0 / N * np.ones((N, D)) * dm
+    dx2 = 1.0 / N * np.ones((N, D), dtype=dout.dtype) * dm
   
     dx = dx1 + dx2
   
@@ -376,15 +384,21 @@ def dropout_forward(x, dropout_param):
       - seed: Seed for the random number generator. Passing seed makes this
         function deterministic, which is needed for gradient checking but not
         in real networks.
+      - mask: How the mask is kept for the backward pass. 'regen' (default)
+        keeps only the state of the generator and regenerates the mask in the
+        backward pass; 'packed' stores the mask packed into one bit per element.
+      - rng: The np.random.Generator used by this layer. It is created on the
+        first call if missing, seeded from the global numpy RNG, so that
+        np.random.seed still makes training reproducible; give each layer its
+        own dropout_param so that layers never share a generator.
 
     Outputs:
     - out: Array of the same shape as x.
-    - cache: tuple (dropout_param, mask). In training mode, mask is the dropout
-      mask that was used to multiply the input; in test mode, mask is None.
+    - cache: tuple (dropout_param, mask). In training mode, mask is either the
+      generator state the mask was drawn from or the bit-packed mask; in test
+      mode, mask is None.
     """
     p, mode = dropout_param['p'], dropout_param['mode']
-    if 'seed' in dropout_param:
-        np.random.seed(dropout_param['seed'])
 
     mask = None
     out = None
@@ -394,8 +408,16 @@ def dropout_forward(x, dropout_param):
         # TODO: Implement training phase forward pass for inverted dropout.   #
         # Store the dropout mask in the mask variable.                        #
         #######################################################################
-        mask = (np.random.rand(*x.shape) > p) / (1-p)
-        out  = x * mask 
+        rng = _dropout_rng(dropout_param)
+        state = rng.bit_generator.state
+        keep = rng.random(x.shape, dtype=np.float32) >= p
+        out  = x * keep
+        out *= 1.0 / (1-p)
+
+        if dropout_param.get('mask', 'regen') == 'packed':
+            mask = np.packbits(keep, axis=None)
+        else:
+            mask = state
         #######################################################################
         #                           END OF YOUR CODE                          #
         #######################################################################
@@ -430,7 +452,15 @@ def dropout_backward(dout, cache):
         #######################################################################
         # TODO: Implement training phase backward pass for inverted dropout   #
         #######################################################################
-        dx = dout * mask
+        p = dropout_param['p']
+        if isinstance(mask, dict):
+            rng = np.random.Generator(np.random.Philox())
+            rng.bit_generator.state = mask
+            keep = rng.random(dout.shape, dtype=np.float32) >= p
+        else:
+            keep = np.unpackbits(mask, count=dout.size).reshape(dout.shape)
+        dx  = dout * keep
+        dx *= 1.0 / (1-p)
         #######################################################################
         #                          END OF YOUR CODE                           #
         #######################################################################
@@ -439,6 +469,23 @@ def dropout_backward(dout, cache):
     return dx
 
 
+def _dropout_rng(dropout_param):
+    """
+    Returns the random generator for a dropout layer. With a seed every call
+    gets a fresh generator, so every call draws the same mask; otherwise the
+    layer keeps its own generator in dropout_param['rng']. That generator is
+    seeded from the global numpy RNG when it is created, and masks never draw
+    from the global RNG after that.
+    """
+    if 'seed' in dropout_param:
+        return np.random.Generator(np.random.Philox(dropout_param['seed']))
+    rng = dropout_param.get('rng')
+    if rng is None:
+        rng = np.random.Generator(np.random.Philox(np.random.randint(2 ** 63)))
+        dropout_param['rng'] = rng
+    return rng
+
+
 def conv_forward_naive(x, w, b, conv_param):
     """
     A naive implementation of the forward pass for a convolutional layer.
@@ -471,7 +518,7 @@ def conv_forward_naive(x, w, b, conv_param):
     H_prima     = int(1 + (H + 2 * pad - HH) / stride)
     W_prima     = int(1 + (W + 2 * pad - WW) / stride)
 
-    out = np.zeros((N,F,H_prima,W_prima))
+    out = np.zeros((N,F,H_prima,W_prima), dtype=x.dtype)
     ###########################################################################
     # TODO: Implement the convolutional forward pass.                         #
     # Hint: you can use the function np.pad for padding.                      #
@@ -590,7 +637,7 @@ def max_pool_forward_naive(x, pool_param):
     H_out = int(1 + (H - pool_height) / stride)
     W_out = int(1 + (W - pool_width) / stride)
 
-    out = np.zeros((N,C,H_out,W_out))
+    out = np.zeros((N,C,H_out,W_out), dtype=x.dtype)
     ###########################################################################
     # TODO: Implement the max pooling forward pass                            #
     ###########################################################################
@@ -747,6 +794,44 @@ def spatial_batchnorm_backward(dout, cache):
     return dx, dgamma, dbeta
 
 
+def batchnorm_fold(w, b, gamma, beta, bn_param):
+    """
+    Folds a test-time batch normalization into the affine or convolutional
+    layer that feeds it.
+
+    At test time batchnorm is the fixed per-feature affine map
+    gamma * (a - running_mean) / sqrt(running_var + eps) + beta, so it can be
+    absorbed into the weights and biases of the previous layer and skipped.
+
+    Inputs:
+    - w: Weights of the previous layer; either affine weights of shape (D, M)
+      or convolutional filters of shape (M, C, HH, WW)
+    - b: Biases of the previous layer, of shape (M,)
+    - gamma: Scale parameter of shape (M,)
+    - beta: Shift paremeter of shape (M,)
+    - bn_param: Dictionary of batchnorm parameters as in batchnorm_forward. It
+      must hold the running_mean and running_var computed during training.
+
+    Returns a tuple of:
+    - w_fold: Folded weights, of the same shape as w
+    - b_fold: Folded biases, of shape (M,)
+    """
+    if 'running_mean' not in bn_param or 'running_var' not in bn_param:
+        raise ValueError('Cannot fold batchnorm without running statistics')
+    eps = bn_param.get('eps', 1e-5)
+    running_mean = np.ravel(bn_param['running_mean'])
+    running_var = np.ravel(bn_param['running_var'])
+
+    scale = gamma / np.sqrt(running_var + eps)
+    if w.ndim == 4:
+        w_fold = w * scale.reshape(-1, 1, 1, 1)
+    else:
+        w_fold = w * scale
+    b_fold = (b - running_mean) * scale + beta
+
+    return w_fold.astype(w.dtype, copy=False), b_fold.astype(b.dtype, copy=False)
+
+
 def svm_loss(x, y):
     """
     Computes the loss and gradient using for multiclass SVM classification.
@@ -771,6 +856,7 @@ def svm_loss(x, y):
     dx[margins > 0] = 1
     dx[np.arange(N), y] -= num_pos
     dx /= N
+    scale_loss_grad(dx)
     return loss, dx
 
 
@@ -788,7 +874,8 @@ def softmax_loss(x, y):
     - loss: Scalar giving the loss
     - dx: Gradient of the loss with respect to x
     """
-    shifted_logits = x - np.max(x, axis=1, keepdims=True)
+    xa = x.astype(accum_dtype(x.dtype), copy=False)
+    shifted_logits = xa - np.max(xa, axis=1, keepdims=True)
     Z = np.sum(np.exp(shifted_logits), axis=1, keepdims=True)
     log_probs = shifted_logits - np.log(Z)
     probs = np.exp(log_probs)
@@ -797,4 +884,5 @@ def softmax_loss(x, y):
     dx = probs.copy()
     dx[np.arange(N), y] -= 1
     dx /= N
-    return loss, dx
+    scale_loss_grad(dx)
+    return loss, dx.astype(x.dtype, copy=False)
@@ -0,0 +1,177 @@
+from __future__ import division
+from builtins import object
+import math
+
+"""
+This file implements learning rate schedules for the Solver. A schedule gives
+the learning rate for every iteration of training, so the rate can change
+within an epoch rather than only between epochs as with lr_decay.
+
+Every schedule has the following interface:
+
+- start(base_lr, num_iterations): Called by the Solver before training with
+  the learning rate of the optim_config and the total number of iterations.
+- __call__(t): Returns the learning rate for iteration t, counted from 0, so
+  the schedule is called as schedule(t).
+- observe(metric): Called by the Solver with the validation accuracy after
+  every accuracy check; only ReduceOnPlateau uses it.
+
+The Solver evaluates the schedule once per iteration and hands the single value
+to the update rule of every parameter.
+
+Example usage:
+
+solver = Solver(model, data,
+                update_rule='sgd_momentum',
+                optim_config={'learning_rate': 1e-1},
+                lr_schedule=LinearWarmup(CosineDecay(), warmup_steps=500))
+"""
+
+
+class LRSchedule(object):
+    """
+    Base class of the learning rate schedules; a constant learning rate.
+    """
+
+    def start(self, base_lr, num_iterations):
+        self.base_lr = base_lr
+        self.num_iterations = num_iterations
+
+
+    def __call__(self, t):
+        return self.base_lr
+
+
+    def observe(self, metric):
+        pass
+
+
+class StepDecay(LRSchedule):
+    """
+    Multiply the learning rate by gamma every step_size iterations.
+    """
+
+    def __init__(self, step_size, gamma=0.1):
+        self.step_size = step_size
+        self.gamma = gamma
+
+
+    def __call__(self, t):
+        return self.base_lr * self.gamma ** (t // self.step_size)
+
+
+class CosineDecay(LRSchedule):
+    """
+    Anneal the learning rate from its base value to min_lr along half a cosine
+    over total_steps iterations; total_steps defaults to the whole training
+    run.
+    """
+
+    def __init__(self, min_lr=0.0, total_steps=None):
+        self.min_lr = min_lr
+        self.total_steps = total_steps
+
+
+    def __call__(self, t):
+        total = self.total_steps or self.num_iterations
+        progress = min(t / max(total, 1), 1.0)
+        return self.min_lr + 0.5 * (self.base_lr - self.min_lr) * (1 + math.cos(math.pi * progress))
+
+
+class OneCycle(LRSchedule):
+    """
+    The one-cycle policy: the learning rate rises from max_lr / div_factor to
+    max_lr over the first pct_start of training, then falls along a cosine to
+    max_lr / (div_factor * final_div_factor). max_lr defaults to the base
+    learning rate.
+    """
+
+    def __init__(self, max_lr=None, pct_start=0.3, div_factor=25.0,
+                 final_div_factor=1e4, total_steps=None):
+        self.max_lr = max_lr
+        self.pct_start = pct_start
+        self.div_factor = div_factor
+        self.final_div_factor = final_div_factor
+        self.total_steps = total_steps
+
+
+    def __call__(self, t):
+        max_lr = self.max_lr if self.max_lr is not None else self.base_lr
+        total = self.total_steps or self.num_iterations
+        initial_lr = max_lr / self.div_factor
+        final_lr = initial_lr / self.final_div_factor
+
+        warmup = max(int(self.pct_start * total), 1)
+        if t < warmup:
+            start, end, progress = initial_lr, max_lr, t / warmup
+        else:
+            start, end = max_lr, final_lr
+            progress = min((t - warmup) / max(total - warmup, 1), 1.0)
+        return end + 0.5 * (start - end) * (1 + math.cos(math.pi * progress))
+
+
+class LinearWarmup(LRSchedule):
+    """
+    Increase the learning rate linearly from start_factor times its value to
+    its value over the first warmup_steps iterations, then follow another
+    schedule, which defaults to a constant learning rate. The wrapped schedule
+    sees iterations counted from the end of the warmup.
+    """
+
+    def __init__(self, schedule=None, warmup_steps=100, start_factor=0.0):
+        self.schedule = schedule if schedule is not None else LRSchedule()
+        self.warmup_steps = warmup_steps
+        self.start_factor = start_factor
+
+
+    def start(self, base_lr, num_iterations):
+        super(LinearWarmup, self).start(base_lr, num_iterations)
+        self.schedule.start(base_lr, max(num_iterations - self.warmup_steps, 1))
+
+
+    def __call__(self, t):
+        if t < self.warmup_steps:
+            factor = self.start_factor + (1 - self.start_factor) * t / self.warmup_steps
+            return factor * self.schedule(0)
+        return self.schedule(t - self.warmup_steps)
+
+
+    def observe(self, metric):
+        self.schedule.observe(metric)
+
+
+class ReduceOnPlateau(LRSchedule):
+    """
+    Multiply the learning rate by factor whenever the observed validation
+    accuracy has not improved by more than threshold for patience accuracy
+    checks in a row, without going below min_lr.
+    """
+
+    def __init__(self, factor=0.1, patience=2, threshold=1e-4, min_lr=0.0):
+        self.factor = factor
+        self.patience = patience
+        self.threshold = threshold
+        self.min_lr = min_lr
+
+
+    def start(self, base_lr, num_iterations):
+        super(ReduceOnPlateau, self).start(base_lr, num_iterations)
+        if not hasattr(self, 'lr'):
+            self.lr = base_lr
+            self.best = None
+            self.num_bad = 0
+
+
+    def __call__(self, t):
+        return self.lr
+
+
+    def observe(self, metric):
+        if self.best is None or metric > self.best + self.threshold:
+            self.best = metric
+            self.num_bad = 0
+            return
+        self.num_bad += 1
+        if self.num_bad > self.patience:
+            self.lr = max(self.lr * self.factor, self.min_lr)
+            self.num_bad = 0
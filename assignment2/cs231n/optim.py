@@ -26,21 +26,39 @@ perform well; however the default values of the other hyperparameters should
 work well for a variety of different problems.
 
 For efficiency, update rules may perform in-place updates, mutating w and
-setting next_w equal to w.
+setting next_w equal to w. All of the rules below do so: they update w and their
+cached values through out= buffers, reusing a scratch array kept in config, so
+that a step allocates no new arrays. Since the rules work on arrays of any
+shape, a single call can also update every parameter of a model at once if the
+parameters are views into one flat array (see Solver's flat_params option).
 """
 
 
+def _state(config, key, like, zeros=True):
+    """
+    Return the array config[key], allocating it with the shape and dtype of
+    like only if the config does not hold it yet; zeros=False leaves it
+    uninitialized, for scratch arrays.
+    """
+    if key not in config:
+        config[key] = np.zeros_like(like) if zeros else np.empty_like(like)
+    return config[key]
+
+
 def sgd(w, dw, config=None):
     """
     Performs vanilla stochastic gradient descent.
 
     config format:
     - learning_rate: Scalar learning rate.
+    - scratch: Work array of the same shape as w, reused across steps.
     """
     if config is None: config = {}
     config.setdefault('learning_rate', 1e-2)
+    tmp = _state(config, 'scratch', w, zeros=False)
 
-    w -= config['learning_rate'] * dw
+    np.multiply(dw, config['learning_rate'], out=tmp)
+    w -= tmp
     return w, config
 
 
@@ -54,19 +72,24 @@ def sgd_momentum(w, dw, config=None):
       Setting momentum = 0 reduces to sgd.
     - velocity: A numpy array of the same shape as w and dw used to store a
       moving average of the gradients.
+    - scratch: Work array of the same shape as w, reused across steps.
     """
     if config is None: config = {}
     config.setdefault('learning_rate', 1e-2)
     config.setdefault('momentum', 0.9)
-    v = config.get('velocity', np.zeros_like(w))
+    v = _state(config, 'velocity', w)
+    tmp = _state(config, 'scratch', w, zeros=False)
 
     next_w = None
     ###########################################################################
     # TODO: Implement the momentum update formula. Store the updated value in #
     # the next_w variable. You should also use and update the velocity v.     #
     ###########################################################################
-    v = config['momentum']*v - config['learning_rate']*dw
-    next_w = w + v
+    v *= config['momentum']
+    np.multiply(dw, config['learning_rate'], out=tmp)
+    v -= tmp
+    w += v
+    next_w = w
     ###########################################################################
     #                             END OF YOUR CODE                            #
     ###########################################################################
@@ -86,12 +109,14 @@ def rmsprop(x, dx, config=None):
       gradient cache.
     - epsilon: Small scalar used for smoothing to avoid dividing by zero.
     - cache: Moving average of second moments of gradients.
+    - scratch: Work array of the same shape as x, reused across steps.
     """
     if config is None: config = {}
     config.setdefault('learning_rate', 1e-2)
     config.setdefault('decay_rate', 0.99)
     config.setdefault('epsilon', 1e-8)
-    config.setdefault('cache', np.zeros_like(x))
+    _state(config, 'cache', x)
+    _state(config, 'scratch', x, zeros=False)
 
     next_x = None
     ###########################################################################
@@ -100,15 +125,24 @@ def rmsprop(x, dx, config=None):
     # config['cache'].                                                        #
     ###########################################################################
     cache = config['cache']
+    tmp = config['scratch']
     decay_rate = config['decay_rate']
     learning_rate = config['learning_rate']
     epsilon = config['epsilon']
 
-    # RMSPROP
-    cache = decay_rate * cache + (1-decay_rate) * dx * dx
-    next_x = x - learning_rate * dx / (np.sqrt(cache) + epsilon)
-
-    config['cache'] = cache
+    # RMSPROP: cache = decay_rate * cache + (1-decay_rate) * dx * dx
+    cache *= decay_rate
+    np.multiply(dx, dx, out=tmp)
+    tmp *= 1 - decay_rate
+    cache += tmp
+
+    # next_x = x - learning_rate * dx / (np.sqrt(cache) + epsilon)
+    np.sqrt(cache, out=tmp)
+    tmp += epsilon
+    np.divide(dx, tmp, out=tmp)
+    tmp *= learning_rate
+    x -= tmp
+    next_x = x
     ###########################################################################
     #                             END OF YOUR CODE                            #
     ###########################################################################
@@ -129,15 +163,17 @@ def adam(x, dx, config=None):
     - m: Moving average of gradient.
     - v: Moving average of squared gradient.
     - t: Iteration number.
+    - scratch: Work array of the same shape as x, reused across steps.
     """
     if config is None: config = {}
     config.setdefault('learning_rate', 1e-3)
     config.setdefault('beta1', 0.9)
     config.setdefault('beta2', 0.999)
     config.setdefault('epsilon', 1e-8)
-    config.setdefault('m', np.zeros_like(x))
-    config.setdefault('v', np.zeros_like(x))
+    _state(config, 'm', x)
+    _state(config, 'v', x)
     config.setdefault('t', 1)
+    _state(config, 'scratch', x, zeros=False)
 
     next_x = None
     ###########################################################################
@@ -148,6 +184,7 @@ def adam(x, dx, config=None):
     t = config['t']
     m = config['m']
     v = config['v']
+    tmp = config['scratch']
     learning_rate = config['learning_rate']
     beta1 = config['beta1']
     beta2 = config['beta2']
@@ -156,18 +193,29 @@ def adam(x, dx, config=None):
     # ADAM
     t += 1
 
-    m = beta1 * m + (1 - beta1) * dx
-    v = beta2 * v + (1 - beta2) * dx * dx
-
-    first_unbias  = m / (1 - beta1 ** t)
-    second_unbias = v / (1 - beta2 ** t)
-
-    next_x = x - learning_rate * first_unbias / (np.sqrt(second_unbias) + epsilon)
+    # m = beta1 * m + (1 - beta1) * dx
+    m *= beta1
+    np.multiply(dx, 1 - beta1, out=tmp)
+    m += tmp
+
+    # v = beta2 * v + (1 - beta2) * dx * dx
+    v *= beta2
+    np.multiply(dx, dx, out=tmp)
+    tmp *= 1 - beta2
+    v += tmp
+
+    # next_x = x - learning_rate * first_unbias / (np.sqrt(second_unbias) + epsilon)
+    # with first_unbias = m / (1 - beta1 ** t), second_unbias = v / (1 - beta2 ** t)
+    np.sqrt(v, out=tmp)
+    tmp *= 1.0 / np.sqrt(1 - beta2 ** t)
+    tmp += epsilon
+    np.divide(m, tmp, out=tmp)
+    tmp *= learning_rate / (1 - beta1 ** t)
+    x -= tmp
+    next_x = x
 
     # Update
     config['t'] = t
-    config['m'] = m
-    config['v'] = v
     ###########################################################################
     #                             END OF YOUR CODE                            #
     ###########################################################################
@@ -183,11 +231,13 @@ def adagrad(x, dx, config=None):
     - learning_rate: Scalar learning rate.
     - epsilon: Small scalar used for smoothing to avoid dividing by zero.
     - v: Moving average of squared gradient.
+    - scratch: Work array of the same shape as x, reused across steps.
     """
     if config is None: config = {}
     config.setdefault('learning_rate', 1e-3)
     config.setdefault('epsilon', 1e-8)
-    config.setdefault('v', np.zeros_like(x))
+    _state(config, 'v', x)
+    _state(config, 'scratch', x, zeros=False)
 
     next_x = None
     ###########################################################################
@@ -196,19 +246,71 @@ def adagrad(x, dx, config=None):
     # config.                                                                 #
     ###########################################################################
     v = config['v']
+    tmp = config['scratch']
     learning_rate = config['learning_rate']
     epsilon = config['epsilon']
 
-    # ADAGRAD
-    v += dx * dx
-
-    next_x = x - learning_rate  * dx / (np.sqrt(v) + epsilon)
-
-    # Update
-    config['v'] = v
+    # ADAGRAD: v += dx * dx
+    np.multiply(dx, dx, out=tmp)
+    v += tmp
+
+    # next_x = x - learning_rate  * dx / (np.sqrt(v) + epsilon)
+    np.sqrt(v, out=tmp)
+    tmp += epsilon
+    np.divide(dx, tmp, out=tmp)
+    tmp *= learning_rate
+    x -= tmp
+    next_x = x
     ###########################################################################
     #                             END OF YOUR CODE                            #
     ###########################################################################
 
     return next_x, config
-##########################################################################################
\ No newline at end of file
+##########################################################################################
+
+
+def clip_gradients(grads, keys, max_norm=None, max_param_norm=None):
+    """
+    Measures the L2 norms of a dictionary of gradients, and optionally clips the
+    gradients in place.
+
+    Inputs:
+    - grads: Dictionary mapping parameter names to gradient arrays.
+    - keys: Names of the gradients to consider; other entries are ignored.
+    - max_norm: If not None, rescale all gradients together whenever their
+      global L2 norm exceeds this value.
+    - max_param_norm: If not None, rescale each gradient whose own L2 norm
+      exceeds this value. This is applied before global norm clipping.
+
+    Returns a tuple of:
+    - norms: Dictionary mapping names to the L2 norm of each gradient, measured
+      before clipping.
+    - global_norm: L2 norm of all gradients together, measured before clipping.
+    - clipped: Boolean; whether any gradient was rescaled.
+    """
+    norms = {}
+    for k in keys:
+        g = grads[k].ravel()
+        norms[k] = float(np.sqrt(np.dot(g, g)))
+    global_norm = float(np.sqrt(sum(n * n for n in norms.values())))
+
+    clipped = False
+    clipped_norm = global_norm
+    if max_param_norm is not None:
+        total = 0.0
+        for k in keys:
+            n = norms[k]
+            if n > max_param_norm:
+                grads[k] *= max_param_norm / n
+                n = max_param_norm
+                clipped = True
+            total += n * n
+        clipped_norm = np.sqrt(total)
+
+    if max_norm is not None and clipped_norm > max_norm:
+        scale = max_norm / clipped_norm
+        for k in keys:
+            grads[k] *= scale
+        clipped = True
+
+    return norms, global_norm, clipped
@@ -0,0 +1,219 @@
+from __future__ import print_function, division
+from builtins import range
+from builtins import object
+import mmap
+import multiprocessing
+import traceback
+
+import numpy as np
+
+from cs231n.flat_params import FlatParams
+from cs231n.precision import set_loss_scale
+
+"""
+This file implements data-parallel training on a single machine. The forward
+and backward passes for each minibatch are split across worker processes, each
+holding a replica of the model, while the Solver applies the update rule once
+on the combined gradient.
+
+The parameters of the model live in one flat buffer in shared memory, so the
+workers always see the latest parameters without any copy. Each worker writes
+the gradient of its part of the minibatch into its own row of a shared gradient
+buffer, and the rows are then reduced into one gradient, weighted by the
+number of samples each worker processed.
+
+The combined gradient is the gradient of the mean loss over the minibatch, as
+in the single-process Solver, up to floating point rounding. Layers that
+compute statistics over the minibatch are the exception: batch normalization
+normalizes each part of the minibatch with its own statistics, and only the
+running averages of the first worker are copied back to the model.
+
+Workers are started with fork, so this only works on platforms that support
+it; they inherit the model and training data from the parent process.
+"""
+
+
+def _shared_array(shape, dtype):
+    """
+    Allocate a zero-filled array in anonymous shared memory; processes forked
+    after the allocation read and write the same memory.
+    """
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape)) * dtype.itemsize
+    buf = mmap.mmap(-1, max(size, 1))
+    return np.frombuffer(buf, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+
+def _worker_loop(rank, model, flat, grad, losses, X, y, dtype, conn):
+    """
+    Main loop of a worker process; computes the loss and gradients for the
+    minibatch indices it receives until it is told to stop.
+    """
+    flat.grad = grad[rank]
+    flat.grads = flat.views(flat.grad)
+
+    # Forked workers inherit the dropout generators and the global RNG of the
+    # parent; give every worker its own stream of the parent's generators so
+    # that workers draw different masks
+    for dropout_param in getattr(model, 'dropout_params', []):
+        if 'seed' not in dropout_param:
+            rng = dropout_param.get('rng')
+            if rng is None:
+                bit_generator = np.random.Philox(np.random.randint(2 ** 63))
+            else:
+                bit_generator = rng.bit_generator
+            dropout_param['rng'] = np.random.Generator(bit_generator.jumped(rank + 1))
+
+    while True:
+        msg = conn.recv()
+        if msg[0] == 'close':
+            break
+        try:
+            if msg[0] == 'step':
+                idx, loss_scale = msg[1], msg[2]
+                X_batch = X[idx]
+                if dtype is not None:
+                    X_batch = X_batch.astype(dtype)
+                set_loss_scale(loss_scale)
+                loss, grads = model.loss(X_batch, y[idx])
+                flat.pack_grads(grads)
+                losses[rank] = loss
+                conn.send(('ok', None))
+            elif msg[0] == 'state':
+                conn.send(('ok', getattr(model, 'bn_params', None)))
+        except Exception:
+            conn.send(('error', traceback.format_exc()))
+    conn.close()
+
+
+class DataParallel(object):
+    """
+    Splits the loss and gradient computation of a model across worker
+    processes.
+
+    Example usage:
+
+    parallel = DataParallel(model, X_train, y_train, num_workers=8)
+    parallel.start()
+    loss, grads = parallel.loss(batch_mask)
+    ... update parallel.flat.data using parallel.flat.grad ...
+    parallel.close()
+
+    After construction model.params are views into the shared buffer
+    parallel.flat.data, so updates to the parameters in the parent process are
+    seen by the workers.
+    """
+
+    def __init__(self, model, X, y, num_workers, dtype=None):
+        """
+        Inputs:
+        - model: A model object with the API expected by the Solver.
+        - X: Array of training data; workers index into it directly.
+        - y: Array of training labels.
+        - num_workers: Number of worker processes.
+        - dtype: If not None, minibatches are cast to this datatype.
+        """
+        self.model = model
+        self.X = X
+        self.y = y
+        self.num_workers = num_workers
+        self.dtype = dtype
+
+        # Move the parameters into shared memory
+        model_flat = getattr(model, 'flat', None)
+        dtype = model_flat.dtype if model_flat is not None else None
+        if dtype is None:
+            dtype = np.result_type(*model.params.values())
+        size = sum(w.size for w in model.params.values())
+        self.flat = FlatParams(model.params, dtype, data=_shared_array((size,), dtype))
+        self.model.params = self.flat.params
+        if model_flat is not None:
+            self.model.flat = self.flat
+
+        self.grad = _shared_array((num_workers, size), dtype)
+        self.losses = _shared_array((num_workers,), np.float64)
+        self.processes = []
+        self.conns = []
+
+
+    def start(self):
+        """
+        Fork the worker processes.
+        """
+        if self.processes:
+            return
+        ctx = multiprocessing.get_context('fork')
+        for rank in range(self.num_workers):
+            parent_conn, child_conn = ctx.Pipe()
+            p = ctx.Process(target=_worker_loop,
+                            args=(rank, self.model, self.flat, self.grad,
+                                  self.losses, self.X, self.y, self.dtype,
+                                  child_conn))
+            p.daemon = True
+            p.start()
+            child_conn.close()
+            self.processes.append(p)
+            self.conns.append(parent_conn)
+
+
+    def close(self):
+        """
+        Stop the worker processes.
+        """
+        for conn in self.conns:
+            conn.send(('close',))
+            conn.close()
+        for p in self.processes:
+            p.join()
+        self.processes = []
+        self.conns = []
+
+
+    def _recv(self, conn):
+        status, value = conn.recv()
+        if status == 'error':
+            raise RuntimeError('Worker process failed:\n%s' % value)
+        return value
+
+
+    def loss(self, batch_mask, loss_scale=1.0):
+        """
+        Compute the loss and gradients for the minibatch X[batch_mask].
+
+        Inputs:
+        - batch_mask: Array of indices into the training data.
+        - loss_scale: Loss scale that the workers use for backpropagation.
+
+        Returns a tuple of:
+        - loss: Scalar loss over the whole minibatch
+        - grads: Dictionary of gradients; the values are views into
+          self.flat.grad.
+        """
+        parts = np.array_split(batch_mask, self.num_workers)
+        active = [rank for rank, part in enumerate(parts) if len(part) > 0]
+        for rank in active:
+            self.conns[rank].send(('step', parts[rank], loss_scale))
+        for rank in active:
+            self._recv(self.conns[rank])
+
+        # Each worker returns the mean over its own samples, so weight the
+        # workers by their share of the minibatch
+        weights = np.array([len(parts[rank]) for rank in active], dtype=np.float64)
+        weights /= len(batch_mask)
+        loss = float(np.dot(weights, self.losses[active]))
+        grad = self.grad if len(active) == self.num_workers else self.grad[active]
+        np.dot(weights.astype(self.flat.dtype), grad, out=self.flat.grad)
+        return loss, self.flat.grads
+
+
+    def sync_state(self):
+        """
+        Copy the batch normalization running averages of the first worker into
+        the model of this process.
+        """
+        if not self.conns or not hasattr(self.model, 'bn_params'):
+            return
+        self.conns[0].send(('state',))
+        bn_params = self._recv(self.conns[0])
+        for dst, src in zip(self.model.bn_params, bn_params):
+            dst.update(src)
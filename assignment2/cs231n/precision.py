@@ -0,0 +1,145 @@
+import numpy as np
+
+"""
+This file implements the pieces needed to train in reduced precision, for
+example with float16 parameters and activations, without losing accuracy.
+
+Layers compute in the datatype of their inputs and never allocate float64
+buffers on their own, so a model built with dtype=np.float16 keeps its
+activations and gradients in float16 and moves half the bytes of float32.
+Three things keep the results accurate:
+
+- Loss scaling: small gradients underflow to zero in float16. The loss
+  functions multiply the gradient they return by the current loss scale, which
+  shifts every gradient of the backward pass into the representable range.
+  Models add their regularization gradients with add_reg_grad, which scales
+  them the same way.
+- Master weights: the Solver keeps a float32 copy of the parameters, unscales
+  the gradients into float32 and applies the update rule there, then copies the
+  result back into the reduced precision parameters of the model.
+- Skipped steps: if an unscaled gradient is not finite the loss scale was too
+  large; the step is skipped and the scale is reduced.
+
+The loss scale is a process-wide setting, which the Solver sets around each
+call to model.loss; it is 1 at all other times, so gradient checks and
+test-time code are unaffected.
+"""
+
+_loss_scale = 1.0
+
+
+def get_loss_scale():
+    """
+    Return the factor that loss gradients are currently multiplied by.
+    """
+    return _loss_scale
+
+
+def set_loss_scale(scale):
+    """
+    Set the factor that loss gradients are multiplied by, and return the
+    previous value.
+    """
+    global _loss_scale
+    prev, _loss_scale = _loss_scale, float(scale)
+    return prev
+
+
+def scale_loss_grad(dx):
+    """
+    Multiply the gradient of a loss by the current loss scale, in place.
+    """
+    if _loss_scale != 1.0:
+        dx *= _loss_scale
+    return dx
+
+
+def add_reg_grad(dw, w, reg):
+    """
+    Add the gradient reg * w of the L2 regularization 0.5 * reg * sum(w * w)
+    to dw in place, multiplied by the current loss scale like the gradient of
+    the loss.
+    """
+    dw += (reg * _loss_scale) * w
+    return dw
+
+
+def accum_dtype(dtype):
+    """
+    Return the datatype used for reductions over data of the given datatype;
+    half precision data is accumulated in float32.
+    """
+    return np.promote_types(dtype, np.float32)
+
+
+class LossScaler(object):
+    """
+    Keeps the loss scale used for reduced precision training.
+
+    With a static scale the value never changes. With a dynamic scale, the
+    scale is halved whenever a step produces non-finite gradients, and doubled
+    after every growth_interval consecutive finite steps, so that it stays close
+    to the largest value that does not overflow.
+
+    Example usage:
+
+    scaler = LossScaler('dynamic')
+    prev = set_loss_scale(scaler.scale)
+    loss, grads = model.loss(X, y)
+    set_loss_scale(prev)
+    finite = scaler.unscale(grad)    # grad is a float32 copy of the gradients
+    if finite:
+        ... update the parameters ...
+    scaler.update(finite)
+    """
+
+    def __init__(self, loss_scale='dynamic', init_scale=2.0 ** 15,
+                 growth_interval=2000, growth_factor=2.0, backoff_factor=0.5):
+        """
+        Inputs:
+        - loss_scale: Either a number, giving a static loss scale, or the
+          string 'dynamic'.
+        - init_scale: Initial loss scale when loss_scale is 'dynamic'.
+        - growth_interval: Number of consecutive finite steps after which a
+          dynamic scale is increased.
+        - growth_factor: Factor by which a dynamic scale is increased.
+        - backoff_factor: Factor by which a dynamic scale is decreased after a
+          non-finite step.
+        """
+        self.dynamic = loss_scale == 'dynamic'
+        if self.dynamic:
+            self.scale = float(init_scale)
+        else:
+            self.scale = float(loss_scale)
+        self.growth_interval = growth_interval
+        self.growth_factor = growth_factor
+        self.backoff_factor = backoff_factor
+        self.good_steps = 0
+        self.skipped_steps = 0
+
+
+    def unscale(self, grad):
+        """
+        Divide a gradient array by the loss scale in place, and return whether
+        all of its values are finite.
+        """
+        if self.scale != 1.0:
+            grad *= 1.0 / self.scale
+        return bool(np.isfinite(grad).all())
+
+
+    def update(self, finite):
+        """
+        Update the loss scale after a step whose gradients were finite or not.
+        """
+        if not finite:
+            self.skipped_steps += 1
+            self.good_steps = 0
+            if self.dynamic:
+                self.scale *= self.backoff_factor
+            return
+
+        self.good_steps += 1
+        if self.dynamic and self.good_steps >= self.growth_interval:
+            self.scale *= self.growth_factor
+            self.good_steps = 0
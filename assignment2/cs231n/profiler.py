@@ -0,0 +1,337 @@
+from __future__ import print_function, division
+from builtins import object
+import functools
+import importlib
+import json
+import re
+import sys
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+"""
+This file implements an opt-in profiler for the layer functions in layers.py,
+fast_layers.py, layer_utils.py and rnn_layers.py.
+
+While a Profiler is active, every forward, backward and loss function of those
+modules is replaced by a wrapper that records one event per call, both in the
+module that defines it and in every cs231n module that imported it (the
+classifiers use "from cs231n.layers import *"). Leaving the profiler puts the
+original functions back, so there is no overhead when it is not in use.
+
+Each event records:
+- the wall time of the call, and the time not spent in nested layer calls
+- an estimate of the floating point operations; the backward pass of a layer
+  is counted as twice its forward pass, and composite layers such as
+  affine_relu_forward as the sum of the layers they call
+- the number of bytes of the arrays returned, not counting the cache
+- the shapes of the arrays returned
+- optionally, the net number of bytes allocated during the call, measured
+  with tracemalloc
+
+Example usage:
+
+with Profiler() as prof:
+    loss, grads = model.loss(X, y)
+print(prof.table())
+prof.export_chrome_trace('trace.json')
+"""
+
+
+LAYER_MODULES = ['cs231n.layers', 'cs231n.fast_layers', 'cs231n.layer_utils',
+                 'cs231n.rnn_layers']
+
+_LAYER_FUNCTION = re.compile(r'.*(_forward|_backward)(_\w+)?$|.*_loss$')
+
+
+def _prod(shape):
+    return int(np.prod(shape)) if len(shape) > 0 else 1
+
+
+def _forward_flops(name, args, out):
+    """
+    Estimate the floating point operations of a forward layer call from its
+    inputs and its output; returns None for layers that only call others.
+    """
+    kind = re.sub(r'_(forward|loss)(_\w+)?$', '', name)
+    if kind == 'affine':
+        x, w = args[0], args[1]
+        return 2 * x.shape[0] * w.shape[0] * w.shape[1]
+    if kind == 'temporal_affine':
+        x, w = args[0], args[1]
+        return 2 * x.shape[0] * x.shape[1] * w.shape[0] * w.shape[1]
+    if kind == 'conv':
+        w = args[1]
+        return 2 * out.size * _prod(w.shape[1:])
+    if kind == 'max_pool':
+        pool_param = args[1]
+        return out.size * pool_param['pool_height'] * pool_param['pool_width']
+    if kind in ('relu', 'leaky_relu', 'dropout'):
+        return 2 * args[0].size
+    if kind in ('batchnorm', 'spatial_batchnorm'):
+        return 8 * args[0].size
+    if kind in ('softmax', 'svm', 'temporal_softmax'):
+        return 5 * args[0].size
+    if kind == 'temporal_sampled_softmax':
+        # Fused layer: scores, plus the gradients of the inputs and weights
+        x, mask, num_sampled = args[0], args[4], args[5]
+        return 6 * int(mask.sum()) * x.shape[2] * (num_sampled + 1)
+    if kind in ('rnn_step', 'lstm_step'):
+        x, prev_h, Wx = args[0], args[1], args[3 if kind == 'lstm_step' else 2]
+        N, H4 = x.shape[0], Wx.shape[1]
+        return 2 * N * (Wx.shape[0] + prev_h.shape[1]) * H4 + 10 * N * H4
+    if kind == 'lstm':
+        x, h0, Wx = args[0], args[1], args[2]
+        N, T, H4 = x.shape[0], x.shape[1], Wx.shape[1]
+        return 2 * N * T * (Wx.shape[0] + h0.shape[1]) * H4 + 10 * N * T * H4
+    if kind == 'word_embedding':
+        return 0
+    return None
+
+
+class Profiler(object):
+    """
+    Records timing, FLOP and memory estimates for every layer call made while
+    it is active; see the top of this file.
+    """
+
+    def __init__(self, trace_memory=False):
+        """
+        Inputs:
+        - trace_memory: If True, also record the net bytes allocated during each
+          call with tracemalloc. This slows down every allocation.
+        """
+        self.trace_memory = trace_memory
+        self.events = []
+        self._patched = []
+        self._local = threading.local()
+        self._forward_flops = {}
+        self._t0 = None
+
+
+    def __enter__(self):
+        self.start()
+        return self
+
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+    def start(self):
+        """
+        Replace the layer functions of every loaded cs231n module with
+        profiling wrappers.
+        """
+        if self._patched:
+            return
+        wrappers = {}
+        for module_name in LAYER_MODULES:
+            try:
+                module = importlib.import_module(module_name)
+            except ImportError:
+                continue
+            for name, fn in vars(module).items():
+                if (callable(fn) and getattr(fn, '__module__', None) == module_name
+                        and _LAYER_FUNCTION.match(name)):
+                    wrappers[fn] = self._wrap(fn)
+
+        for module_name, module in list(sys.modules.items()):
+            if module is None or not (module_name == 'cs231n' or module_name.startswith('cs231n.')):
+                continue
+            for name, fn in list(vars(module).items()):
+                try:
+                    wrapper = wrappers.get(fn)
+                except TypeError:
+                    continue
+                if wrapper is not None:
+                    setattr(module, name, wrapper)
+                    self._patched.append((module, name, fn))
+
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        self._t0 = time.perf_counter()
+
+
+    def stop(self):
+        """
+        Put the original layer functions back.
+        """
+        for module, name, fn in reversed(self._patched):
+            setattr(module, name, fn)
+        self._patched = []
+        self._forward_flops = {}
+        if getattr(self, '_started_tracemalloc', False):
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+
+    def _wrap(self, fn):
+        name = fn.__name__
+        is_backward = '_backward' in name
+        is_forward = '_forward' in name
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            stack = getattr(self._local, 'stack', None)
+            if stack is None:
+                stack = self._local.stack = []
+            frame = {'child_time': 0.0, 'child_flops': 0}
+            stack.append(frame)
+            mem0 = tracemalloc.get_traced_memory()[0] if self.trace_memory else 0
+            start = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            finally:
+                end = time.perf_counter()
+                stack.pop()
+            mem1 = tracemalloc.get_traced_memory()[0] if self.trace_memory else 0
+
+            # Split the result into returned arrays and cache
+            cache = None
+            if isinstance(result, tuple):
+                if is_forward:
+                    outputs, cache = result[:-1], result[-1]
+                else:
+                    outputs = result
+            else:
+                outputs = (result,)
+            outputs = [o for o in outputs if isinstance(o, np.ndarray)]
+
+            # Estimate FLOPs; backward passes look up the forward estimate of
+            # the same layer through its cache
+            if is_backward:
+                entry = self._forward_flops.pop(id(args[-1]), None)
+                flops = entry[1] if entry is not None else None
+                if frame['child_flops'] or flops is None:
+                    flops = frame['child_flops']
+                else:
+                    flops *= 2
+            else:
+                flops = None
+                if outputs:
+                    try:
+                        flops = _forward_flops(name, args, outputs[0])
+                    except (AttributeError, IndexError, KeyError, TypeError):
+                        flops = None
+                if flops is None:
+                    flops = frame['child_flops']
+                if cache is not None:
+                    # The entry keeps the cache alive, so that its id cannot
+                    # be reused by another cache before the entry is removed
+                    self._forward_flops[id(cache)] = (cache, flops)
+
+            duration = end - start
+            if stack:
+                stack[-1]['child_time'] += duration
+                stack[-1]['child_flops'] += flops
+            self.events.append({
+              'name': name,
+              'start': start - self._t0,
+              'time': duration,
+              'self_time': duration - frame['child_time'],
+              'flops': flops,
+              'nested_flops': frame['child_flops'],
+              'out_bytes': sum(o.nbytes for o in outputs),
+              'alloc_bytes': mem1 - mem0,
+              'shapes': [list(o.shape) for o in outputs],
+              'depth': len(stack),
+              'thread': threading.current_thread().ident,
+            })
+            if not stack:
+                self._prune_forward_flops()
+            return result
+
+        return wrapper
+
+
+    def _prune_forward_flops(self):
+        """
+        Forget the forward estimates whose caches nothing but this profiler
+        refers to any more, such as those of test-time forward passes, whose
+        backward pass never comes.
+        """
+        # A probe object referenced only by an entry like those of the
+        # caches gives the reference count of an otherwise unused cache
+        probe = (object(), 0)
+        entries = [(None, probe)] + list(self._forward_flops.items())
+        unused = None
+        for key, entry in entries:
+            count = sys.getrefcount(entry[0])
+            if unused is None:
+                unused = count
+            elif count <= unused:
+                self._forward_flops.pop(key, None)
+
+
+    def summary(self):
+        """
+        Aggregate the recorded events per layer function.
+
+        Returns a list of dictionaries, one per function, sorted by decreasing
+        self time, with keys name, calls, time, self_time, flops, out_bytes,
+        alloc_bytes and shapes (the output shapes of the last call).
+        """
+        rows = {}
+        for e in self.events:
+            row = rows.setdefault(e['name'], {
+              'name': e['name'], 'calls': 0, 'time': 0.0, 'self_time': 0.0,
+              'flops': 0, 'out_bytes': 0, 'alloc_bytes': 0,
+            })
+            row['calls'] += 1
+            row['time'] += e['time']
+            row['self_time'] += e['self_time']
+            row['flops'] += e['flops'] - e['nested_flops']
+            row['out_bytes'] += e['out_bytes']
+            row['alloc_bytes'] += e['alloc_bytes']
+            row['shapes'] = e['shapes']
+        return sorted(rows.values(), key=lambda r: -r['self_time'])
+
+
+    def table(self):
+        """
+        Return a text table of the recorded time per layer function. Times and
+        FLOPs in the self columns exclude nested layer calls, so they add up
+        to the total time spent in layers.
+        """
+        rows = self.summary()
+        total = sum(r['self_time'] for r in rows) or 1.0
+        lines = ['%-36s %6s %10s %10s %6s %10s %10s  %s' % (
+            'layer', 'calls', 'total ms', 'self ms', 'self%', 'GFLOP/s',
+            'out MB', 'last output shapes')]
+        for r in rows:
+            gflops = r['flops'] / r['self_time'] / 1e9 if r['self_time'] > 0 else 0.0
+            lines.append('%-36s %6d %10.3f %10.3f %5.1f%% %10.2f %10.2f  %s' % (
+                r['name'], r['calls'], 1e3 * r['time'], 1e3 * r['self_time'],
+                100.0 * r['self_time'] / total, gflops, r['out_bytes'] / 2.0 ** 20,
+                ' '.join('x'.join(str(d) for d in s) for s in r['shapes'])))
+        return '\n'.join(lines)
+
+
+    def export_chrome_trace(self, path):
+        """
+        Write the recorded events in the Chrome trace event format, which can be
+        opened in chrome://tracing or Perfetto.
+        """
+        events = []
+        for e in self.events:
+            events.append({
+              'name': e['name'],
+              'cat': 'backward' if '_backward' in e['name'] else 'forward',
+              'ph': 'X',
+              'ts': 1e6 * e['start'],
+              'dur': 1e6 * e['time'],
+              'pid': 0,
+              'tid': e['thread'],
+              'args': {
+                'flops': e['flops'],
+                'out_bytes': e['out_bytes'],
+                'alloc_bytes': e['alloc_bytes'],
+                'shapes': e['shapes'],
+              },
+            })
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events}, f)
@@ -4,11 +4,16 @@ standard_library.install_aliases()
 from builtins import range
 from builtins import object
 import os
-import pickle as pickle
 
 import numpy as np
 
 from cs231n import optim
+from cs231n.checkpoint import Checkpointer, latest_checkpoint, load_checkpoint
+from cs231n.checkpoint import model_skeleton, restore_model, pickle_array, unpickle_array
+from cs231n.evaluation import evaluate
+from cs231n.flat_params import FlatParams
+from cs231n.parallel import DataParallel
+from cs231n.precision import LossScaler, accum_dtype, set_loss_scale
 
 
 class Solver(object):
@@ -31,7 +36,13 @@ class Solver(object):
     In addition, the instance variable solver.loss_history will contain a list
     of all losses encountered during training and the instance variables
     solver.train_acc_history and solver.val_acc_history will be lists of the
-    accuracies of the model on the training and validation set at each epoch.
+    accuracies of the model on the training and validation set at each epoch,
+    and solver.val_metrics_history will hold the top-1, top-5 and per-class
+    accuracies on the validation set at each epoch.
+
+    If metrics_every is set, solver.metrics_history will also contain one
+    dictionary per recorded iteration giving the loss and the gradient and
+    update norms of every parameter.
 
     Example usage might look something like this:
 
@@ -52,6 +63,12 @@ class Solver(object):
                     print_every=100)
     solver.train()
 
+    If the solver was given a checkpoint_name, an interrupted run can be
+    continued from its last checkpoint with
+
+    solver = Solver.from_checkpoint(checkpoint_name, data)
+    solver.train()
+
 
     A Solver works on a model object that must conform to the following API:
 
@@ -100,6 +117,9 @@ class Solver(object):
           'learning_rate' parameter so that should always be present.
         - lr_decay: A scalar for learning rate decay; after each epoch the
           learning rate is multiplied by this value.
+        - lr_schedule: If not None, a schedule from lr_schedule.py that sets
+          the learning rate of every iteration, starting from the learning
+          rate in optim_config. Cannot be combined with lr_decay.
         - batch_size: Size of minibatches used to compute loss and gradient
           during training.
         - num_epochs: The number of epochs to run for during training.
@@ -111,8 +131,41 @@ class Solver(object):
           accuracy; default is 1000; set to None to use entire training set.
         - num_val_samples: Number of validation samples to use to check val
           accuracy; default is None, which uses the entire validation set.
-        - checkpoint_name: If not None, then save model checkpoints here every
-          epoch.
+        - eval_batch_size: Number of samples per forward pass when checking
+          accuracy. Default is 1000.
+        - eval_num_threads: Number of threads that accuracy checks run batches
+          on. Default is the number of CPUs, up to 4.
+        - checkpoint_name: If not None, then save checkpoints with this path
+          prefix every epoch; see checkpoint.py.
+        - checkpoint_keep_last: Number of most recent checkpoints to keep on
+          disk; None keeps all of them. Default is 3.
+        - checkpoint_async: Boolean; if True (the default), checkpoints are
+          written on a background thread while training continues.
+        - flat_params: Boolean; if True, model.params are moved into views of
+          one contiguous vector and the update rule is called once per step on
+          that whole vector rather than once per parameter. All parameters then
+          share a single optim config. Models that already keep their
+          parameters in a flat buffer (model.flat) are always updated this way.
+        - grad_clip_norm: If not None, gradients are rescaled together before
+          each update so that their global L2 norm is at most this value.
+        - grad_clip_param_norm: If not None, each gradient is rescaled before
+          each update so that its own L2 norm is at most this value.
+        - metrics_every: Integer; every metrics_every iterations the gradient
+          and update norms of every parameter are appended to
+          self.metrics_history. Set to 0 to disable.
+        - dtype: If not None, a numpy datatype such as np.float16 or np.float32;
+          the parameters of the model and every minibatch are cast to it, so
+          that all layers compute in it. For half precision the update rule
+          runs on float32 master copies of the parameters.
+        - loss_scale: Factor that the loss gradient is multiplied by during
+          backpropagation, so that small gradients do not underflow in half
+          precision; either a number or 'dynamic'. Defaults to 'dynamic' when
+          dtype is a half precision type and to no scaling otherwise. Steps
+          with non-finite gradients are skipped.
+        - num_workers: Integer; if greater than 1, every minibatch is split
+          across this many worker processes that compute the loss and gradients
+          on replicas of the model, and the update rule is applied once on the
+          combined gradient. Implies flat_params. See parallel.py.
         """
         self.model = model
         self.X_train = data['X_train']
@@ -124,14 +177,26 @@ class Solver(object):
         self.update_rule = kwargs.pop('update_rule', 'sgd')
         self.optim_config = kwargs.pop('optim_config', {})
         self.lr_decay = kwargs.pop('lr_decay', 1.0)
+        self.lr_schedule = kwargs.pop('lr_schedule', None)
         self.batch_size = kwargs.pop('batch_size', 100)
         self.num_epochs = kwargs.pop('num_epochs', 10)
         self.num_train_samples = kwargs.pop('num_train_samples', 1000)
         self.num_val_samples = kwargs.pop('num_val_samples', None)
+        self.eval_batch_size = kwargs.pop('eval_batch_size', 1000)
+        self.eval_num_threads = kwargs.pop('eval_num_threads', min(4, os.cpu_count() or 1))
 
         self.checkpoint_name = kwargs.pop('checkpoint_name', None)
+        self.checkpoint_keep_last = kwargs.pop('checkpoint_keep_last', 3)
+        self.checkpoint_async = kwargs.pop('checkpoint_async', True)
         self.print_every = kwargs.pop('print_every', 10)
         self.verbose = kwargs.pop('verbose', True)
+        self.flat_params = kwargs.pop('flat_params', False)
+        self.grad_clip_norm = kwargs.pop('grad_clip_norm', None)
+        self.grad_clip_param_norm = kwargs.pop('grad_clip_param_norm', None)
+        self.metrics_every = kwargs.pop('metrics_every', 0)
+        self.dtype = kwargs.pop('dtype', None)
+        self.loss_scale = kwargs.pop('loss_scale', None)
+        self.num_workers = kwargs.pop('num_workers', 1)
 
         # Throw an error if there are extra keyword arguments
         if len(kwargs) > 0:
@@ -144,6 +209,12 @@ class Solver(object):
             raise ValueError('Invalid update_rule "%s"' % self.update_rule)
         self.update_rule = getattr(optim, self.update_rule)
 
+        if self.lr_schedule is not None:
+            if self.lr_decay != 1.0:
+                raise ValueError('lr_schedule and lr_decay cannot be combined')
+            if 'learning_rate' not in self.optim_config:
+                raise ValueError('lr_schedule needs a learning_rate in optim_config')
+
         self._reset()
 
 
@@ -154,11 +225,21 @@ class Solver(object):
         """
         # Set up some variables for book-keeping
         self.epoch = 0
+        self.iteration = 0
+        self.learning_rate = None
         self.best_val_acc = 0
         self.best_params = {}
         self.loss_history = []
         self.train_acc_history = []
         self.val_acc_history = []
+        self.val_metrics_history = []
+        self.metrics_history = []
+
+        self.checkpointer = None
+        if self.checkpoint_name is not None:
+            self.checkpointer = Checkpointer(self.checkpoint_name,
+                                             keep_last=self.checkpoint_keep_last,
+                                             background=self.checkpoint_async)
 
         # Make a deep copy of the optim_config for each parameter
         self.optim_configs = {}
@@ -166,6 +247,66 @@ class Solver(object):
             d = {k: v for k, v in self.optim_config.items()}
             self.optim_configs[p] = d
 
+        # In flat mode the model reads its parameters from views into one
+        # vector, and that vector is updated with a single optim config
+        self.flat = getattr(self.model, 'flat', None)
+        if self.flat is None and self.flat_params:
+            self.flat = FlatParams(self.model.params)
+            self.model.params = self.flat.params
+        if self.flat is not None:
+            self.optim_configs = {'flat': {k: v for k, v in self.optim_config.items()}}
+
+        # In reduced precision the model computes with parameters of self.dtype,
+        # while the update rule runs on master copies of at least float32
+        self.master = None
+        self.scaler = None
+        if self.dtype is not None:
+            self._cast_model(self.dtype)
+
+        # In data-parallel mode the flat parameter vector lives in shared memory
+        self.parallel = None
+        if self.num_workers > 1:
+            self.parallel = DataParallel(self.model, self.X_train, self.y_train,
+                                         self.num_workers, self.dtype)
+            self.flat = self.parallel.flat
+            self.optim_configs = {'flat': {k: v for k, v in self.optim_config.items()}}
+        loss_scale = self.loss_scale
+        if loss_scale is None and self.dtype is not None and np.dtype(self.dtype).itemsize < 4:
+            loss_scale = 'dynamic'
+        if loss_scale is not None:
+            dtype = accum_dtype(np.result_type(*self.model.params.values()))
+            self.master = FlatParams(self.model.params, dtype)
+            self.scaler = LossScaler(loss_scale)
+
+
+    def _cast_model(self, dtype):
+        """
+        Cast the parameters of the model to the given datatype. Don't call this
+        manually.
+        """
+        if hasattr(self.model, 'dtype'):
+            self.model.dtype = dtype
+        if self.flat is not None:
+            self.flat = FlatParams(self.model.params, dtype)
+            self.model.params = self.flat.params
+            if getattr(self.model, 'flat', None) is not None:
+                self.model.flat = self.flat
+        else:
+            for p, w in self.model.params.items():
+                self.model.params[p] = w.astype(dtype)
+
+
+    def _batch(self, batch_mask):
+        """
+        Return the training minibatch selected by batch_mask, cast to
+        self.dtype if set.
+        """
+        X_batch = self.X_train[batch_mask]
+        if self.dtype is not None:
+            X_batch = X_batch.astype(self.dtype)
+        y_batch = self.y_train[batch_mask]
+        return X_batch, y_batch
+
 
     def _step(self):
         """
@@ -175,132 +316,367 @@ class Solver(object):
         # Make a minibatch of training data
         num_train = self.X_train.shape[0]
         batch_mask = np.random.choice(num_train, self.batch_size)
-        X_batch = self.X_train[batch_mask]
-        y_batch = self.y_train[batch_mask]
+
+        # All parameters share the learning rate of the schedule; the configs
+        # are only written when it changes
+        if self.lr_schedule is not None:
+            lr = self.lr_schedule(self.iteration)
+            if lr != self.learning_rate:
+                self.learning_rate = lr
+                for config in self.optim_configs.values():
+                    config['learning_rate'] = lr
 
         # Compute loss and gradient
-        loss, grads = self.model.loss(X_batch, y_batch)
+        if self.parallel is not None:
+            loss_scale = self.scaler.scale if self.scaler is not None else 1.0
+            loss, grads = self.parallel.loss(batch_mask, loss_scale)
+        elif self.scaler is not None:
+            X_batch, y_batch = self._batch(batch_mask)
+            prev_scale = set_loss_scale(self.scaler.scale)
+            try:
+                loss, grads = self.model.loss(X_batch, y_batch)
+            finally:
+                set_loss_scale(prev_scale)
+        else:
+            X_batch, y_batch = self._batch(batch_mask)
+            loss, grads = self.model.loss(X_batch, y_batch)
         self.loss_history.append(loss)
 
+        # Move the scaled gradients into the master buffer and unscale them
+        # there; skip the step if they overflowed
+        if self.master is not None:
+            self.master.pack_grads(grads)
+            finite = self.scaler.unscale(self.master.grad)
+            self.scaler.update(finite)
+            if not finite:
+                return
+
+        # Measure and maybe clip the gradients; norms are only computed on
+        # iterations where they are needed
+        t = len(self.loss_history) - 1
+        record = self.metrics_every > 0 and t % self.metrics_every == 0
+        clip = self.grad_clip_norm is not None or self.grad_clip_param_norm is not None
+        if record or clip:
+            grad_norms, grad_norm, clipped = optim.clip_gradients(
+                grads, list(self.model.params), self.grad_clip_norm,
+                self.grad_clip_param_norm)
+        if record:
+            prev_params = {p: w.copy() for p, w in self.model.params.items()}
+
         # Perform a parameter update
-        for p, w in self.model.params.items():
-            dw = grads[p]
-            config = self.optim_configs[p]
-            next_w, next_config = self.update_rule(w, dw, config)
-            self.model.params[p] = next_w
-            self.optim_configs[p] = next_config
+        if self.flat is not None:
+            if self.master is not None:
+                w, dw = self.master.data, self.master.grad
+            else:
+                w, dw = self.flat.data, self.flat.pack_grads(grads)
+            next_w, next_config = self.update_rule(w, dw, self.optim_configs['flat'])
+            if next_w is not w:
+                w[...] = next_w
+            self.optim_configs['flat'] = next_config
+        else:
+            params = self.model.params if self.master is None else self.master.params
+            for p, w in params.items():
+                dw = grads[p]
+                config = self.optim_configs[p]
+                next_w, next_config = self.update_rule(w, dw, config)
+                if self.master is None:
+                    self.model.params[p] = next_w
+                elif next_w is not w:
+                    w[...] = next_w
+                self.optim_configs[p] = next_config
+
+        # Copy the updated master weights back into the model
+        if self.master is not None:
+            if self.flat is not None:
+                self.flat.data[...] = self.master.data
+            else:
+                for p, w in self.master.params.items():
+                    self.model.params[p][...] = w
+
+        if record:
+            update_norms = {}
+            for p, w in self.model.params.items():
+                prev_params[p] -= w
+                update_norms[p] = float(np.linalg.norm(prev_params[p]))
+            self.metrics_history.append({
+              'iteration': t,
+              'loss': float(loss),
+              'grad_norm': grad_norm,
+              'grad_norms': grad_norms,
+              'update_norms': update_norms,
+              'clipped': clipped,
+            })
 
 
     def _save_checkpoint(self):
-        if self.checkpoint_name is None: return
-        checkpoint = {
-          'model': self.model,
-          'update_rule': self.update_rule,
-          'lr_decay': self.lr_decay,
+        if self.checkpointer is None: return
+        options = {
+          'update_rule': self.update_rule.__name__,
           'optim_config': self.optim_config,
+          'lr_decay': self.lr_decay,
           'batch_size': self.batch_size,
+          'num_epochs': self.num_epochs,
           'num_train_samples': self.num_train_samples,
           'num_val_samples': self.num_val_samples,
-          'epoch': self.epoch,
-          'loss_history': self.loss_history,
+          'eval_batch_size': self.eval_batch_size,
+          'eval_num_threads': self.eval_num_threads,
+          'checkpoint_name': self.checkpoint_name,
+          'checkpoint_keep_last': self.checkpoint_keep_last,
+          'checkpoint_async': self.checkpoint_async,
+          'print_every': self.print_every,
+          'verbose': self.verbose,
+          'flat_params': self.flat_params,
+          'grad_clip_norm': self.grad_clip_norm,
+          'grad_clip_param_norm': self.grad_clip_param_norm,
+          'metrics_every': self.metrics_every,
+          'dtype': np.dtype(self.dtype).name if self.dtype is not None else None,
+          'loss_scale': self.loss_scale,
+          'num_workers': self.num_workers,
+        }
+        _, rng_keys, rng_pos, rng_has_gauss, rng_gauss = np.random.get_state()
+        meta = {
+          'options': options,
+          'model_flat': getattr(self.model, 'flat', None) is not None,
+          'iteration': self.iteration,
+          'best_val_acc': self.best_val_acc,
           'train_acc_history': self.train_acc_history,
           'val_acc_history': self.val_acc_history,
+          'val_metrics_history': self.val_metrics_history,
+          'rng_state': [int(rng_pos), int(rng_has_gauss), float(rng_gauss)],
+        }
+        if self.scaler is not None:
+            meta['scaler'] = [self.scaler.scale, self.scaler.good_steps, self.scaler.skipped_steps]
+        extra_arrays = {
+          'model': model_skeleton(self.model),
+          'rng_keys': rng_keys,
         }
-        filename = '%s_epoch_%d.pkl' % (self.checkpoint_name, self.epoch)
+        if self.lr_schedule is not None:
+            extra_arrays['lr_schedule'] = pickle_array(self.lr_schedule)
+        dropout_params = getattr(self.model, 'dropout_params', [])
+        if dropout_params:
+            # State of the generator of every dropout layer, or None for layers
+            # that have not drawn a mask yet
+            extra_arrays['dropout_rngs'] = pickle_array(
+                [dp['rng'].bit_generator.state if 'rng' in dp else None for dp in dropout_params])
         if self.verbose:
-            print('Saving checkpoint to "%s"' % filename)
-        with open(filename, 'wb') as f:
-            pickle.dump(checkpoint, f)
+            print('Saving checkpoint to "%s_epoch_%d.npz"' % (self.checkpoint_name, self.epoch))
+        self.checkpointer.save(self.epoch, self.model.params, self.optim_configs,
+                               self.loss_history, meta,
+                               best_params=self.best_params,
+                               master_params=self.master.params if self.master is not None else None,
+                               bn_params=getattr(self.model, 'bn_params', None),
+                               extra_arrays=extra_arrays)
 
 
-    def check_accuracy(self, X, y, num_samples=None, batch_size=100):
+    @classmethod
+    def from_checkpoint(cls, path, data, model=None, **kwargs):
         """
-        Check accuracy of the model on the provided data.
+        Construct a Solver that continues training exactly where the Solver
+        that wrote a checkpoint stopped: parameters, update rule state, random
+        number generators (including those of the dropout layers), epoch and
+        iteration counters and histories are all restored. The one exception
+        is training with num_workers > 1: the workers draw their dropout masks
+        from generators of their own, which are not saved, so a resumed run
+        draws different masks.
 
         Inputs:
-        - X: Array of data, of shape (N, d_1, ..., d_k)
-        - y: Array of labels, of shape (N,)
-        - num_samples: If not None, subsample the data and only test the model
-          on num_samples datapoints.
-        - batch_size: Split X and y into batches of this size to avoid using
-          too much memory.
+        - path: Path of a checkpoint file, or a checkpoint prefix (the
+          checkpoint_name of the original Solver), in which case the newest
+          checkpoint with that prefix is used.
+        - data: Dictionary of training and validation data, as for the
+          constructor.
+        - model: Optional model object to load the parameters into, for
+          example to warm-start a model built in code. By default the model
+          stored in the checkpoint is used.
+        - kwargs: Optional arguments of the constructor; they override the ones
+          stored in the checkpoint, for example num_epochs to train for longer.
 
         Returns:
-        - acc: Scalar giving the fraction of instances that were correctly
-          classified by the model.
+        - solver: A new Solver instance; call train() to continue training.
+        """
+        if not path.endswith('.npz'):
+            prefix, path = path, latest_checkpoint(path)
+            if path is None:
+                raise ValueError('No checkpoint found for "%s"' % prefix)
+        ckpt = load_checkpoint(path)
+        meta = ckpt['meta']
+
+        if model is None:
+            model = ckpt['extra']['model']
+        model = restore_model(model, ckpt['params'], flat=meta['model_flat'])
+
+        options = dict(meta['options'])
+        if 'lr_schedule' in ckpt['extra']:
+            options['lr_schedule'] = unpickle_array(ckpt['extra']['lr_schedule'])
+        options.update(kwargs)
+        solver = cls(model, data, **options)
+        solver._restore(ckpt)
+        return solver
+
+
+    def _restore(self, ckpt):
+        """
+        Restore the training state from a loaded checkpoint. Don't call this
+        manually; use from_checkpoint.
+        """
+        meta = ckpt['meta']
+        for key, config in ckpt['optim_configs'].items():
+            if key not in self.optim_configs:
+                raise ValueError('Optimizer state "%s" does not match the model' % key)
+            self.optim_configs[key] = config
+        if self.master is not None and ckpt['master_params']:
+            self.master.load(ckpt['master_params'])
+        if self.scaler is not None and 'scaler' in meta:
+            self.scaler.scale, self.scaler.good_steps, self.scaler.skipped_steps = meta['scaler']
+        for bn_param, saved in zip(getattr(self.model, 'bn_params', []), ckpt['bn_params']):
+            bn_param.update(saved)
+        if 'dropout_rngs' in ckpt['extra']:
+            states = unpickle_array(ckpt['extra']['dropout_rngs'])
+            for dropout_param, state in zip(self.model.dropout_params, states):
+                if state is None:
+                    dropout_param.pop('rng', None)
+                else:
+                    rng = np.random.Generator(np.random.Philox())
+                    rng.bit_generator.state = state
+                    dropout_param['rng'] = rng
+
+        self.epoch = meta['epoch']
+        self.iteration = meta['iteration']
+        self.best_val_acc = meta['best_val_acc']
+        self.best_params = ckpt['best_params']
+        self.loss_history = ckpt['loss_history']
+        self.train_acc_history = meta['train_acc_history']
+        self.val_acc_history = meta['val_acc_history']
+        self.val_metrics_history = meta['val_metrics_history']
+        if self.checkpointer is not None:
+            self.checkpointer.resume(meta['epoch'], len(self.loss_history))
+
+        rng_pos, rng_has_gauss, rng_gauss = meta['rng_state']
+        np.random.set_state(('MT19937', ckpt['extra']['rng_keys'], rng_pos,
+                             rng_has_gauss, rng_gauss))
+
+
+    def evaluate(self, X, y, num_samples=None, batch_size=None):
         """
+        Evaluate the model on the provided data; see evaluation.py.
 
+        Inputs:
+        - X: Array of data, of shape (N, d_1, ..., d_k)
+        - y: Array of labels, of shape (N,)
+        - num_samples: If not None, subsample the data without replacement and
+          only test the model on num_samples datapoints.
+        - batch_size: Number of samples per forward pass; defaults to
+          self.eval_batch_size.
+
+        Returns a dictionary with the top-1, top-5 and per-class accuracies
+        and the predictions of the model, as returned by evaluation.evaluate.
+        """
         # Maybe subsample the data
         N = X.shape[0]
         if num_samples is not None and N > num_samples:
-            mask = np.random.choice(N, num_samples)
-            N = num_samples
+            mask = np.random.choice(N, num_samples, replace=False)
             X = X[mask]
             y = y[mask]
 
-        # Compute predictions in batches
-        num_batches = N // batch_size
-        if N % batch_size != 0:
-            num_batches += 1
-        y_pred = []
-        for i in range(num_batches):
-            start = i * batch_size
-            end = (i + 1) * batch_size
-            scores = self.model.loss(X[start:end])
-            y_pred.append(np.argmax(scores, axis=1))
-        y_pred = np.hstack(y_pred)
-        acc = np.mean(y_pred == y)
+        if batch_size is None:
+            batch_size = self.eval_batch_size
+        return evaluate(self.model, X, y, batch_size=batch_size,
+                        num_threads=self.eval_num_threads, dtype=self.dtype)
+
 
-        return acc
+    def check_accuracy(self, X, y, num_samples=None, batch_size=None):
+        """
+        Check accuracy of the model on the provided data.
+
+        Inputs:
+        - X: Array of data, of shape (N, d_1, ..., d_k)
+        - y: Array of labels, of shape (N,)
+        - num_samples: If not None, subsample the data without replacement and
+          only test the model on num_samples datapoints.
+        - batch_size: Split X and y into batches of this size to avoid using
+          too much memory; defaults to self.eval_batch_size.
+
+        Returns:
+        - acc: Scalar giving the fraction of instances that were correctly
+          classified by the model.
+        """
+        return self.evaluate(X, y, num_samples, batch_size)['top1']
 
 
     def train(self):
         """
-        Run optimization to train the model.
+        Run optimization to train the model. A Solver restored with
+        from_checkpoint continues from the iteration it was saved at.
         """
         num_train = self.X_train.shape[0]
         iterations_per_epoch = max(num_train // self.batch_size, 1)
         num_iterations = self.num_epochs * iterations_per_epoch
 
-        for t in range(num_iterations):
-            self._step()
-
-            # Maybe print training loss
-            if self.verbose and t % self.print_every == 0:
-                print('(Iteration %d / %d) loss: %f' % (
-                       t + 1, num_iterations, self.loss_history[-1]))
-
-            # At the end of every epoch, increment the epoch counter and decay
-            # the learning rate.
-            epoch_end = (t + 1) % iterations_per_epoch == 0
-            if epoch_end:
-                self.epoch += 1
-                for k in self.optim_configs:
-                    self.optim_configs[k]['learning_rate'] *= self.lr_decay
-
-            # Check train and val accuracy on the first iteration, the last
-            # iteration, and at the end of each epoch.
-            first_it = (t == 0)
-            last_it = (t == num_iterations - 1)
-            if first_it or last_it or epoch_end:
-                train_acc = self.check_accuracy(self.X_train, self.y_train,
-                    num_samples=self.num_train_samples)
-                val_acc = self.check_accuracy(self.X_val, self.y_val,
-                    num_samples=self.num_val_samples)
-                self.train_acc_history.append(train_acc)
-                self.val_acc_history.append(val_acc)
-                self._save_checkpoint()
-
-                if self.verbose:
-                    print('(Epoch %d / %d) train acc: %f; val_acc: %f' % (
-                           self.epoch, self.num_epochs, train_acc, val_acc))
-
-                # Keep track of the best model
-                if val_acc > self.best_val_acc:
-                    self.best_val_acc = val_acc
-                    self.best_params = {}
-                    for k, v in self.model.params.items():
-                        self.best_params[k] = v.copy()
+        if self.lr_schedule is not None:
+            self.lr_schedule.start(self.optim_config['learning_rate'], num_iterations)
+
+        if self.parallel is not None:
+            self.parallel.start()
+        try:
+            for t in range(self.iteration, num_iterations):
+                self._step()
+                self.iteration = t + 1
+
+                # Maybe print training loss
+                if self.verbose and t % self.print_every == 0:
+                    print('(Iteration %d / %d) loss: %f' % (
+                           t + 1, num_iterations, self.loss_history[-1]))
+
+                # At the end of every epoch, increment the epoch counter and decay
+                # the learning rate.
+                epoch_end = (t + 1) % iterations_per_epoch == 0
+                if epoch_end:
+                    self.epoch += 1
+                    for k in self.optim_configs:
+                        self.optim_configs[k]['learning_rate'] *= self.lr_decay
+
+                # Check train and val accuracy on the first iteration, the last
+                # iteration, and at the end of each epoch.
+                first_it = (t == 0)
+                last_it = (t == num_iterations - 1)
+                if first_it or last_it or epoch_end:
+                    if self.parallel is not None:
+                        self.parallel.sync_state()
+                    train_acc = self.check_accuracy(self.X_train, self.y_train,
+                        num_samples=self.num_train_samples)
+                    val_metrics = self.evaluate(self.X_val, self.y_val,
+                        num_samples=self.num_val_samples)
+                    val_acc = val_metrics['top1']
+                    if self.lr_schedule is not None:
+                        self.lr_schedule.observe(val_acc)
+                    self.val_metrics_history.append({
+                      'top1': val_metrics['top1'],
+                      'top5': val_metrics['top5'],
+                      'per_class': val_metrics['per_class'].tolist(),
+                    })
+                    self.train_acc_history.append(train_acc)
+                    self.val_acc_history.append(val_acc)
+
+                    if self.verbose:
+                        print('(Epoch %d / %d) train acc: %f; val_acc: %f' % (
+                               self.epoch, self.num_epochs, train_acc, val_acc))
+
+                    # Keep track of the best model
+                    if val_acc > self.best_val_acc:
+                        self.best_val_acc = val_acc
+                        self.best_params = {}
+                        for k, v in self.model.params.items():
+                            self.best_params[k] = v.copy()
+
+                    self._save_checkpoint()
+        finally:
+            if self.parallel is not None:
+                self.parallel.close()
+            if self.checkpointer is not None:
+                self.checkpointer.close()
 
         # At the end of training swap the best params into the model
-        self.model.params = self.best_params
+        if self.flat is None:
+            self.model.params = self.best_params
+        elif self.best_params:
+            self.flat.load(self.best_params)
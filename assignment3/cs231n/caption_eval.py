@@ -0,0 +1,269 @@
+from __future__ import print_function, division
+from builtins import range
+from builtins import object
+from collections import Counter, defaultdict
+import math
+import multiprocessing
+
+import numpy as np
+
+"""
+This file implements offline evaluation of generated captions against the
+reference captions of a COCO split, with the BLEU-1 to BLEU-n and CIDEr-D
+metrics of the COCO caption evaluation code.
+
+Captions are compared as sequences of word indices; <NULL>, <START> and
+everything from <END> on are ignored. A CaptionScorer builds, once per split,
+an index of the n-gram counts of every reference caption: for BLEU the maximum
+count of every n-gram over the references of each image, and for CIDEr the
+document frequencies of the n-grams over the images of the split and the
+TF-IDF vectors of the references. Scoring a set of generated captions then only
+counts the n-grams of the generated captions.
+
+Scoring can be split over worker processes. Workers are started with fork, so
+they inherit the index and the captions to score without copying them; each
+scores a contiguous range of the captions and sends back per-range sums.
+
+Example usage:
+
+scorer = CaptionScorer(data['val_captions'], data['val_image_idxs'],
+                       data['word_to_idx'])
+scores = evaluate_captions(model, data, 'val', scorer, num_workers=4)
+print(scores['Bleu_4'], scores['CIDEr'])
+"""
+
+
+# Scorer and captions being scored, set in the parent process right before the
+# worker processes are forked
+_job = None
+
+
+def _score_range(bounds):
+    scorer, captions, images = _job
+    return scorer._score_range(captions, images, *bounds)
+
+
+def _ngrams(tokens, max_n):
+    """
+    Count the n-grams of a sequence of words for n = 1, ..., max_n; n-grams
+    are tuples of words, so n-grams of different n are different keys.
+    """
+    counts = Counter()
+    for n in range(1, max_n + 1):
+        counts.update(zip(*[tokens[i:] for i in range(n)]))
+    return counts
+
+
+class CaptionScorer(object):
+    """
+    Scores generated captions against the reference captions of a split with
+    BLEU and CIDEr-D; see the top of this file.
+    """
+
+    def __init__(self, captions, image_idxs, word_to_idx, max_n=4, sigma=6.0):
+        """
+        Build the n-gram index of the reference captions.
+
+        Inputs:
+        - captions: Integer array of shape (M, T) of reference captions, such
+          as data['val_captions'].
+        - image_idxs: Integer array of shape (M,) giving the image of each
+          reference caption, such as data['val_image_idxs'].
+        - word_to_idx: Dictionary giving the vocabulary.
+        - max_n: Largest n-gram size; BLEU-1 to BLEU-max_n are reported, and
+          CIDEr uses n-grams up to this size.
+        - sigma: Width of the Gaussian length penalty of CIDEr-D.
+        """
+        self.max_n = max_n
+        self.sigma = sigma
+        self.special = set(word_to_idx[w] for w in ('<NULL>', '<START>') if w in word_to_idx)
+        self.end = word_to_idx.get('<END>', None)
+
+        # Group the references by image
+        refs = defaultdict(list)
+        for image, caption in zip(image_idxs.tolist(), captions.tolist()):
+            refs[image].append(self._tokens(caption))
+        self.images = sorted(refs)
+
+        # BLEU: maximum count of each n-gram over the references of an image,
+        # and the lengths of the references
+        self.max_counts = {}
+        self.ref_lens = {}
+        ref_counts = {}
+        for image in self.images:
+            counts = [_ngrams(r, max_n) for r in refs[image]]
+            max_counts = Counter()
+            for c in counts:
+                max_counts |= c
+            self.max_counts[image] = max_counts
+            self.ref_lens[image] = [len(r) for r in refs[image]]
+            ref_counts[image] = counts
+
+        # CIDEr: document frequency of each n-gram over the images, and the
+        # TF-IDF vectors and their norms for every reference
+        self.doc_freq = Counter()
+        for image in self.images:
+            self.doc_freq.update(set(g for c in ref_counts[image] for g in c))
+        self.log_num_images = math.log(float(len(self.images)))
+        self.ref_vecs = {}
+        for image in self.images:
+            self.ref_vecs[image] = [self._tfidf(c) + (len(r),)
+                                    for c, r in zip(ref_counts[image], refs[image])]
+
+
+    def _tokens(self, caption):
+        """
+        Return the words of a caption as a tuple, without <NULL> and <START>
+        and up to its first <END>.
+        """
+        tokens = []
+        for w in caption:
+            if w == self.end:
+                break
+            if w not in self.special:
+                tokens.append(w)
+        return tuple(tokens)
+
+
+    def _tfidf(self, counts):
+        """
+        Return the TF-IDF vector of each n-gram size and their norms.
+        """
+        vecs = [{} for n in range(self.max_n)]
+        norms = [0.0] * self.max_n
+        for g, tf in counts.items():
+            n = len(g) - 1
+            v = tf * (self.log_num_images - math.log(max(1.0, self.doc_freq[g])))
+            vecs[n][g] = v
+            norms[n] += v * v
+        return vecs, [math.sqrt(x) for x in norms]
+
+
+    def _score_range(self, captions, images, start, end):
+        """
+        Score captions[start:end] against the references of their images.
+
+        Returns a tuple of:
+        - stats: Array of shape (2 * max_n + 2,) with the clipped n-gram
+          matches and the n-gram counts of the captions for every n, the total
+          length of the captions and the total closest reference length
+        - cider: Array of shape (end - start,) of CIDEr-D scores
+        """
+        max_n = self.max_n
+        stats = np.zeros(2 * max_n + 2)
+        cider = np.zeros(end - start)
+        for i in range(start, end):
+            image = images[i]
+            tokens = self._tokens(captions[i])
+            counts = _ngrams(tokens, max_n)
+            L = len(tokens)
+
+            # BLEU statistics
+            max_counts = self.max_counts[image]
+            for g, c in counts.items():
+                stats[len(g) - 1] += min(c, max_counts.get(g, 0))
+            for n in range(max_n):
+                stats[max_n + n] += max(L - n, 0)
+            stats[2 * max_n] += L
+            stats[2 * max_n + 1] += min(self.ref_lens[image], key=lambda r: (abs(r - L), r))
+
+            # CIDEr-D: clipped cosine similarity of the TF-IDF vectors with a
+            # Gaussian penalty on the length difference, averaged over the
+            # references and the n-gram sizes
+            vecs, norms = self._tfidf(counts)
+            score = 0.0
+            for ref_vecs, ref_norms, ref_len in self.ref_vecs[image]:
+                penalty = math.exp(-(L - ref_len) ** 2 / (2 * self.sigma ** 2))
+                for n in range(max_n):
+                    if norms[n] == 0 or ref_norms[n] == 0:
+                        continue
+                    ref_vec = ref_vecs[n]
+                    dot = sum(min(v, ref_vec[g]) * ref_vec[g]
+                              for g, v in vecs[n].items() if g in ref_vec)
+                    score += penalty * dot / (norms[n] * ref_norms[n])
+            cider[i - start] = 10.0 * score / max_n / len(self.ref_vecs[image])
+        return stats, cider
+
+
+    def score(self, captions, images, num_workers=1):
+        """
+        Score generated captions against the references of their images.
+
+        Inputs:
+        - captions: Integer array of shape (N, T) of generated captions, as
+          returned by CaptioningRNN.sample.
+        - images: Integer array of shape (N,) giving the image of each caption;
+          every image must have references in this scorer.
+        - num_workers: Number of processes to split the scoring over.
+
+        Returns a dictionary with keys:
+        - 'Bleu_1', ..., 'Bleu_<max_n>': Corpus BLEU scores
+        - 'CIDEr': Mean CIDEr-D score
+        """
+        global _job
+        captions, images = captions.tolist(), images.tolist()
+        N = len(captions)
+        num_workers = max(1, min(num_workers, N))
+        bounds = [(N * k // num_workers, N * (k + 1) // num_workers)
+                  for k in range(num_workers)]
+        if num_workers > 1:
+            _job = (self, captions, images)
+            try:
+                with multiprocessing.get_context('fork').Pool(num_workers) as pool:
+                    results = pool.map(_score_range, bounds)
+            finally:
+                _job = None
+        else:
+            results = [self._score_range(captions, images, *bounds[0])]
+
+        max_n = self.max_n
+        stats = sum(r[0] for r in results)
+        cider = np.concatenate([r[1] for r in results])
+
+        # Corpus BLEU with the brevity penalty of the closest reference lengths
+        tiny, small = 1e-15, 1e-9
+        cand_len, ref_len = stats[2 * max_n], stats[2 * max_n + 1]
+        brevity = 1.0 if cand_len > ref_len else math.exp(1 - ref_len / (cand_len + small))
+        scores = {}
+        log_precision = 0.0
+        for n in range(max_n):
+            log_precision += math.log((stats[n] + tiny) / (stats[max_n + n] + small))
+            scores['Bleu_%d' % (n + 1)] = brevity * math.exp(log_precision / (n + 1))
+        scores['CIDEr'] = float(np.mean(cider)) if N > 0 else 0.0
+        return scores
+
+
+def evaluate_captions(model, data, split='val', scorer=None, num_samples=None,
+                      batch_size=1000, max_length=30, beam_size=1,
+                      num_workers=1):
+    """
+    Caption the images of a split with model.sample and score the captions
+    against all the reference captions of each image.
+
+    Inputs:
+    - model: A CaptioningRNN.
+    - data: A dictionary of data from load_coco_data.
+    - split: Either 'train' or 'val'.
+    - scorer: A CaptionScorer for the split; built if not given. Building it
+      takes a while, so reuse it across evaluations.
+    - num_samples: If not None, only caption this many randomly chosen images.
+    - batch_size: Number of images captioned per call to model.sample.
+    - max_length, beam_size: Passed to model.sample.
+    - num_workers: Number of processes used for scoring.
+
+    Returns the dictionary of scores of CaptionScorer.score.
+    """
+    if scorer is None:
+        scorer = CaptionScorer(data['%s_captions' % split],
+                               data['%s_image_idxs' % split], data['word_to_idx'])
+    images = np.array(scorer.images)
+    if num_samples is not None and len(images) > num_samples:
+        images = np.sort(np.random.choice(images, num_samples, replace=False))
+
+    features = data['%s_features' % split]
+    captions = np.empty((len(images), max_length), dtype=np.int32)
+    for start in range(0, len(images), batch_size):
+        idx = images[start:start + batch_size]
+        captions[start:start + len(idx)] = model.sample(
+            features[idx], max_length=max_length, beam_size=beam_size)
+    return scorer.score(captions, images, num_workers)
@@ -4,7 +4,12 @@ from builtins import object
 import numpy as np
 
 from cs231n import optim
-from cs231n.coco_utils import sample_coco_minibatch
+from cs231n.caption_eval import CaptionScorer, evaluate_captions
+from cs231n.checkpoint import Checkpointer, latest_checkpoint, load_checkpoint
+from cs231n.checkpoint import model_skeleton, restore_model
+from cs231n.flat_params import FlatParams
+from cs231n.precision import LossScaler, accum_dtype, set_loss_scale
+from cs231n.coco_utils import caption_lengths, length_buckets, sample_coco_minibatch
 
 
 class CaptioningSolver(object):
@@ -29,6 +34,15 @@ class CaptioningSolver(object):
     solver.train_acc_history and solver.val_acc_history will be lists containing
     the accuracies of the model on the training and validation set at each epoch.
 
+    If val_metric is set, the captions the model samples for the training and
+    validation images are scored with BLEU and CIDEr at the end of every epoch
+    (see caption_eval.py); the histories then hold the chosen metric, and
+    solver.val_metrics_history holds all the validation scores.
+
+    If metrics_every is set, solver.metrics_history will also contain one
+    dictionary per recorded iteration giving the loss and the gradient and
+    update norms of every parameter.
+
     Example usage might look something like this:
 
     data = load_coco_data()
@@ -43,6 +57,12 @@ class CaptioningSolver(object):
                     print_every=100)
     solver.train()
 
+    If the solver was given a checkpoint_name, an interrupted run can be
+    continued from its last checkpoint with
+
+    solver = CaptioningSolver.from_checkpoint(checkpoint_name, data)
+    solver.train()
+
 
     A CaptioningSolver works on a model object that must conform to the following
     API:
@@ -84,10 +104,50 @@ class CaptioningSolver(object):
         - batch_size: Size of minibatches used to compute loss and gradient during
           training.
         - num_epochs: The number of epochs to run for during training.
+        - bucket_by_length: Boolean; if True, every minibatch is drawn from
+          training captions of similar length and cut after its longest
+          caption, so that little time is spent on <NULL> padding. Each
+          caption is still sampled with the same probability.
         - print_every: Integer; training losses will be printed every print_every
           iterations.
         - verbose: Boolean; if set to false then no output will be printed during
           training.
+        - flat_params: Boolean; if True, model.params are moved into views of
+          one contiguous vector and the update rule is called once per step on
+          that whole vector rather than once per parameter. All parameters then
+          share a single optim config. Models that already keep their
+          parameters in a flat buffer (model.flat) are always updated this way.
+        - grad_clip_norm: If not None, gradients are rescaled together before
+          each update so that their global L2 norm is at most this value.
+        - grad_clip_param_norm: If not None, each gradient is rescaled before
+          each update so that its own L2 norm is at most this value.
+        - metrics_every: Integer; every metrics_every iterations the gradient
+          and update norms of every parameter are appended to
+          self.metrics_history. Set to 0 to disable.
+        - dtype: If not None, a numpy datatype such as np.float16 or np.float32;
+          the parameters of the model and every minibatch are cast to it, so
+          that all layers compute in it. For half precision the update rule
+          runs on float32 master copies of the parameters.
+        - loss_scale: Factor that the loss gradient is multiplied by during
+          backpropagation, so that small gradients do not underflow in half
+          precision; either a number or 'dynamic'. Defaults to 'dynamic' when
+          dtype is a half precision type and to no scaling otherwise. Steps
+          with non-finite gradients are skipped.
+        - val_metric: If not None, the name of a score of caption_eval.py, such
+          as 'CIDEr' or 'Bleu_4', used to check the model at the end of every
+          epoch and to keep the best parameters. Default is None, which skips
+          these checks.
+        - num_train_samples: Number of training images to caption when checking
+          the model; default 1000.
+        - num_val_samples: Number of validation images to caption when checking
+          the model; default None, which uses all of them.
+        - eval_workers: Number of processes used to score captions.
+        - checkpoint_name: If not None, then save checkpoints with this path
+          prefix every epoch; see checkpoint.py.
+        - checkpoint_keep_last: Number of most recent checkpoints to keep on
+          disk; None keeps all of them. Default is 3.
+        - checkpoint_async: Boolean; if True (the default), checkpoints are
+          written on a background thread while training continues.
         """
         self.model = model
         self.data = data
@@ -98,9 +158,23 @@ class CaptioningSolver(object):
         self.lr_decay = kwargs.pop('lr_decay', 1.0)
         self.batch_size = kwargs.pop('batch_size', 100)
         self.num_epochs = kwargs.pop('num_epochs', 10)
+        self.bucket_by_length = kwargs.pop('bucket_by_length', False)
 
+        self.checkpoint_name = kwargs.pop('checkpoint_name', None)
+        self.checkpoint_keep_last = kwargs.pop('checkpoint_keep_last', 3)
+        self.checkpoint_async = kwargs.pop('checkpoint_async', True)
         self.print_every = kwargs.pop('print_every', 10)
         self.verbose = kwargs.pop('verbose', True)
+        self.flat_params = kwargs.pop('flat_params', False)
+        self.grad_clip_norm = kwargs.pop('grad_clip_norm', None)
+        self.grad_clip_param_norm = kwargs.pop('grad_clip_param_norm', None)
+        self.metrics_every = kwargs.pop('metrics_every', 0)
+        self.dtype = kwargs.pop('dtype', None)
+        self.loss_scale = kwargs.pop('loss_scale', None)
+        self.val_metric = kwargs.pop('val_metric', None)
+        self.num_train_samples = kwargs.pop('num_train_samples', 1000)
+        self.num_val_samples = kwargs.pop('num_val_samples', None)
+        self.eval_workers = kwargs.pop('eval_workers', 1)
 
         # Throw an error if there are extra keyword arguments
         if len(kwargs) > 0:
@@ -123,11 +197,31 @@ class CaptioningSolver(object):
         """
         # Set up some variables for book-keeping
         self.epoch = 0
+        self.iteration = 0
         self.best_val_acc = 0
         self.best_params = {}
         self.loss_history = []
         self.train_acc_history = []
         self.val_acc_history = []
+        self.val_metrics_history = []
+        self.metrics_history = []
+
+        # Reference n-gram indexes of the splits, built on first use
+        self.scorers = {}
+
+        # Group the training captions by length once; each minibatch is then
+        # sampled from a single bucket
+        self.buckets = None
+        if self.bucket_by_length:
+            lengths = caption_lengths(self.data['train_captions'],
+                                      self.data['word_to_idx']['<NULL>'])
+            self.buckets = length_buckets(lengths, min_size=self.batch_size)
+
+        self.checkpointer = None
+        if self.checkpoint_name is not None:
+            self.checkpointer = Checkpointer(self.checkpoint_name,
+                                             keep_last=self.checkpoint_keep_last,
+                                             background=self.checkpoint_async)
 
         # Make a deep copy of the optim_config for each parameter
         self.optim_configs = {}
@@ -135,6 +229,46 @@ class CaptioningSolver(object):
             d = {k: v for k, v in self.optim_config.items()}
             self.optim_configs[p] = d
 
+        # In flat mode the model reads its parameters from views into one
+        # vector, and that vector is updated with a single optim config
+        self.flat = getattr(self.model, 'flat', None)
+        if self.flat is None and self.flat_params:
+            self.flat = FlatParams(self.model.params)
+            self.model.params = self.flat.params
+        if self.flat is not None:
+            self.optim_configs = {'flat': {k: v for k, v in self.optim_config.items()}}
+
+        # In reduced precision the model computes with parameters of self.dtype,
+        # while the update rule runs on master copies of at least float32
+        self.master = None
+        self.scaler = None
+        if self.dtype is not None:
+            self._cast_model(self.dtype)
+        loss_scale = self.loss_scale
+        if loss_scale is None and self.dtype is not None and np.dtype(self.dtype).itemsize < 4:
+            loss_scale = 'dynamic'
+        if loss_scale is not None:
+            dtype = accum_dtype(np.result_type(*self.model.params.values()))
+            self.master = FlatParams(self.model.params, dtype)
+            self.scaler = LossScaler(loss_scale)
+
+
+    def _cast_model(self, dtype):
+        """
+        Cast the parameters of the model to the given datatype. Don't call this
+        manually.
+        """
+        if hasattr(self.model, 'dtype'):
+            self.model.dtype = dtype
+        if self.flat is not None:
+            self.flat = FlatParams(self.model.params, dtype)
+            self.model.params = self.flat.params
+            if getattr(self.model, 'flat', None) is not None:
+                self.model.flat = self.flat
+        else:
+            for p, w in self.model.params.items():
+                self.model.params[p] = w.astype(dtype)
+
 
     def _step(self):
         """
@@ -144,92 +278,297 @@ class CaptioningSolver(object):
         # Make a minibatch of training data
         minibatch = sample_coco_minibatch(self.data,
                       batch_size=self.batch_size,
-                      split='train')
+                      split='train',
+                      buckets=self.buckets)
         captions, features, urls = minibatch
+        if self.dtype is not None:
+            features = features.astype(self.dtype)
 
         # Compute loss and gradient
-        loss, grads = self.model.loss(features, captions)
+        if self.scaler is not None:
+            prev_scale = set_loss_scale(self.scaler.scale)
+            try:
+                loss, grads = self.model.loss(features, captions)
+            finally:
+                set_loss_scale(prev_scale)
+        else:
+            loss, grads = self.model.loss(features, captions)
         self.loss_history.append(loss)
 
+        # Move the scaled gradients into the master buffer and unscale them
+        # there; skip the step if they overflowed
+        if self.master is not None:
+            self.master.pack_grads(grads)
+            finite = self.scaler.unscale(self.master.grad)
+            self.scaler.update(finite)
+            if not finite:
+                return
+
+        # Measure and maybe clip the gradients; norms are only computed on
+        # iterations where they are needed
+        t = len(self.loss_history) - 1
+        record = self.metrics_every > 0 and t % self.metrics_every == 0
+        clip = self.grad_clip_norm is not None or self.grad_clip_param_norm is not None
+        if record or clip:
+            grad_norms, grad_norm, clipped = optim.clip_gradients(
+                grads, list(self.model.params), self.grad_clip_norm,
+                self.grad_clip_param_norm)
+        if record:
+            prev_params = {p: w.copy() for p, w in self.model.params.items()}
+
         # Perform a parameter update
-        for p, w in self.model.params.items():
-            dw = grads[p]
-            config = self.optim_configs[p]
-            next_w, next_config = self.update_rule(w, dw, config)
-            self.model.params[p] = next_w
-            self.optim_configs[p] = next_config
+        if self.flat is not None:
+            if self.master is not None:
+                w, dw = self.master.data, self.master.grad
+            else:
+                w, dw = self.flat.data, self.flat.pack_grads(grads)
+            next_w, next_config = self.update_rule(w, dw, self.optim_configs['flat'])
+            if next_w is not w:
+                w[...] = next_w
+            self.optim_configs['flat'] = next_config
+        else:
+            params = self.model.params if self.master is None else self.master.params
+            for p, w in params.items():
+                dw = grads[p]
+                config = self.optim_configs[p]
+                next_w, next_config = self.update_rule(w, dw, config)
+                if self.master is None:
+                    self.model.params[p] = next_w
+                elif next_w is not w:
+                    w[...] = next_w
+                self.optim_configs[p] = next_config
+
+        # Copy the updated master weights back into the model
+        if self.master is not None:
+            if self.flat is not None:
+                self.flat.data[...] = self.master.data
+            else:
+                for p, w in self.master.params.items():
+                    self.model.params[p][...] = w
+
+        if record:
+            update_norms = {}
+            for p, w in self.model.params.items():
+                prev_params[p] -= w
+                update_norms[p] = float(np.linalg.norm(prev_params[p]))
+            self.metrics_history.append({
+              'iteration': t,
+              'loss': float(loss),
+              'grad_norm': grad_norm,
+              'grad_norms': grad_norms,
+              'update_norms': update_norms,
+              'clipped': clipped,
+            })
+
+
+    def _save_checkpoint(self):
+        if self.checkpointer is None: return
+        options = {
+          'update_rule': self.update_rule.__name__,
+          'optim_config': self.optim_config,
+          'lr_decay': self.lr_decay,
+          'batch_size': self.batch_size,
+          'num_epochs': self.num_epochs,
+          'bucket_by_length': self.bucket_by_length,
+          'checkpoint_name': self.checkpoint_name,
+          'checkpoint_keep_last': self.checkpoint_keep_last,
+          'checkpoint_async': self.checkpoint_async,
+          'print_every': self.print_every,
+          'verbose': self.verbose,
+          'flat_params': self.flat_params,
+          'grad_clip_norm': self.grad_clip_norm,
+          'grad_clip_param_norm': self.grad_clip_param_norm,
+          'metrics_every': self.metrics_every,
+          'dtype': np.dtype(self.dtype).name if self.dtype is not None else None,
+          'loss_scale': self.loss_scale,
+          'val_metric': self.val_metric,
+          'num_train_samples': self.num_train_samples,
+          'num_val_samples': self.num_val_samples,
+          'eval_workers': self.eval_workers,
+        }
+        _, rng_keys, rng_pos, rng_has_gauss, rng_gauss = np.random.get_state()
+        meta = {
+          'options': options,
+          'model_flat': getattr(self.model, 'flat', None) is not None,
+          'iteration': self.iteration,
+          'best_val_acc': self.best_val_acc,
+          'train_acc_history': self.train_acc_history,
+          'val_acc_history': self.val_acc_history,
+          'val_metrics_history': self.val_metrics_history,
+          'rng_state': [int(rng_pos), int(rng_has_gauss), float(rng_gauss)],
+        }
+        if self.scaler is not None:
+            meta['scaler'] = [self.scaler.scale, self.scaler.good_steps, self.scaler.skipped_steps]
+        extra_arrays = {
+          'model': model_skeleton(self.model),
+          'rng_keys': rng_keys,
+        }
+        if self.verbose:
+            print('Saving checkpoint to "%s_epoch_%d.npz"' % (self.checkpoint_name, self.epoch))
+        self.checkpointer.save(self.epoch, self.model.params, self.optim_configs,
+                               self.loss_history, meta,
+                               best_params=self.best_params,
+                               master_params=self.master.params if self.master is not None else None,
+                               extra_arrays=extra_arrays)
+
+
+    @classmethod
+    def from_checkpoint(cls, path, data, model=None, **kwargs):
+        """
+        Construct a CaptioningSolver that continues training exactly where the
+        CaptioningSolver that wrote a checkpoint stopped: parameters, update
+        rule state, random number generator, epoch and iteration counters and
+        histories are all restored.
+
+        Inputs:
+        - path: Path of a checkpoint file, or a checkpoint prefix (the
+          checkpoint_name of the original solver), in which case the newest
+          checkpoint with that prefix is used.
+        - data: A dictionary of training and validation data from
+          load_coco_data.
+        - model: Optional model object to load the parameters into, for
+          example to warm-start a model built in code. By default the model
+          stored in the checkpoint is used.
+        - kwargs: Optional arguments of the constructor; they override the ones
+          stored in the checkpoint, for example num_epochs to train for longer.
 
+        Returns:
+        - solver: A new CaptioningSolver instance; call train() to continue
+          training.
+        """
+        if not path.endswith('.npz'):
+            prefix, path = path, latest_checkpoint(path)
+            if path is None:
+                raise ValueError('No checkpoint found for "%s"' % prefix)
+        ckpt = load_checkpoint(path)
+        meta = ckpt['meta']
+
+        if model is None:
+            model = ckpt['extra']['model']
+        model = restore_model(model, ckpt['params'], flat=meta['model_flat'])
 
-    # TODO: This does nothing right now; maybe implement BLEU?
-    def check_accuracy(self, X, y, num_samples=None, batch_size=100):
+        options = dict(meta['options'])
+        options.update(kwargs)
+        solver = cls(model, data, **options)
+        solver._restore(ckpt)
+        return solver
+
+
+    def _restore(self, ckpt):
+        """
+        Restore the training state from a loaded checkpoint. Don't call this
+        manually; use from_checkpoint.
         """
-        Check accuracy of the model on the provided data.
+        meta = ckpt['meta']
+        for key, config in ckpt['optim_configs'].items():
+            if key not in self.optim_configs:
+                raise ValueError('Optimizer state "%s" does not match the model' % key)
+            self.optim_configs[key] = config
+        if self.master is not None and ckpt['master_params']:
+            self.master.load(ckpt['master_params'])
+        if self.scaler is not None and 'scaler' in meta:
+            self.scaler.scale, self.scaler.good_steps, self.scaler.skipped_steps = meta['scaler']
+
+        self.epoch = meta['epoch']
+        self.iteration = meta['iteration']
+        self.best_val_acc = meta['best_val_acc']
+        self.best_params = ckpt['best_params']
+        self.loss_history = ckpt['loss_history']
+        self.train_acc_history = meta['train_acc_history']
+        self.val_acc_history = meta['val_acc_history']
+        self.val_metrics_history = meta.get('val_metrics_history', [])
+        if self.checkpointer is not None:
+            self.checkpointer.resume(meta['epoch'], len(self.loss_history))
+
+        rng_pos, rng_has_gauss, rng_gauss = meta['rng_state']
+        np.random.set_state(('MT19937', ckpt['extra']['rng_keys'], rng_pos,
+                             rng_has_gauss, rng_gauss))
+
+
+    def check_accuracy(self, split='val', num_samples=None, batch_size=1000):
+        """
+        Check the captions the model samples for the images of a split against
+        their reference captions.
 
         Inputs:
-        - X: Array of data, of shape (N, d_1, ..., d_k)
-        - y: Array of labels, of shape (N,)
-        - num_samples: If not None, subsample the data and only test the model
-          on num_samples datapoints.
-        - batch_size: Split X and y into batches of this size to avoid using too
-          much memory.
+        - split: Either 'train' or 'val'.
+        - num_samples: If not None, only caption this many randomly chosen
+          images of the split.
+        - batch_size: Number of images captioned per call to model.sample.
 
-        Returns:
-        - acc: Scalar giving the fraction of instances that were correctly
-          classified by the model.
-        """
-        return 0.0
-
-        # Maybe subsample the data
-        N = X.shape[0]
-        if num_samples is not None and N > num_samples:
-            mask = np.random.choice(N, num_samples)
-            N = num_samples
-            X = X[mask]
-            y = y[mask]
-
-        # Compute predictions in batches
-        num_batches = N / batch_size
-        if N % batch_size != 0:
-            num_batches += 1
-        y_pred = []
-        for i in range(num_batches):
-            start = i * batch_size
-            end = (i + 1) * batch_size
-            scores = self.model.loss(X[start:end])
-            y_pred.append(np.argmax(scores, axis=1))
-        y_pred = np.hstack(y_pred)
-        acc = np.mean(y_pred == y)
-
-        return acc
+        Returns a dictionary mapping the names of the scores of caption_eval.py,
+        such as 'Bleu_4' and 'CIDEr', to their values.
+        """
+        scorer = self.scorers.get(split)
+        if scorer is None:
+            scorer = self.scorers[split] = CaptionScorer(
+                self.data['%s_captions' % split], self.data['%s_image_idxs' % split],
+                self.data['word_to_idx'])
+        return evaluate_captions(self.model, self.data, split, scorer,
+                                 num_samples=num_samples, batch_size=batch_size,
+                                 num_workers=self.eval_workers)
 
 
     def train(self):
         """
-        Run optimization to train the model.
+        Run optimization to train the model. A solver restored with
+        from_checkpoint continues from the iteration it was saved at.
         """
         num_train = self.data['train_captions'].shape[0]
         iterations_per_epoch = max(num_train // self.batch_size, 1)
         num_iterations = self.num_epochs * iterations_per_epoch
 
-        for t in range(num_iterations):
-            self._step()
-
-            # Maybe print training loss
-            if self.verbose and t % self.print_every == 0:
-                print('(Iteration %d / %d) loss: %f' % (
-                       t + 1, num_iterations, self.loss_history[-1]))
-
-            # At the end of every epoch, increment the epoch counter and decay the
-            # learning rate.
-            epoch_end = (t + 1) % iterations_per_epoch == 0
-            if epoch_end:
-                self.epoch += 1
-                for k in self.optim_configs:
-                    self.optim_configs[k]['learning_rate'] *= self.lr_decay
-
-            # Check train and val accuracy on the first iteration, the last
-            # iteration, and at the end of each epoch.
-            # TODO: Implement some logic to check Bleu on validation set periodically
+        try:
+            for t in range(self.iteration, num_iterations):
+                self._step()
+                self.iteration = t + 1
+
+                # Maybe print training loss
+                if self.verbose and t % self.print_every == 0:
+                    print('(Iteration %d / %d) loss: %f' % (
+                           t + 1, num_iterations, self.loss_history[-1]))
+
+                # At the end of every epoch, increment the epoch counter and decay the
+                # learning rate.
+                epoch_end = (t + 1) % iterations_per_epoch == 0
+                if epoch_end:
+                    self.epoch += 1
+                    for k in self.optim_configs:
+                        self.optim_configs[k]['learning_rate'] *= self.lr_decay
+
+                # Check the captions of train and val images at the end of each
+                # epoch and on the last iteration
+                last_it = (t == num_iterations - 1)
+                if self.val_metric is not None and (epoch_end or last_it):
+                    train_acc = self.check_accuracy('train', num_samples=self.num_train_samples)
+                    val_metrics = self.check_accuracy('val', num_samples=self.num_val_samples)
+                    train_acc = train_acc[self.val_metric]
+                    val_acc = val_metrics[self.val_metric]
+                    self.train_acc_history.append(train_acc)
+                    self.val_acc_history.append(val_acc)
+                    self.val_metrics_history.append(val_metrics)
+
+                    if self.verbose:
+                        print('(Epoch %d / %d) train %s: %f; val %s: %f' % (
+                               self.epoch, self.num_epochs, self.val_metric, train_acc,
+                               self.val_metric, val_acc))
+
+                    # Keep track of the best model
+                    if val_acc > self.best_val_acc:
+                        self.best_val_acc = val_acc
+                        self.best_params = {}
+                        for k, v in self.model.params.items():
+                            self.best_params[k] = v.copy()
+
+                if epoch_end:
+                    self._save_checkpoint()
+        finally:
+            if self.checkpointer is not None:
+                self.checkpointer.close()
 
         # At the end of training swap the best params into the model
-        # self.model.params = self.best_params
+        if self.best_params:
+            if self.flat is None:
+                self.model.params = self.best_params
+            else:
+                self.flat.load(self.best_params)
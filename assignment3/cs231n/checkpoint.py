@@ -0,0 +1,388 @@
+from __future__ import print_function, division
+from builtins import range
+from builtins import object
+import copy
+import glob
+import json
+import os
+import pickle
+import re
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+
+from cs231n.flat_params import FlatParams
+
+"""
+This file implements checkpointing for the solvers. A checkpoint holds the
+parameters of a model, the state of every update rule and the book-keeping
+needed to continue training, and is written as a single .npz file:
+
+- 'param/<name>': value of parameter <name>
+- 'optim/<key>/<name>': array <name> in the optim config <key>
+- 'best/<name>': best parameters seen so far, if any
+- 'master/<name>': float32 master copy of parameter <name>, if any
+- 'bn/<i>/<name>': array <name> in the i-th batchnorm parameter dictionary
+- 'extra/<name>': any other array the solver needs, such as the model itself
+  without its parameters (see model_skeleton) and the state of the RNG
+- 'meta': JSON encoded dictionary of scalars, lists and strings
+
+Snapshots are taken synchronously, since training keeps updating the arrays in
+place, but writing them to disk happens on a background thread. Each
+file is written under a temporary name and renamed into place, so a crash never
+leaves a truncated checkpoint behind, and only the newest keep_last checkpoints
+written by the run are kept on disk. Checkpoints that an earlier run left under
+the same prefix, other than the ones a resumed run started from, are removed
+when the first checkpoint is written, since the loss history file they refer
+to is overwritten.
+
+The loss history, which grows with every iteration, is not stored in the
+checkpoints. It is appended as raw float64 values to a single file
+<prefix>_loss_history.bin, writing only the values added since the previous
+checkpoint.
+"""
+
+
+def _split_config(config):
+    """
+    Split an optim config into arrays and JSON serializable values; the scratch
+    buffers of the update rules are dropped, since they are rebuilt on demand.
+    """
+    arrays, values = {}, {}
+    for k, v in config.items():
+        if k == 'scratch':
+            continue
+        if isinstance(v, np.ndarray):
+            arrays[k] = v
+        elif isinstance(v, np.generic):
+            values[k] = v.item()
+        else:
+            values[k] = v
+    return arrays, values
+
+
+class Checkpointer(object):
+    """
+    Writes checkpoints for a solver on a background thread.
+
+    Example usage:
+
+    checkpointer = Checkpointer('checkpoints/model', keep_last=3)
+    checkpointer.save(epoch, params, optim_configs, loss_history, meta)
+    ...
+    checkpointer.close()    # waits for all pending writes
+
+    ckpt = load_checkpoint(latest_checkpoint('checkpoints/model'))
+    """
+
+    def __init__(self, prefix, keep_last=3, background=True, history_start=0):
+        """
+        Inputs:
+        - prefix: Path prefix of the checkpoint files; checkpoints are written to
+          <prefix>_epoch_<epoch>.npz.
+        - keep_last: Number of most recent checkpoints of this run to keep on
+          disk, at least 1; None keeps all of them.
+        - background: If True, files are written on a background thread;
+          otherwise save blocks until the checkpoint is on disk.
+        - history_start: Number of loss history values already on disk that
+          belong to this run, for example when resuming from a checkpoint.
+          Values after them are overwritten.
+        """
+        if keep_last is not None and keep_last < 1:
+            raise ValueError('keep_last must be at least 1 or None, got %r' % (keep_last,))
+        self.prefix = prefix
+        self.keep_last = keep_last
+        self.background = background
+        self.history_path = prefix + '_loss_history.bin'
+        self.history_len = history_start
+        self.error = None
+
+        # Checkpoints of this run, oldest first; other checkpoints with the
+        # prefix are removed by the first write
+        self.paths = []
+        self.removed_stale = False
+
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = None
+
+
+    def resume(self, epoch, history_len):
+        """
+        Continue a run from its checkpoint of the given epoch: the checkpoints
+        with the prefix up to that epoch become part of this run, and the loss
+        history is continued after its first history_len values.
+        """
+        self.history_len = history_len
+        self.paths = [path for e, path in _checkpoint_epochs(self.prefix) if e <= epoch]
+
+
+    def save(self, epoch, params, optim_configs, loss_history, meta,
+             best_params=None, master_params=None, bn_params=None,
+             extra_arrays=None):
+        """
+        Take a snapshot of the training state and write it as a checkpoint.
+
+        Inputs:
+        - epoch: Epoch number; used in the file name.
+        - params: Dictionary mapping parameter names to arrays.
+        - optim_configs: Dictionary mapping keys (parameter names, or 'flat')
+          to the optim config of the update rule.
+        - loss_history: List of all losses so far; only the values added since
+          the last checkpoint are written.
+        - meta: Dictionary of JSON serializable values.
+        - best_params: Optional dictionary of the best parameters so far.
+        - master_params: Optional dictionary of float32 master parameters.
+        - bn_params: Optional list of batchnorm parameter dictionaries.
+        - extra_arrays: Optional dictionary of other arrays to store.
+        """
+        self._raise_error()
+
+        arrays = {}
+        for k, v in params.items():
+            arrays['param/' + k] = np.array(v)
+        configs = {}
+        for key, config in optim_configs.items():
+            config_arrays, configs[key] = _split_config(config)
+            for k, v in config_arrays.items():
+                arrays['optim/%s/%s' % (key, k)] = v.copy()
+        for k, v in (best_params or {}).items():
+            arrays['best/' + k] = np.array(v)
+        for k, v in (master_params or {}).items():
+            arrays['master/' + k] = np.array(v)
+        for i, bn_param in enumerate(bn_params or []):
+            for k, v in bn_param.items():
+                if isinstance(v, np.ndarray):
+                    arrays['bn/%d/%s' % (i, k)] = v.copy()
+        for k, v in (extra_arrays or {}).items():
+            arrays['extra/' + k] = np.array(v)
+
+        meta = dict(meta)
+        meta['epoch'] = epoch
+        meta['optim_configs'] = configs
+        meta['num_bn_params'] = len(bn_params or [])
+        meta['loss_history_len'] = len(loss_history)
+        arrays['meta'] = np.array(json.dumps(meta))
+
+        start = self.history_len
+        history = np.array(loss_history[start:], dtype=np.float64)
+        self.history_len = len(loss_history)
+
+        path = '%s_epoch_%d.npz' % (self.prefix, epoch)
+        job = (path, arrays, start, history)
+        if self.background:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.queue.put(job)
+        else:
+            self._write(*job)
+
+
+    def wait(self):
+        """
+        Block until all pending checkpoints are on disk.
+        """
+        self.queue.join()
+        self._raise_error()
+
+
+    def close(self):
+        """
+        Write all pending checkpoints and stop the background thread.
+        """
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        self._raise_error()
+
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                self._write(*job)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+
+    def _write(self, path, arrays, start, history):
+        # Append the new losses, dropping anything written after them by an
+        # earlier run
+        with open(self.history_path, 'ab') as f:
+            f.truncate(start * 8)
+            history.tofile(f)
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+        if path in self.paths:
+            self.paths.remove(path)
+        self.paths.append(path)
+        if not self.removed_stale:
+            for old_path in list_checkpoints(self.prefix):
+                if old_path not in self.paths:
+                    os.remove(old_path)
+            self.removed_stale = True
+        if self.keep_last is not None:
+            while len(self.paths) > self.keep_last:
+                os.remove(self.paths.pop(0))
+
+
+def _checkpoint_epochs(prefix):
+    """
+    Return (epoch, path) pairs of all checkpoints with the given prefix, oldest
+    first.
+    """
+    pattern = re.compile(re.escape(prefix) + r'_epoch_(\d+)\.npz$')
+    paths = []
+    for path in glob.glob(glob.escape(prefix) + '_epoch_*.npz'):
+        match = pattern.match(path)
+        if match:
+            paths.append((int(match.group(1)), path))
+    return sorted(paths)
+
+
+def list_checkpoints(prefix):
+    """
+    Return the paths of all checkpoints with the given prefix, oldest first.
+    """
+    return [path for _, path in _checkpoint_epochs(prefix)]
+
+
+def latest_checkpoint(prefix):
+    """
+    Return the path of the newest checkpoint with the given prefix, or None.
+    """
+    paths = list_checkpoints(prefix)
+    return paths[-1] if paths else None
+
+
+def load_checkpoint(path):
+    """
+    Load a checkpoint written by Checkpointer.
+
+    Returns a dictionary with keys:
+    - 'params': Dictionary of parameters
+    - 'optim_configs': Dictionary of optim configs, arrays included
+    - 'best_params': Dictionary of best parameters; may be empty
+    - 'master_params': Dictionary of master parameters; may be empty
+    - 'bn_params': List of dictionaries with the batchnorm arrays
+    - 'extra': Dictionary of the extra arrays
+    - 'loss_history': List of all losses up to the checkpoint
+    - 'meta': The remaining values passed to Checkpointer.save
+    """
+    with np.load(path) as f:
+        arrays = {k: f[k] for k in f.files}
+    meta = json.loads(str(arrays.pop('meta')))
+
+    ckpt = {
+      'params': {},
+      'optim_configs': meta.pop('optim_configs'),
+      'best_params': {},
+      'master_params': {},
+      'bn_params': [{} for i in range(meta.pop('num_bn_params'))],
+      'extra': {},
+      'meta': meta,
+    }
+    for name, v in arrays.items():
+        kind, rest = name.split('/', 1)
+        if kind == 'param':
+            ckpt['params'][rest] = v
+        elif kind == 'best':
+            ckpt['best_params'][rest] = v
+        elif kind == 'master':
+            ckpt['master_params'][rest] = v
+        elif kind == 'optim':
+            key, k = rest.rsplit('/', 1)
+            ckpt['optim_configs'][key][k] = v
+        elif kind == 'bn':
+            i, k = rest.split('/', 1)
+            ckpt['bn_params'][int(i)][k] = v
+        elif kind == 'extra':
+            ckpt['extra'][rest] = v
+
+    # The history file may hold losses from after this checkpoint
+    prefix = re.sub(r'_epoch_\d+\.npz$', '', path)
+    history_len = meta.pop('loss_history_len')
+    history = np.fromfile(prefix + '_loss_history.bin', dtype=np.float64,
+                          count=history_len)
+    if len(history) < history_len:
+        raise ValueError('Loss history of "%s" is missing values' % path)
+    ckpt['loss_history'] = history.tolist()
+
+    return ckpt
+
+
+def pickle_array(obj):
+    """
+    Pickle an object into a uint8 array, so that it can be stored in a
+    checkpoint as one of the extra arrays.
+    """
+    return np.frombuffer(pickle.dumps(obj, protocol=2), dtype=np.uint8)
+
+
+def unpickle_array(a):
+    """
+    Inverse of pickle_array.
+    """
+    return pickle.loads(a.tobytes())
+
+
+def model_skeleton(model):
+    """
+    Serialize a model without its parameters, so that it can be stored in a
+    checkpoint next to them; see restore_model.
+
+    Returns a uint8 array holding the pickled model.
+    """
+    skeleton = copy.copy(model)
+    skeleton.params = {}
+    for attr in ('flat', 'folded_params'):
+        if hasattr(skeleton, attr):
+            setattr(skeleton, attr, None)
+    return pickle_array(skeleton)
+
+
+def restore_model(model, params, flat=False):
+    """
+    Load parameters from a checkpoint into a model.
+
+    Inputs:
+    - model: Either a model object, or an array from model_skeleton.
+    - params: Dictionary of parameters.
+    - flat: If True and the model has no flat parameter buffer yet, give it
+      one, as models constructed with flat_params=True have.
+
+    Returns the model.
+    """
+    if isinstance(model, np.ndarray):
+        model = unpickle_array(model)
+    if getattr(model, 'flat', None) is not None:
+        model.flat.load(params)
+    elif flat:
+        model.flat = FlatParams(params, getattr(model, 'dtype', None))
+        model.params = model.flat.params
+    else:
+        for k, v in params.items():
+            model.params[k] = v.copy()
+    return model
@@ -7,8 +7,19 @@ from cs231n.layer_utils import *
 
 
 class PretrainedCNN(object):
-  def __init__(self, dtype=np.float32, num_classes=100, input_size=64, h5_file=None):
+  def __init__(self, dtype=np.float32, num_classes=100, input_size=64, h5_file=None,
+               checkpoints=None):
+    """
+    Inputs:
+    - dtype: numpy datatype to use for computation.
+    - num_classes: Number of class scores.
+    - input_size: Height and width of the input images.
+    - h5_file: If not None, path of an HDF5 file to load pretrained weights from.
+    - checkpoints: Default layer boundaries at which training-mode forward passes
+      keep activations; see forward. None keeps every layer cache.
+    """
     self.dtype = dtype
+    self.checkpoints = checkpoints
     self.conv_params = []
     self.input_size = input_size
     self.num_classes = num_classes
@@ -30,6 +41,7 @@ class PretrainedCNN(object):
     hidden_dim = 512
 
     self.bn_params = []
+    self.folded_params = None
     
     cur_size = input_size
     prev_dim = 3
@@ -101,8 +113,112 @@ class PretrainedCNN(object):
     for k, v in self.params.items():
       self.params[k] = v.astype(self.dtype)
 
+
+  def fold_batchnorm(self):
+    """
+    Fold every batchnorm layer into the conv or affine layer that feeds it.
+
+    After this is called, test-mode passes through forward run [conv - relu] and
+    [affine - relu] blocks on the folded weights and skip batchnorm entirely.
+    Running the model in training mode discards the folded weights, since they
+    go stale as soon as the parameters change.
+    """
+    folded = {}
+    for i in range(len(self.conv_params) + 1):
+      i1 = i + 1
+      w, b = self.params['W%d' % i1], self.params['b%d' % i1]
+      gamma, beta = self.params['gamma%d' % i1], self.params['beta%d' % i1]
+      folded['W%d' % i1], folded['b%d' % i1] = batchnorm_fold(w, b, gamma, beta, self.bn_params[i])
+    self.folded_params = folded
+
   
-  def forward(self, X, start=None, end=None, mode='test'):
+  def _segments(self, start, end, checkpoints):
+    """
+    Return the first layer of every segment of layers start to end, given
+    checkpoints as in forward.
+    """
+    if checkpoints is None:
+      return [start]
+    if isinstance(checkpoints, int):
+      if checkpoints < 1:
+        raise ValueError('checkpoints must be a positive number of layers')
+      return list(range(start, end + 1, checkpoints))
+    return sorted(set([start] + [i for i in checkpoints if start < i <= end]))
+
+
+  def _layer_forward(self, i, prev_a, mode, folded, bn_param=None):
+    """
+    Run layer i forward; bn_param overrides self.bn_params[i].
+    """
+    i1 = i + 1
+    if 0 <= i < len(self.conv_params):
+      # This is a conv layer
+      w, b = self.params['W%d' % i1], self.params['b%d' % i1]
+      gamma, beta = self.params['gamma%d' % i1], self.params['beta%d' % i1]
+      conv_param = self.conv_params[i]
+      if bn_param is None:
+        bn_param = self.bn_params[i]
+      bn_param['mode'] = mode
+
+      if folded:
+        w, b = self.folded_params['W%d' % i1], self.folded_params['b%d' % i1]
+        return conv_relu_forward(prev_a, w, b, conv_param)
+      return conv_bn_relu_forward(prev_a, w, b, gamma, beta, conv_param, bn_param)
+    elif i == len(self.conv_params):
+      # This is the fully-connected hidden layer
+      w, b = self.params['W%d' % i1], self.params['b%d' % i1]
+      gamma, beta = self.params['gamma%d' % i1], self.params['beta%d' % i1]
+      if bn_param is None:
+        bn_param = self.bn_params[i]
+      bn_param['mode'] = mode
+      if folded:
+        w, b = self.folded_params['W%d' % i1], self.folded_params['b%d' % i1]
+        return affine_relu_forward(prev_a, w, b)
+      return affine_bn_relu_forward(prev_a, w, b, gamma, beta, bn_param)
+    elif i == len(self.conv_params) + 1:
+      # This is the last fully-connected layer that produces scores
+      w, b = self.params['W%d' % i1], self.params['b%d' % i1]
+      return affine_forward(prev_a, w, b)
+    else:
+      raise ValueError('Invalid layer index %d' % i)
+
+
+  def _layer_backward(self, i, dnext_a, cache, folded, grads):
+    """
+    Run layer i backward, storing its parameter gradients in grads.
+    """
+    i1 = i + 1
+    if i == len(self.conv_params) + 1:
+      # This is the last fully-connected layer
+      dprev_a, dw, db = affine_backward(dnext_a, cache)
+      grads['W%d' % i1] = dw
+      grads['b%d' % i1] = db
+    elif i == len(self.conv_params) and folded:
+      dprev_a, _, _ = affine_relu_backward(dnext_a, cache)
+    elif i == len(self.conv_params):
+      # This is the fully-connected hidden layer
+      temp = affine_bn_relu_backward(dnext_a, cache)
+      dprev_a, dw, db, dgamma, dbeta = temp
+      grads['W%d' % i1] = dw
+      grads['b%d' % i1] = db
+      grads['gamma%d' % i1] = dgamma
+      grads['beta%d' % i1] = dbeta
+    elif 0 <= i < len(self.conv_params) and folded:
+      dprev_a, _, _ = conv_relu_backward(dnext_a, cache)
+    elif 0 <= i < len(self.conv_params):
+      # This is a conv layer
+      temp = conv_bn_relu_backward(dnext_a, cache)
+      dprev_a, dw, db, dgamma, dbeta = temp
+      grads['W%d' % i1] = dw
+      grads['b%d' % i1] = db
+      grads['gamma%d' % i1] = dgamma
+      grads['beta%d' % i1] = dbeta
+    else:
+      raise ValueError('Invalid layer index %d' % i)
+    return dprev_a
+
+
+  def forward(self, X, start=None, end=None, mode='test', checkpoints=None):
     """
     Run part of the model forward, starting and ending at an arbitrary layer,
     in either training mode or testing mode.
@@ -126,6 +242,14 @@ class PretrainedCNN(object):
       fully-connected layer, returning class scores. Default is 11.
     - mode: The mode to use, either 'test' or 'train'. We need this because
       batch normalization behaves differently at training time and test time.
+      If fold_batchnorm has been called, test mode skips batchnorm and uses the
+      folded weights instead.
+    - checkpoints: Gradient checkpointing for training mode. Either a number k,
+      to keep the activations every k layers, or a list of layer indices whose
+      inputs are kept. Only those activations are stored, and every segment
+      of layers between them is run forward again by backward, which costs
+      about one more forward pass but only needs the caches of one segment at
+      a time. Defaults to self.checkpoints; None keeps every layer cache.
 
     Returns:
     - out: Output from the end layer.
@@ -135,39 +259,32 @@ class PretrainedCNN(object):
     X = X.astype(self.dtype)
     if start is None: start = 0
     if end is None: end = len(self.conv_params) + 1
-    layer_caches = []
+    if checkpoints is None: checkpoints = self.checkpoints
 
-    prev_a = X
-    for i in range(start, end + 1):
-      i1 = i + 1
-      if 0 <= i < len(self.conv_params):
-        # This is a conv layer
-        w, b = self.params['W%d' % i1], self.params['b%d' % i1]
-        gamma, beta = self.params['gamma%d' % i1], self.params['beta%d' % i1]
-        conv_param = self.conv_params[i]
-        bn_param = self.bn_params[i]
-        bn_param['mode'] = mode
+    # Folded weights are only valid for the parameters they were built from
+    if mode == 'train':
+      self.folded_params = None
+    folded = self.folded_params is not None
 
-        next_a, cache = conv_bn_relu_forward(prev_a, w, b, gamma, beta, conv_param, bn_param)
-      elif i == len(self.conv_params):
-        # This is the fully-connected hidden layer
-        w, b = self.params['W%d' % i1], self.params['b%d' % i1]
-        gamma, beta = self.params['gamma%d' % i1], self.params['beta%d' % i1]
-        bn_param = self.bn_params[i]
-        bn_param['mode'] = mode
-        next_a, cache = affine_bn_relu_forward(prev_a, w, b, gamma, beta, bn_param)
-      elif i == len(self.conv_params) + 1:
-        # This is the last fully-connected layer that produces scores
-        w, b = self.params['W%d' % i1], self.params['b%d' % i1]
-        next_a, cache = affine_forward(prev_a, w, b)
+    # Every segment but the last keeps only its input; the caches of the last
+    # segment are needed right away by backward, so they are kept
+    segment_starts = self._segments(start, end, checkpoints if mode == 'train' else None)
+    segments = []
+    prev_a = X
+    for s, next_s in zip(segment_starts, segment_starts[1:] + [end + 1]):
+      if next_s <= end:
+        segments.append((s, next_s - 1, prev_a, None))
+        for i in range(s, next_s):
+          prev_a, _ = self._layer_forward(i, prev_a, mode, folded)
       else:
-        raise ValueError('Invalid layer index %d' % i)
-
-      layer_caches.append(cache)
-      prev_a = next_a
+        layer_caches = []
+        for i in range(s, next_s):
+          prev_a, cache = self._layer_forward(i, prev_a, mode, folded)
+          layer_caches.append(cache)
+        segments.append((s, next_s - 1, None, layer_caches))
 
     out = prev_a
-    cache = (start, end, layer_caches)
+    cache = (start, end, segments, folded, mode)
     return out, cache
 
 
@@ -190,36 +307,29 @@ class PretrainedCNN(object):
       biases, and spatial batchnorm parameters of those two convolutional
       layers. The grads dictionary will therefore contain a subset of the keys
       of self.params, and grads[k] and self.params[k] will have the same shape.
+      If the forward pass ran on folded batchnorm weights, only the final
+      affine layer has parameter gradients; dX is still exact.
     """
-    start, end, layer_caches = cache
+    start, end, segments, folded, mode = cache
     dnext_a = dout
     grads = {}
-    for i in reversed(range(start, end + 1)):
-      i1 = i + 1
-      if i == len(self.conv_params) + 1:
-        # This is the last fully-connected layer
-        dprev_a, dw, db = affine_backward(dnext_a, layer_caches.pop())
-        grads['W%d' % i1] = dw
-        grads['b%d' % i1] = db
-      elif i == len(self.conv_params):
-        # This is the fully-connected hidden layer
-        temp = affine_bn_relu_backward(dnext_a, layer_caches.pop())
-        dprev_a, dw, db, dgamma, dbeta = temp
-        grads['W%d' % i1] = dw
-        grads['b%d' % i1] = db
-        grads['gamma%d' % i1] = dgamma
-        grads['beta%d' % i1] = dbeta
-      elif 0 <= i < len(self.conv_params):
-        # This is a conv layer
-        temp = conv_bn_relu_backward(dnext_a, layer_caches.pop())
-        dprev_a, dw, db, dgamma, dbeta = temp
-        grads['W%d' % i1] = dw
-        grads['b%d' % i1] = db
-        grads['gamma%d' % i1] = dgamma
-        grads['beta%d' % i1] = dbeta
-      else:
-        raise ValueError('Invalid layer index %d' % i)
-      dnext_a = dprev_a
+    while segments:
+      s, e, x, layer_caches = segments.pop()
+      if layer_caches is None:
+        # Run the segment forward again from its checkpoint. The running
+        # averages of batchnorm were already updated by the first forward pass,
+        # so the recomputation updates a copy of them
+        layer_caches = []
+        for i in range(s, e + 1):
+          bn_param = None
+          if i < len(self.bn_params):
+            bn_param = {k: v.copy() if isinstance(v, np.ndarray) else v
+                        for k, v in self.bn_params[i].items()}
+          x, layer_cache = self._layer_forward(i, x, mode, folded, bn_param)
+          layer_caches.append(layer_cache)
+        x = None
+      for i in reversed(range(s, e + 1)):
+        dnext_a = self._layer_backward(i, dnext_a, layer_caches.pop(), folded, grads)
 
     dX = dnext_a
     return dX, grads
@@ -4,6 +4,7 @@ import numpy as np
 
 from cs231n.layers import *
 from cs231n.rnn_layers import *
+from cs231n.flat_params import FlatParams
 
 
 class CaptioningRNN(object):
@@ -19,7 +20,9 @@ class CaptioningRNN(object):
     """
 
     def __init__(self, word_to_idx, input_dim=512, wordvec_dim=128,
-                 hidden_dim=128, cell_type='rnn', dtype=np.float32):
+                 hidden_dim=128, cell_type='rnn', dtype=np.float32,
+                 flat_params=False, num_sampled=0, sampling_probs=None,
+                 sparse_embedding=False, sparse_vocab=False, bptt_window=None):
         """
         Construct a new CaptioningRNN instance.
 
@@ -32,12 +35,39 @@ class CaptioningRNN(object):
         - cell_type: What type of RNN to use; either 'rnn' or 'lstm'.
         - dtype: numpy datatype to use; use float32 for training and float64 for
           numeric gradient checking.
+        - flat_params: If True, every entry of self.params is a view into one
+          contiguous buffer of this dtype, self.flat.data, and loss writes the
+          gradients into the matching buffer self.flat.grad.
+        - num_sampled: If positive, the training loss scores only the
+          ground-truth word and this many sampled words at every timestep
+          instead of the whole vocabulary; see temporal_sampled_softmax_loss.
+          Sampling captions always uses the full vocabulary.
+        - sampling_probs: Optional array of shape (V,) giving the distribution
+          words are sampled from for the sampled loss, for example from
+          word_sampling_probs in coco_utils.py; uniform by default.
+        - sparse_embedding: If True, loss returns the gradient of W_embed as a
+          RowSparseGrad holding only the rows of the words in the minibatch,
+          which the update rules in optim.py apply without touching the other
+          rows. With flat parameters or a reduced precision solver it is copied
+          into a dense gradient.
+        - sparse_vocab: If True and num_sampled is positive, loss likewise
+          returns the gradient of W_vocab as a RowSparseGrad holding only the
+          columns of the ground-truth and sampled words.
+        - bptt_window: If not None, loss runs the RNN over windows of this many
+          timesteps with truncated backpropagation through time (see
+          truncated_bptt_loss), so that the caches and scores of only one
+          window are kept at a time. Gradients do not flow between windows.
         """
         if cell_type not in {'rnn', 'lstm'}:
             raise ValueError('Invalid cell_type "%s"' % cell_type)
 
         self.cell_type = cell_type
         self.dtype = dtype
+        self.num_sampled = num_sampled
+        self.sampling_probs = sampling_probs
+        self.sparse_embedding = sparse_embedding
+        self.sparse_vocab = sparse_vocab
+        self.bptt_window = bptt_window
         self.word_to_idx = word_to_idx
         self.idx_to_word = {i: w for w, i in word_to_idx.items()}
         self.params = {}
@@ -74,8 +104,13 @@ class CaptioningRNN(object):
         for k, v in self.params.items():
             self.params[k] = v.astype(self.dtype)
 
+        self.flat = None
+        if flat_params:
+            self.flat = FlatParams(self.params, self.dtype)
+            self.params = self.flat.params
 
-    def loss(self, features, captions):
+
+    def loss(self, features, captions, sampled=True):
         """
         Compute training-time loss for the RNN. We input image features and
         ground-truth captions for those images, and use an RNN (or LSTM) to compute
@@ -85,6 +120,9 @@ class CaptioningRNN(object):
         - features: Input image features, of shape (N, D)
         - captions: Ground-truth captions; an integer array of shape (N, T) where
           each element is in the range 0 <= y[i, t] < V
+        - sampled: If False, use the full softmax loss even if the model was
+          constructed with num_sampled, for example to compare validation
+          losses.
 
         Returns a tuple of:
         - loss: Scalar loss
@@ -102,6 +140,18 @@ class CaptioningRNN(object):
         # You'll need this
         mask = (captions_out != self._null)
 
+        # Sort the captions by decreasing length (up to their last word that is
+        # not <NULL>) and drop the timesteps that are padding for all of them, so
+        # that the RNN only runs each caption for as many steps as it has words;
+        # the loss and gradients do not change
+        lengths = np.where(mask.any(axis=1), mask.shape[1] - np.argmax(mask[:, ::-1], axis=1), 0)
+        order = np.argsort(-lengths, kind='stable')
+        if np.any(order != np.arange(len(order))):
+            features, lengths = features[order], lengths[order]
+            captions_in, captions_out, mask = captions_in[order], captions_out[order], mask[order]
+        T = max(lengths.max(), 1)
+        captions_in, captions_out, mask = captions_in[:, :T], captions_out[:, :T], mask[:, :T]
+
         # Weight and bias for the affine transform from image features to initial
         # hidden state
         W_proj, b_proj = self.params['W_proj'], self.params['b_proj']
@@ -143,32 +193,69 @@ class CaptioningRNN(object):
         h0, cache_affine                      = affine_forward(features,W_proj,b_proj)
         # (2)
         vectors_captions_in, cache_word_embed = word_embedding_forward(captions_in, W_embed)
+        use_sampled = sampled and self.num_sampled > 0
+        if self.bptt_window is not None and T > self.bptt_window:
+            # (3), (4) y (5) por ventanas; la pérdida de cada ventana calcula los
+            # scores de sus pasos y acumula los gradientes de W_vocab y b_vocab
+            grads['W_vocab'], grads['b_vocab'] = np.zeros_like(W_vocab), np.zeros_like(b_vocab)
+            def window_loss(start, h):
+                stop = start + h.shape[1]
+                y, m = captions_out[:, start:stop], mask[:, start:stop]
+                if use_sampled:
+                    loss, dh, dW_vocab, db_vocab = temporal_sampled_softmax_loss(
+                        h, W_vocab, b_vocab, y, m, self.num_sampled, self.sampling_probs)
+                else:
+                    scores, cache_temporal = temporal_affine_forward(h, W_vocab, b_vocab)
+                    loss, dx = temporal_softmax_loss(scores, y, m)
+                    dh, dW_vocab, db_vocab = temporal_affine_backward(dx, cache_temporal)
+                grads['W_vocab'] += dW_vocab
+                grads['b_vocab'] += db_vocab
+                return loss, dh
+
+            loss, dx, dh0, grads['Wx'], grads['Wh'], grads['b'], _, _ = truncated_bptt_loss(
+                vectors_captions_in, h0, Wx, Wh, b, window_loss, self.bptt_window,
+                self.cell_type, lengths)
+            grads['W_embed']                      = word_embedding_backward(dx, cache_word_embed, self.sparse_embedding)
+            dx, grads['W_proj'], grads['b_proj']  = affine_backward(dh0, cache_affine)
+            if self.flat is not None:
+                self.flat.pack_grads(grads)
+            return loss, grads
+
         # (3)
         if self.cell_type == 'rnn':
-            h, cache_rnn                      = rnn_forward(vectors_captions_in, h0, Wx, Wh, b)
+            h, cache_rnn                      = rnn_forward(vectors_captions_in, h0, Wx, Wh, b, lengths)
         else:
-            h, cache_lstm                     = lstm_forward(vectors_captions_in, h0, Wx, Wh, b)
-        # (4)
-        scores, cache_temporal                = temporal_affine_forward(h, W_vocab, b_vocab)
-        # (5)
-        loss, dx                              = temporal_softmax_loss(scores, captions_out, mask)
+            h, cache_lstm                     = lstm_forward(vectors_captions_in, h0, Wx, Wh, b, lengths)
+        # (4) y (5); con softmax muestreado se calculan solo los scores de las
+        # palabras correctas y de las muestreadas, junto con sus gradientes
+        if use_sampled:
+            loss, dh, grads['W_vocab'], grads['b_vocab'] = temporal_sampled_softmax_loss(
+                h, W_vocab, b_vocab, captions_out, mask, self.num_sampled, self.sampling_probs,
+                self.sparse_vocab)
+        else:
+            scores, cache_temporal            = temporal_affine_forward(h, W_vocab, b_vocab)
+            loss, dx                          = temporal_softmax_loss(scores, captions_out, mask)
 
         # Backward Pass
-        dh, grads['W_vocab'], grads['b_vocab']            = temporal_affine_backward(dx, cache_temporal)
+        if not use_sampled:
+            dh, grads['W_vocab'], grads['b_vocab']        = temporal_affine_backward(dx, cache_temporal)
         if self.cell_type == 'rnn':
             dx, dh0, grads['Wx'], grads['Wh'], grads['b'] = rnn_backward(dh, cache_rnn)
         else:
             dx, dh0, grads['Wx'], grads['Wh'], grads['b'] = lstm_backward(dh, cache_lstm)
-        grads['W_embed']                                  = word_embedding_backward(dx, cache_word_embed)
+        grads['W_embed']                                  = word_embedding_backward(dx, cache_word_embed, self.sparse_embedding)
         dx, grads['W_proj'], grads['b_proj']              = affine_backward(dh0, cache_affine)
         ############################################################################
         #                             END OF YOUR CODE                             #
         ############################################################################
 
+        if self.flat is not None:
+            self.flat.pack_grads(grads)
+
         return loss, grads
 
 
-    def sample(self, features, max_length=30):
+    def sample(self, features, max_length=30, beam_size=1, length_penalty=0.0):
         """
         Run a test-time forward pass for the model, sampling captions for input
         feature vectors.
@@ -183,14 +270,27 @@ class CaptioningRNN(object):
         For LSTMs you will also have to keep track of the cell state; in that case
         the initial cell state should be zero.
 
+        With beam_size k > 1 this is a beam search: the k most likely partial
+        captions of every image are kept at each timestep, and the caption with
+        the best score among those that emitted <END> (or reached max_length)
+        is returned. The score of a caption of L words, counting <END>, is its
+        log-probability divided by ((5 + L) / 6) ** length_penalty, so a
+        positive length_penalty favours longer captions. Images stop decoding,
+        and are removed from the batch, as soon as no remaining partial caption
+        can beat their best finished one; beam_size=1 and length_penalty=0 is
+        greedy decoding.
+
         Inputs:
         - features: Array of input image features of shape (N, D).
         - max_length: Maximum length T of generated captions.
+        - beam_size: Number k of partial captions kept for each image.
+        - length_penalty: Exponent of the length normalization of the scores.
 
         Returns:
         - captions: Array of shape (N, max_length) giving sampled captions,
           where each element is an integer in the range [0, V). The first element
           of captions should be the first sampled word, not the <START> token.
+          Positions after the <END> token are <NULL>.
         """
         N = features.shape[0]
         captions = self._null * np.ones((N, max_length), dtype=np.int32)
@@ -222,36 +322,119 @@ class CaptioningRNN(object):
         # functions; you'll need to call rnn_step_forward or lstm_step_forward in #
         # a loop.                                                                 #
         ###########################################################################
-        # Obtengo dimensiones
-        (N,_) = features.shape
-
-        # Obtengo el estado inicial
-        h, cache_affine  = affine_forward(features, W_proj, b_proj)
-
-        # Inicializo variables
-        sampled_captions = np.zeros((N,1), dtype=np.int32) + self._start
-        c                = np.zeros_like(h) 
-
-        for time_stamp in range(max_length):
-            #(1)
-            word_embed, _ = word_embedding_forward(sampled_captions, W_embed)
-            #(2)
-            word_embed = word_embed.reshape((word_embed.shape[0],word_embed.shape[2]))
-            if(self.cell_type == 'rnn'):
-                h, cache2 = rnn_step_forward(word_embed, h, Wx, Wh, b)
-            else:
-                h, c, cache2 = lstm_step_forward(word_embed, h, c, Wx, Wh, b)
-            #(3)
-            h = h.reshape((h.shape[0],1,h.shape[1]))
-            scores, cache3 = temporal_affine_forward(h, W_vocab, b_vocab)
-            #(4)
-            sampled_captions = np.argmax(scores,axis=2).reshape(-1)
-
-            captions[:,time_stamp] = sampled_captions
-
-            sampled_captions = sampled_captions.reshape((sampled_captions.shape[0],1))
-            h = h.reshape((h.shape[0],h.shape[2]))
+        # Obtengo dimensiones y el estado inicial; cada imagen tiene k hipótesis
+        # (beams), en filas consecutivas
+        k = beam_size
+        V = W_vocab.shape[1]
+        end = self._end if self._end is not None else -1
+        h = np.repeat(features.dot(W_proj) + b_proj, k, axis=0)
+        c = np.zeros_like(h) if self.cell_type == 'lstm' else None
+        words = np.full(N * k, self._start, dtype=np.int32)
+
+        # Log-probabilidad de cada hipótesis; al principio todas son iguales, así
+        # que solo se expande la primera
+        beam_logp = np.full((N, k), -np.inf)
+        beam_logp[:, 0] = 0
+        tokens = np.zeros((N * k, 0), dtype=np.int32)
+
+        # Mejor hipótesis terminada de cada imagen, con su puntaje normalizado
+        images = np.arange(N)
+        best_score = np.full(N, -np.inf)
+        best_tokens = np.full((N, max_length), self._null, dtype=np.int32)
+
+        penalty = lambda L: ((5.0 + L) / 6.0) ** length_penalty
+        for t in range(max_length):
+            n = len(images)
+
+            # (1), (2) y (3) sin armar caches; log-probabilidades de las palabras
+            h, c, scores = self._decode_step(words, h, c)
+            scores -= scores.max(axis=1, keepdims=True)
+            scores -= np.log(np.exp(scores).sum(axis=1, keepdims=True))
+            cand = (beam_logp[:, :, None] + scores.reshape(n, k, V)).reshape(n, k * V)
+
+            # (4) Me quedo con los 2k mejores candidatos de cada imagen; como cada
+            # hipótesis termina con una sola palabra, al menos k de ellos siguen
+            m = min(2 * k, k * V)
+            top = np.argpartition(-cand, m - 1, axis=1)[:, :m]
+            top_score = np.take_along_axis(cand, top, axis=1)
+            order = np.argsort(-top_score, axis=1, kind='stable')
+            top = np.take_along_axis(top, order, axis=1)
+            top_score = np.take_along_axis(top_score, order, axis=1)
+            src = np.arange(n)[:, None] * k + top // V
+            top_word = top % V
+
+            # Los k mejores candidatos que terminan en <END>, o todos en el último
+            # paso, son hipótesis terminadas; guardo la mejor de cada imagen
+            ended = top_word == end
+            finished = (ended & (np.arange(m) < k)) | (t == max_length - 1)
+            norm = np.where(finished, top_score / penalty(t + 1), -np.inf)
+            j = np.argmax(norm, axis=1)
+            better = norm[np.arange(n), j] > best_score
+            if np.any(better):
+                rows = np.flatnonzero(better)
+                best_score[rows] = norm[rows, j[rows]]
+                best_tokens[rows, :t] = tokens[src[rows, j[rows]]]
+                best_tokens[rows, t] = top_word[rows, j[rows]]
+
+            # Las k mejores hipótesis que no terminan en <END> siguen
+            alive = np.argsort(ended, axis=1, kind='stable')[:, :k]
+            beam_logp = np.take_along_axis(top_score, alive, axis=1)
+            src = np.take_along_axis(src, alive, axis=1)
+            words = np.take_along_axis(top_word, alive, axis=1).astype(np.int32)
+
+            # Una imagen termina cuando ninguna hipótesis viva puede superar a la
+            # mejor terminada: la log-probabilidad solo puede bajar, y la divido
+            # por la mayor penalización que puede tener
+            bound = beam_logp.max(axis=1) / max(penalty(t + 2), penalty(max_length))
+            keep = (best_score < bound) & (t < max_length - 1)
+
+            # Saco del batch las imágenes terminadas
+            done = ~keep
+            captions[images[done]] = best_tokens[done]
+            if not np.any(keep):
+                break
+            rows = src[keep].ravel()
+            h = h[rows]
+            if c is not None:
+                c = c[rows]
+            tokens = np.concatenate((tokens[rows], words[keep].reshape(-1, 1)), axis=1)
+            words = words[keep].ravel()
+            beam_logp = beam_logp[keep]
+            images, best_score, best_tokens = images[keep], best_score[keep], best_tokens[keep]
         ############################################################################
         #                             END OF YOUR CODE                             #
         ############################################################################
         return captions
+
+
+    def _decode_step(self, words, h, c):
+        """
+        Run one test-time timestep of the RNN without building caches for the
+        backward pass.
+
+        Inputs:
+        - words: Integer array of shape (N,) giving the previous words.
+        - h: Previous hidden states, of shape (N, H).
+        - c: Previous cell states, of shape (N, H), or None for a vanilla RNN.
+
+        Returns a tuple of:
+        - h: Next hidden states, of shape (N, H)
+        - c: Next cell states, of shape (N, H), or None for a vanilla RNN
+        - scores: Scores of all words of the vocabulary, of shape (N, V)
+        """
+        Wx, Wh, b = self.params['Wx'], self.params['Wh'], self.params['b']
+        a = self.params['W_embed'][words].dot(Wx)
+        a += h.dot(Wh)
+        a += b
+        if self.cell_type == 'rnn':
+            h = np.tanh(a, out=a)
+        else:
+            H = h.shape[1]
+            sigmoid(a[:, :3*H], out=a[:, :3*H])
+            np.tanh(a[:, 3*H:], out=a[:, 3*H:])
+            c = a[:, H:2*H] * c
+            c += a[:, :H] * a[:, 3*H:]
+            h = a[:, 2*H:3*H] * np.tanh(c)
+        scores = h.dot(self.params['W_vocab'])
+        scores += self.params['b_vocab']
+        return h, c, scores
@@ -5,9 +5,122 @@ import h5py
 
 BASE_DIR = 'cs231n/datasets/coco_captioning'
 
+
+class HDF5Rows(object):
+    """
+    Read-only array-like view of the rows of a 2-dimensional HDF5 dataset, which
+    keeps the file open and reads rows only when they are indexed.
+
+    Indexing with an array of row indices reads the rows that are not cached,
+    in increasing order and with one read per HDF5 chunk they fall in, and
+    returns them in the requested order as a numpy array. The most recently
+    used cache_rows rows are kept in memory, so the memory used is bounded
+    whatever the size of the dataset.
+
+    Example usage:
+
+    features = HDF5Rows('train2014_vgg16_fc7.h5', 'features')
+    minibatch = features[image_idxs]
+    """
+
+    def __init__(self, path, name, cache_rows=10000):
+        """
+        Inputs:
+        - path: Path of the HDF5 file.
+        - name: Name of the dataset in the file.
+        - cache_rows: Number of rows to keep cached; 0 disables the cache.
+        """
+        self.path = path
+        self.name = name
+        self.file = h5py.File(path, 'r')
+        self.dset = self.file[name]
+        self.shape = self.dset.shape
+        self.dtype = self.dset.dtype
+        num_rows, dim = self.shape
+
+        # Rows per read: the chunk size of the dataset, or about 1MB for
+        # contiguous datasets
+        if self.dset.chunks is not None:
+            self.chunk_rows = self.dset.chunks[0]
+        else:
+            self.chunk_rows = max(1, 2 ** 20 // max(1, dim * self.dtype.itemsize))
+
+        # The cache is one block of rows; slot_of maps a row to its slot in it,
+        # or -1, and last_used records when each slot was last read, so that
+        # the least recently used slots are the ones replaced
+        self.cache_rows = cache_rows
+        self.cache = np.empty((cache_rows, dim), dtype=self.dtype)
+        self.slot_of = np.full(num_rows, -1, dtype=np.int64)
+        self.row_of = np.full(cache_rows, -1, dtype=np.int64)
+        self.last_used = np.zeros(cache_rows, dtype=np.int64)
+        self.tick = 0
+
+
+    def __len__(self):
+        return self.shape[0]
+
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return self.dset[idx]
+        idx = np.asarray(idx)
+        if idx.dtype == bool:
+            idx = np.flatnonzero(idx)
+        rows, inverse = np.unique(idx.ravel(), return_inverse=True)
+        out = np.empty((len(rows), self.shape[1]), dtype=self.dtype)
+
+        self.tick += 1
+        slots = self.slot_of[rows]
+        hit = slots >= 0
+        out[hit] = self.cache[slots[hit]]
+        self.last_used[slots[hit]] = self.tick
+
+        # Read the missing rows chunk by chunk; rows is sorted, so the reads
+        # move forward through the file
+        missing = np.flatnonzero(~hit)
+        if len(missing) > 0:
+            chunk = rows[missing] // self.chunk_rows
+            bounds = np.flatnonzero(np.diff(chunk)) + 1
+            for group in np.split(missing, bounds):
+                lo, hi = rows[group[0]], rows[group[-1]] + 1
+                out[group] = self.dset[lo:hi][rows[group] - lo]
+            self._cache(rows[missing], out[missing], int(hit.sum()))
+
+        return out[inverse].reshape(idx.shape + (self.shape[1],))
+
+
+    def _cache(self, rows, values, num_hits):
+        # Replace the least recently used slots, but not those read in this call
+        n = min(len(rows), self.cache_rows - num_hits)
+        if n <= 0:
+            return
+        slots = np.argpartition(self.last_used, n - 1)[:n]
+        old = self.row_of[slots]
+        self.slot_of[old[old >= 0]] = -1
+        self.cache[slots] = values[:n]
+        self.row_of[slots] = rows[:n]
+        self.slot_of[rows[:n]] = slots
+        self.last_used[slots] = self.tick
+
+
+    def close(self):
+        self.file.close()
+
+
 def load_coco_data(base_dir=BASE_DIR,
                    max_train=None,
-                   pca_features=True):
+                   pca_features=True,
+                   lazy_features=False,
+                   cache_rows=10000):
+    """
+    Load the COCO captioning data into a dictionary.
+
+    If lazy_features is True, the train and val features are not read into
+    memory; data['train_features'] and data['val_features'] are HDF5Rows
+    objects that read the rows of each minibatch from the open HDF5 files and
+    keep the last cache_rows of them cached. This allows training on the full
+    4096-dimensional features in bounded memory.
+    """
     data = {}
     caption_file = os.path.join(base_dir, 'coco2014_captions.h5')
     with h5py.File(caption_file, 'r') as f:
@@ -18,15 +131,21 @@ def load_coco_data(base_dir=BASE_DIR,
         train_feat_file = os.path.join(base_dir, 'train2014_vgg16_fc7_pca.h5')
     else:
         train_feat_file = os.path.join(base_dir, 'train2014_vgg16_fc7.h5')
-    with h5py.File(train_feat_file, 'r') as f:
-        data['train_features'] = np.asarray(f['features'])
+    if lazy_features:
+        data['train_features'] = HDF5Rows(train_feat_file, 'features', cache_rows)
+    else:
+        with h5py.File(train_feat_file, 'r') as f:
+            data['train_features'] = np.asarray(f['features'])
 
     if pca_features:
         val_feat_file = os.path.join(base_dir, 'val2014_vgg16_fc7_pca.h5')
     else:
         val_feat_file = os.path.join(base_dir, 'val2014_vgg16_fc7.h5')
-    with h5py.File(val_feat_file, 'r') as f:
-        data['val_features'] = np.asarray(f['features'])
+    if lazy_features:
+        data['val_features'] = HDF5Rows(val_feat_file, 'features', cache_rows)
+    else:
+        with h5py.File(val_feat_file, 'r') as f:
+            data['val_features'] = np.asarray(f['features'])
 
     dict_file = os.path.join(base_dir, 'coco2014_vocab.json')
     with open(dict_file, 'r') as f:
@@ -55,30 +174,115 @@ def load_coco_data(base_dir=BASE_DIR,
 
 
 def decode_captions(captions, idx_to_word):
+    """
+    Turn captions of word indices into strings; <NULL> words are dropped and
+    each caption stops after its first <END>.
+
+    The words of all captions are looked up at once with array operations,
+    including finding the first <END> of each caption, and then joined one
+    caption at a time.
+
+    Inputs:
+    - captions: Integer array of shape (N, T), or of shape (T,) for a single
+      caption.
+    - idx_to_word: Dictionary mapping word indices to words.
+
+    Returns a list of N strings, or a single string for a single caption.
+    """
     singleton = False
     if captions.ndim == 1:
         singleton = True
         captions = captions[None]
-    decoded = []
-    N, T = captions.shape
-    for i in range(N):
-        words = []
-        for t in range(T):
-            word = idx_to_word[captions[i, t]]
-            if word != '<NULL>':
-                words.append(word)
-            if word == '<END>':
-                break
-        decoded.append(' '.join(words))
+
+    # Array of words, so that a whole caption is looked up with one indexing
+    keys = np.fromiter(idx_to_word.keys(), dtype=np.int64, count=len(idx_to_word))
+    vocab = np.empty(keys.max() + 1, dtype=object)
+    vocab[keys] = list(idx_to_word.values())
+    null = np.flatnonzero(vocab == '<NULL>')
+    null = null[0] if len(null) > 0 else -1
+    end = np.flatnonzero(vocab == '<END>')
+    end = end[0] if len(end) > 0 else -1
+
+    # Drop <NULL> and everything after the first <END>, and look up all the
+    # remaining words at once; caption i has the words starts[i]:ends[i]
+    is_end = captions == end
+    keep = (captions != null) & (np.cumsum(is_end, axis=1) - is_end == 0)
+    words = vocab[captions[keep]].tolist()
+    ends = np.cumsum(keep.sum(axis=1)).tolist()
+    starts = [0] + ends[:-1]
+
+    decoded = [' '.join(words[a:b]) for a, b in zip(starts, ends)]
+
     if singleton:
         decoded = decoded[0]
     return decoded
 
 
-def sample_coco_minibatch(data, batch_size=100, split='train'):
+def caption_lengths(captions, null_idx):
+    """
+    Return the length of each caption in an (N, T) array of word indices, up to
+    and including its last word that is not <NULL>.
+    """
+    not_null = captions != null_idx
+    T = captions.shape[1]
+    return np.where(not_null.any(axis=1), T - np.argmax(not_null[:, ::-1], axis=1), 0)
+
+
+def word_sampling_probs(captions, vocab_size, null_idx, power=0.75):
+    """
+    Return a distribution over the vocabulary for sampled softmax losses: the
+    frequency of each word in the captions plus one, so that every word can be
+    sampled, raised to the given power to flatten it, and normalized. <NULL>
+    is never sampled.
+    """
+    counts = np.bincount(captions.ravel(), minlength=vocab_size) + 1.0
+    counts[null_idx] = 0
+    probs = counts ** power
+    return probs / probs.sum()
+
+
+def length_buckets(lengths, min_size=1):
+    """
+    Group caption indices by length. Captions of the same length go in the same
+    bucket, and neighbouring lengths are merged until every bucket holds at
+    least min_size captions.
+
+    Returns a list of integer arrays of caption indices, shortest first.
+    """
+    order = np.argsort(lengths, kind='stable')
+    sorted_lengths = lengths[order]
+    ends = np.flatnonzero(np.diff(sorted_lengths)) + 1
+    buckets = []
+    start = 0
+    for end in ends.tolist() + [len(order)]:
+        if end - start >= min_size or end == len(order):
+            buckets.append(order[start:end])
+            start = end
+    if len(buckets) > 1 and len(buckets[-1]) < min_size:
+        buckets[-2:] = [np.concatenate(buckets[-2:])]
+    return [b for b in buckets if len(b) > 0]
+
+
+def sample_coco_minibatch(data, batch_size=100, split='train', buckets=None):
+    """
+    Sample a random minibatch of captions with their image features and urls.
+
+    If buckets is given, as returned by length_buckets for the captions of the
+    split, all captions of the minibatch come from one bucket, chosen with
+    probability proportional to its size so that every caption is still equally
+    likely, and the captions are cut after the longest of them.
+    """
     split_size = data['%s_captions' % split].shape[0]
-    mask = np.random.choice(split_size, batch_size)
+    if buckets is None:
+        mask = np.random.choice(split_size, batch_size)
+    else:
+        sizes = np.array([len(b) for b in buckets], dtype=np.float64)
+        bucket = buckets[np.random.choice(len(buckets), p=sizes / sizes.sum())]
+        mask = bucket[np.random.randint(len(bucket), size=batch_size)]
     captions = data['%s_captions' % split][mask]
+    if buckets is not None:
+        lengths = caption_lengths(captions, data['word_to_idx']['<NULL>'])
+        captions = captions[:, :max(lengths.max(), 2)]
     image_idxs = data['%s_image_idxs' % split][mask]
     image_features = data['%s_features' % split][image_idxs]
     urls = data['%s_urls' % split][image_idxs]
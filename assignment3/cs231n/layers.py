@@ -1,5 +1,7 @@
 import numpy as np
 
+from cs231n.precision import accum_dtype, scale_loss_grad
+
 
 def affine_forward(x, w, b):
     """
@@ -250,6 +252,44 @@ def spatial_batchnorm_backward(dout, cache):
     return dx, dgamma, dbeta
 
 
+def batchnorm_fold(w, b, gamma, beta, bn_param):
+    """
+    Folds a test-time batch normalization into the affine or convolutional
+    layer that feeds it.
+
+    At test time batchnorm is the fixed per-feature affine map
+    gamma * (a - running_mean) / sqrt(running_var + eps) + beta, so it can be
+    absorbed into the weights and biases of the previous layer and skipped.
+
+    Inputs:
+    - w: Weights of the previous layer; either affine weights of shape (D, M)
+      or convolutional filters of shape (M, C, HH, WW)
+    - b: Biases of the previous layer, of shape (M,)
+    - gamma: Scale parameter of shape (M,)
+    - beta: Shift parameter of shape (M,)
+    - bn_param: Dictionary of batchnorm parameters as in batchnorm_forward. It
+      must hold the running_mean and running_var computed during training.
+
+    Returns a tuple of:
+    - w_fold: Folded weights, of the same shape as w
+    - b_fold: Folded biases, of shape (M,)
+    """
+    if 'running_mean' not in bn_param or 'running_var' not in bn_param:
+        raise ValueError('Cannot fold batchnorm without running statistics')
+    eps = bn_param.get('eps', 1e-5)
+    running_mean = np.ravel(bn_param['running_mean'])
+    running_var = np.ravel(bn_param['running_var'])
+
+    scale = gamma / np.sqrt(running_var + eps)
+    if w.ndim == 4:
+        w_fold = w * scale.reshape(-1, 1, 1, 1)
+    else:
+        w_fold = w * scale
+    b_fold = (b - running_mean) * scale + beta
+
+    return w_fold.astype(w.dtype, copy=False), b_fold.astype(b.dtype, copy=False)
+
+
 def svm_loss(x, y):
     """
     Computes the loss and gradient using for multiclass SVM classification.
@@ -274,6 +314,7 @@ def svm_loss(x, y):
     dx[margins > 0] = 1
     dx[np.arange(N), y] -= num_pos
     dx /= N
+    scale_loss_grad(dx)
     return loss, dx
 
 
@@ -291,11 +332,13 @@ def softmax_loss(x, y):
     - loss: Scalar giving the loss
     - dx: Gradient of the loss with respect to x
     """
-    probs = np.exp(x - np.max(x, axis=1, keepdims=True))
+    xa = x.astype(accum_dtype(x.dtype), copy=False)
+    probs = np.exp(xa - np.max(xa, axis=1, keepdims=True))
     probs /= np.sum(probs, axis=1, keepdims=True)
     N = x.shape[0]
     loss = -np.sum(np.log(probs[np.arange(N), y])) / N
     dx = probs.copy()
     dx[np.arange(N), y] -= 1
     dx /= N
-    return loss, dx
+    scale_loss_grad(dx)
+    return loss, dx.astype(x.dtype, copy=False)
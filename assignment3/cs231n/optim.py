@@ -1,5 +1,7 @@
 import numpy as np
 
+from cs231n.row_sparse import RowSparseGrad
+
 """
 This file implements various first-order update rules that are commonly used for
 training neural networks. Each update rule accepts current weights and the
@@ -27,20 +29,40 @@ for a variety of different problems.
 
 For efficiency, update rules may perform in-place updates, mutating w and
 setting next_w equal to w.
+
+The gradient may also be a RowSparseGrad (see row_sparse.py), in which case the
+update rules only touch the rows (or columns) of w that it holds.
 """
 
 
+def _state(config, key, like, zeros=True):
+    """
+    Return the array config[key], allocating it with the shape and dtype of
+    like only if the config does not hold it yet; zeros=False leaves it
+    uninitialized, for scratch arrays.
+    """
+    if key not in config:
+        config[key] = np.zeros_like(like) if zeros else np.empty_like(like)
+    return config[key]
+
+
 def sgd(w, dw, config=None):
     """
     Performs vanilla stochastic gradient descent.
 
     config format:
     - learning_rate: Scalar learning rate.
+    - scratch: Work array of the same shape as w, reused across dense steps.
     """
     if config is None: config = {}
     config.setdefault('learning_rate', 1e-2)
 
-    w -= config['learning_rate'] * dw
+    if isinstance(dw, RowSparseGrad):
+        dw.rows_of(w)[dw.indices] -= config['learning_rate'] * dw.rows
+    else:
+        tmp = _state(config, 'scratch', w, zeros=False)
+        np.multiply(dw, config['learning_rate'], out=tmp)
+        w -= tmp
     return w, config
 
 
@@ -57,27 +79,106 @@ def adam(x, dx, config=None):
     - m: Moving average of gradient.
     - v: Moving average of squared gradient.
     - t: Iteration number.
+    - scratch: Work array of the same shape as x, reused across steps.
+
+    If dx is a RowSparseGrad this is a lazy Adam: only the rows of x, m and v
+    that dx holds are updated, while the moving averages of the other rows are
+    left as they are rather than decayed towards zero.
     """
     if config is None: config = {}
     config.setdefault('learning_rate', 1e-3)
     config.setdefault('beta1', 0.9)
     config.setdefault('beta2', 0.999)
     config.setdefault('epsilon', 1e-8)
-    config.setdefault('m', np.zeros_like(x))
-    config.setdefault('v', np.zeros_like(x))
+    _state(config, 'm', x)
+    _state(config, 'v', x)
     config.setdefault('t', 0)
 
     next_x = None
     beta1, beta2, eps = config['beta1'], config['beta2'], config['epsilon']
     t, m, v = config['t'], config['m'], config['v']
-    m = beta1 * m + (1 - beta1) * dx
-    v = beta2 * v + (1 - beta2) * (dx * dx)
+
+    if isinstance(dx, RowSparseGrad):
+        # Update the seen rows on gathered copies and write them back; for a
+        # column gradient the rows are those of the transposed arrays
+        rows, g = dx.indices, dx.rows
+        x_rows, m_rows, v_rows = dx.rows_of(x), dx.rows_of(m), dx.rows_of(v)
+        m_new = beta1 * m_rows[rows] + (1 - beta1) * g
+        v_new = beta2 * v_rows[rows] + (1 - beta2) * (g * g)
+        m_rows[rows], v_rows[rows] = m_new, v_new
+        t += 1
+        alpha = config['learning_rate'] * np.sqrt(1 - beta2 ** t) / (1 - beta1 ** t)
+        x_rows[rows] -= alpha * m_new / (np.sqrt(v_new) + eps)
+        config['t'] = t
+        return x, config
+
+    tmp = _state(config, 'scratch', x, zeros=False)
+
+    # Update m, v and x in place through the scratch array so that a step
+    # allocates nothing
+    m *= beta1
+    np.multiply(dx, 1 - beta1, out=tmp)
+    m += tmp
+    v *= beta2
+    np.multiply(dx, dx, out=tmp)
+    tmp *= 1 - beta2
+    v += tmp
     t += 1
     alpha = config['learning_rate'] * np.sqrt(1 - beta2 ** t) / (1 - beta1 ** t)
-    x -= alpha * (m / (np.sqrt(v) + eps))
+    np.sqrt(v, out=tmp)
+    tmp += eps
+    np.divide(m, tmp, out=tmp)
+    tmp *= alpha
+    x -= tmp
     config['t'] = t
-    config['m'] = m
-    config['v'] = v
     next_x = x
 
     return next_x, config
+
+
+def clip_gradients(grads, keys, max_norm=None, max_param_norm=None):
+    """
+    Measures the L2 norms of a dictionary of gradients, and optionally clips the
+    gradients in place.
+
+    Inputs:
+    - grads: Dictionary mapping parameter names to gradient arrays.
+    - keys: Names of the gradients to consider; other entries are ignored.
+    - max_norm: If not None, rescale all gradients together whenever their
+      global L2 norm exceeds this value.
+    - max_param_norm: If not None, rescale each gradient whose own L2 norm
+      exceeds this value. This is applied before global norm clipping.
+
+    Returns a tuple of:
+    - norms: Dictionary mapping names to the L2 norm of each gradient, measured
+      before clipping.
+    - global_norm: L2 norm of all gradients together, measured before clipping.
+    - clipped: Boolean; whether any gradient was rescaled.
+    """
+    norms = {}
+    for k in keys:
+        g = grads[k]
+        g = (g.rows if isinstance(g, RowSparseGrad) else g).ravel()
+        norms[k] = float(np.sqrt(np.dot(g, g)))
+    global_norm = float(np.sqrt(sum(n * n for n in norms.values())))
+
+    clipped = False
+    clipped_norm = global_norm
+    if max_param_norm is not None:
+        total = 0.0
+        for k in keys:
+            n = norms[k]
+            if n > max_param_norm:
+                grads[k] *= max_param_norm / n
+                n = max_param_norm
+                clipped = True
+            total += n * n
+        clipped_norm = np.sqrt(total)
+
+    if max_norm is not None and clipped_norm > max_norm:
+        scale = max_norm / clipped_norm
+        for k in keys:
+            grads[k] *= scale
+        clipped = True
+
+    return norms, global_norm, clipped
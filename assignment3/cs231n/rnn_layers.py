@@ -2,6 +2,9 @@ from __future__ import print_function, division
 from builtins import range
 import numpy as np
 
+from cs231n.precision import accum_dtype, scale_loss_grad
+from cs231n.row_sparse import RowSparseGrad
+
 
 """
 This file defines layer types that are commonly used for recurrent neural
@@ -91,7 +94,22 @@ def rnn_step_backward(dnext_h, cache):
     return dx, dprev_h, dWx, dWh, db
 
 
-def rnn_forward(x, h0, Wx, Wh, b):
+def _step_sizes(lengths, N, T):
+    """
+    Return a list with the number of sequences still running at each of the T
+    timesteps. The sequences must be sorted by decreasing length, so that the
+    running ones at any timestep are the first rows of the minibatch.
+    """
+    if lengths is None:
+        return [N] * T
+    lengths = np.asarray(lengths)
+    if lengths.shape != (N,) or np.any(lengths[1:] > lengths[:-1]):
+        raise ValueError('lengths must be an array of shape (%d,) sorted in '
+                         'decreasing order' % N)
+    return (lengths[:, None] > np.arange(T)).sum(axis=0).tolist()
+
+
+def rnn_forward(x, h0, Wx, Wh, b, lengths=None):
     """
     Run a vanilla RNN forward on an entire sequence of data. We assume an input
     sequence composed of T vectors, each of dimension D. The RNN uses a hidden
@@ -104,6 +122,9 @@ def rnn_forward(x, h0, Wx, Wh, b):
     - Wx: Weight matrix for input-to-hidden connections, of shape (D, H)
     - Wh: Weight matrix for hidden-to-hidden connections, of shape (H, H)
     - b: Biases of shape (H,)
+    - lengths: Optional integer array of shape (N,) giving the length of each
+      sequence, sorted in decreasing order. Sequence i is only run for its
+      first lengths[i] timesteps; its hidden states after that are zero.
 
     Returns a tuple of:
     - h: Hidden states for the entire timeseries, of shape (N, T, H).
@@ -120,16 +141,21 @@ def rnn_forward(x, h0, Wx, Wh, b):
     (_,H)   = h0.shape
 
     # Inicializo las variables
-    h = np.zeros([N,T,H])
-    cache = []
+    h = np.zeros([N,T,H], dtype=h0.dtype)
+    sizes = _step_sizes(lengths, N, T)
+    caches = []
 
     # Llamo a rnn_step_forward en un loop para cada estado y voy guardando los
-    # estados y caches intermedios
+    # estados y caches intermedios. En cada paso solo proceso las n primeras
+    # secuencias, que son las que no terminaron
     prev_h = h0
-    for t in range(T):
-        prev_h, cache_t = rnn_step_forward(x[:,t,:],prev_h,Wx,Wh,b)
-        h[:,t,:] = prev_h
-        cache   += [cache_t]
+    for t, n in enumerate(sizes):
+        if n == 0:
+            break
+        prev_h, cache_t = rnn_step_forward(x[:n,t,:],prev_h[:n],Wx,Wh,b)
+        h[:n,t,:] = prev_h
+        caches   += [cache_t]
+    cache = (caches, sizes, D)
     ##############################################################################
     #                               END OF YOUR CODE                             #
     ##############################################################################
@@ -157,21 +183,22 @@ def rnn_backward(dh, cache):
     # defined above. You can use a for loop to help compute the backward pass.   #
     ##############################################################################
     # Obtengo dimensiones
-    _, x, _, _, _, _ = cache[0]
+    caches, sizes, D = cache
     (N,T,H) = dh.shape
-    (_,D)   = x.shape
 
     # Inicializo variables
-    dx      = np.zeros([N,T,D])
-    dprev_h = np.zeros([N,H])
-    dWx     = np.zeros([D,H])
-    dWh     = np.zeros([H,H])
-    db      = np.zeros([H])
+    dx      = np.zeros([N,T,D], dtype=dh.dtype)
+    dprev_h = np.zeros([N,H], dtype=dh.dtype)
+    dWx     = np.zeros([D,H], dtype=dh.dtype)
+    dWh     = np.zeros([H,H], dtype=dh.dtype)
+    db      = np.zeros([H], dtype=dh.dtype)
 
     # Llamo a rnn_step_backward en loop para cada estado y voy formando los 
-    # gradientes
-    for t in range(T-1,-1,-1):
-        dx[:,t,:], dprev_h, dWx_t, dWh_t, db_t = rnn_step_backward(dh[:,t,:]+dprev_h, cache[t])
+    # gradientes. Las secuencias que ya terminaron en el paso t no reciben
+    # gradiente en ese paso, así que su dprev_h queda como estaba
+    for t in range(len(caches)-1,-1,-1):
+        n = sizes[t]
+        dx[:n,t,:], dprev_h[:n], dWx_t, dWh_t, db_t = rnn_step_backward(dh[:n,t,:]+dprev_h[:n], caches[t])
         dWh += dWh_t
         dWx += dWx_t
         db  += db_t
@@ -216,7 +243,7 @@ def word_embedding_forward(x, W):
     return out, cache
 
 
-def word_embedding_backward(dout, cache):
+def word_embedding_backward(dout, cache, sparse=False):
     """
     Backward pass for word embeddings. We cannot back-propagate into the words
     since they are integers, so we only return gradient for the word embedding
@@ -227,6 +254,8 @@ def word_embedding_backward(dout, cache):
     Inputs:
     - dout: Upstream gradients of shape (N, T, D)
     - cache: Values from the forward pass
+    - sparse: If True, return the gradient as a RowSparseGrad holding only the
+      rows of the words in x; see row_sparse.py.
 
     Returns:
     - dW: Gradient of word embedding matrix, of shape (V, D).
@@ -240,31 +269,35 @@ def word_embedding_backward(dout, cache):
     ##############################################################################
     # Obtengo datos y dimensiones
     W,x = cache
-    V,_ = W.shape
+    D   = dout.shape[-1]
 
-    # Inicializo variables
-    dW  = np.zeros_like(W)
+    # Sumo los gradientes de cada palabra ordenando los índices y sumando cada
+    # grupo con np.add.reduceat, que es mucho más rápido que np.add.at
+    dW  = RowSparseGrad.from_rows(x.reshape(-1), dout.reshape(-1, D), W.shape)
 
-    # Calculo el gradiente según la matriz W
-    dw  = np.add.at(dW, x.reshape(np.prod(x.shape)), dout.reshape(np.prod(dout.shape[:-1]), dout.shape[-1]))
+    # Salvo que se pida disperso, devuelvo el gradiente denso
+    if not sparse:
+        dW = dW.to_dense(W.dtype)
     ##############################################################################
     #                               END OF YOUR CODE                             #
     ##############################################################################
     return dW
 
 
-def sigmoid(x):
+def sigmoid(x, out=None):
     """
     A numerically stable version of the logistic sigmoid function.
+
+    It is computed as 0.5 * (1 + tanh(x / 2)), which equals the sigmoid and
+    never overflows, since tanh saturates for large inputs. The result is
+    written into out if given, which may be x itself, so no temporary arrays
+    are allocated.
     """
-    pos_mask = (x >= 0)
-    neg_mask = (x < 0)
-    z = np.zeros_like(x)
-    z[pos_mask] = np.exp(-x[pos_mask])
-    z[neg_mask] = np.exp(x[neg_mask])
-    top = np.ones_like(x)
-    top[neg_mask] = z[neg_mask]
-    return top / (1 + z)
+    out = np.multiply(x, 0.5, out=out)
+    np.tanh(out, out=out)
+    out += 1
+    out *= 0.5
+    return out
 
 
 def lstm_step_forward(x, prev_h, prev_c, Wx, Wh, b):
@@ -298,14 +331,11 @@ def lstm_step_forward(x, prev_h, prev_c, Wx, Wh, b):
     # Obtengo vector de activación
     a = x.dot(Wx) + prev_h.dot(Wh) + b
     
-    # Utilizo los primeros H elementos
-    i = sigmoid(a[:,0:H])
-    # Utilizo los segundos H elementos
-    f = sigmoid(a[:,H:2*H])
-    # Utilizo los terceros H elementos
-    o = sigmoid(a[:,2*H:3*H])
-    # Utilizo los últimos H elementos
-    g = np.tanh(a[:,3*H:4*H])
+    # Aplico las activaciones en el lugar: sigmoide a los primeros 3H elementos
+    # (i, f, o) y tangente hiperbólica a los últimos H elementos (g)
+    sigmoid(a[:,0:3*H], out=a[:,0:3*H])
+    np.tanh(a[:,3*H:4*H], out=a[:,3*H:4*H])
+    i, f, o, g = a[:,0:H], a[:,H:2*H], a[:,2*H:3*H], a[:,3*H:4*H]
 
     # Calculo nuevo estado de la celda
     next_c = f*prev_c + i*g
@@ -381,16 +411,17 @@ def lstm_step_backward(dnext_h, dnext_c, cache):
     return dx, dprev_h, dprev_c, dWx, dWh, db
 
 
-def lstm_forward(x, h0, Wx, Wh, b):
+def lstm_forward(x, h0, Wx, Wh, b, lengths=None, c0=None):
     """
     Forward pass for an LSTM over an entire sequence of data. We assume an input
     sequence composed of T vectors, each of dimension D. The LSTM uses a hidden
     size of H, and we work over a minibatch containing N sequences. After running
     the LSTM forward, we return the hidden states for all timesteps.
 
-    Note that the initial cell state is passed as input, but the initial cell
-    state is set to zero. Also note that the cell state is not returned; it is
-    an internal variable to the LSTM and is not accessed from outside.
+    Note that the initial hidden state is passed as input, but the initial cell
+    state is set to zero unless c0 is given. Also note that the cell state is
+    not returned; it is an internal variable to the LSTM and is not accessed
+    from outside.
 
     Inputs:
     - x: Input data of shape (N, T, D)
@@ -398,6 +429,12 @@ def lstm_forward(x, h0, Wx, Wh, b):
     - Wx: Weights for input-to-hidden connections, of shape (D, 4H)
     - Wh: Weights for hidden-to-hidden connections, of shape (H, 4H)
     - b: Biases of shape (4H,)
+    - lengths: Optional integer array of shape (N,) giving the length of each
+      sequence, sorted in decreasing order. Sequence i is only run for its
+      first lengths[i] timesteps; its hidden states after that are zero.
+    - c0: Optional initial cell state of shape (N, H), for example the last
+      cell state of the previous window in truncated_bptt_loss. No gradient is
+      computed for it.
 
     Returns a tuple of:
     - h: Hidden states for all timesteps of all sequences, of shape (N, T, H)
@@ -409,20 +446,58 @@ def lstm_forward(x, h0, Wx, Wh, b):
     # You should use the lstm_step_forward function that you just defined.      #
     #############################################################################
     # Obtengo dimensiones
-    N, T, _ = x.shape
+    N, T, D = x.shape
     _, H    = h0.shape
 
-    # Inicializo variables
-    h = np.zeros([N,T,H])
-    h_t = h0
-    c_t = np.zeros_like(h0)
-    cache = []
-
-    # Llamo a lstm_step_forward para cada time stamp y voy armando h
-    for t in range(T):
-        h_t, c_t, cache_t = lstm_step_forward(x[:,t,:], h_t, c_t, Wx, Wh, b)
-        h[:,t,:] = h_t
-        cache += [cache_t]
+    # Trabajo en orden temporal (T, N, ...), así cada paso lee y escribe bloques
+    # contiguos. En el paso t solo corren las sizes[t] primeras secuencias, y
+    # sus entradas se empaquetan una tras otra en x_p; la parte de la entrada
+    # de las activaciones de todos los pasos se calcula con un solo producto
+    # de matrices, y gates[offsets[t]:offsets[t+1]] son las del paso t
+    sizes = _step_sizes(lengths, N, T)
+    offsets = np.concatenate(([0], np.cumsum(sizes))).tolist()
+    x_t = x.transpose(1, 0, 2)
+    if lengths is None:
+        x_p = np.ascontiguousarray(x_t).reshape(T * N, D)
+    else:
+        x_p = x_t[np.arange(N) < np.array(sizes)[:, None]]
+    gates = x_p.dot(Wx)
+    gates += b
+
+    # hs[t] y cs[t] son los estados antes del paso t, y hs[t+1] y cs[t+1] los
+    # estados después; el estado inicial de la celda es cero si no se da c0
+    hs = np.empty((T + 1, N, H), dtype=h0.dtype)
+    cs = np.empty((T + 1, N, H), dtype=h0.dtype)
+    tanh_cs = np.empty((T, N, H), dtype=h0.dtype)
+    hs[0] = h0
+    cs[0] = 0 if c0 is None else c0
+    ig = np.empty((N, H), dtype=gates.dtype)
+
+    for t, n in enumerate(sizes):
+        # Las secuencias que ya terminaron tienen estado cero
+        hs[t + 1, n:] = 0
+        cs[t + 1, n:] = 0
+        if n == 0:
+            continue
+
+        # Agrego la parte recurrente y aplico las activaciones en el lugar; los
+        # bloques son i, f, o (sigmoide) y g (tangente hiperbólica)
+        a = gates[offsets[t]:offsets[t + 1]]
+        a += hs[t, :n].dot(Wh)
+        sigmoid(a[:, :3*H], out=a[:, :3*H])
+        np.tanh(a[:, 3*H:], out=a[:, 3*H:])
+        i, f, o, g = a[:, :H], a[:, H:2*H], a[:, 2*H:3*H], a[:, 3*H:]
+
+        # Calculo nuevo estado de la celda y nuevo estado oculto
+        np.multiply(f, cs[t, :n], out=cs[t + 1, :n])
+        np.multiply(i, g, out=ig[:n])
+        cs[t + 1, :n] += ig[:n]
+        np.tanh(cs[t + 1, :n], out=tanh_cs[t, :n])
+        np.multiply(o, tanh_cs[t, :n], out=hs[t + 1, :n])
+
+    # Devuelvo h con forma (N, T, H) como vista de los estados
+    h = hs[1:].transpose(1, 0, 2)
+    cache = (x_p, Wx, Wh, gates, hs, cs, tanh_cs, sizes)
     ##############################################################################
     #                               END OF YOUR CODE                             #
     ##############################################################################
@@ -450,25 +525,56 @@ def lstm_backward(dh, cache):
     # TODO: Implement the backward pass for an LSTM over an entire timeseries.  #
     # You should use the lstm_step_backward function that you just defined.     #
     #############################################################################
-    # Obtengo dimensiones
-    x       = cache[0][0]
+    # Obtengo datos y dimensiones
+    x_p, Wx, Wh, gates, hs, cs, tanh_cs, sizes = cache
     N, T, H = dh.shape
-    _, D    = x.shape
-
-    # Inicializo variables
-    dx      = np.zeros([N,T,D])
-    dprev_h = np.zeros([N,H])
-    dprev_c = np.zeros([N,H])
-    dWx     = np.zeros([D,4*H])
-    dWh     = np.zeros([H,4*H])
-    db      = np.zeros([4*H])
-
-    # Llamo a lstm_step_backward para cada time_stamp y voy armando los gradientes
+    D       = Wx.shape[0]
+    offsets = np.concatenate(([0], np.cumsum(sizes))).tolist()
+
+    # Gradientes de las activaciones de todos los pasos, empaquetados como en
+    # lstm_forward
+    dgates  = np.empty((offsets[-1], 4*H), dtype=dh.dtype)
+    dh_t    = dh.transpose(1, 0, 2)
+    dprev_h = np.zeros([N,H], dtype=dh.dtype)
+    dprev_c = np.zeros([N,H], dtype=dh.dtype)
+
+    # Recorro los pasos hacia atrás; en cada paso solo queda el producto con Wh
+    # para propagar el gradiente al estado oculto anterior
+    # Las secuencias que ya terminaron en el paso t no reciben gradiente en ese
+    # paso, así que sus dprev_h y dprev_c quedan como estaban
     for t in range(T-1,-1,-1):
-        dx[:,t,:], dprev_h, dprev_c, dWx_t, dWh_t, db_t = lstm_step_backward(dh[:,t,:] + dprev_h, dprev_c, cache[t])
-        dWh += dWh_t
-        dWx += dWx_t
-        db  += db_t
+        n = sizes[t]
+        if n == 0:
+            continue
+        a = gates[offsets[t]:offsets[t + 1]]
+        i, f, o, g = a[:, :H], a[:, H:2*H], a[:, 2*H:3*H], a[:, 3*H:]
+        da = dgates[offsets[t]:offsets[t + 1]]
+
+        dnext_h  = dh_t[t, :n] + dprev_h[:n]
+        dnext_c  = dprev_c[:n] + dnext_h*o*(1-tanh_cs[t, :n]**2)
+
+        # Uso que la derivada de la sigmoide es s*(1-s) y la de tanh es 1-tanh^2
+        da[:, :H]      = dnext_c*g*i*(1-i)
+        da[:, H:2*H]   = dnext_c*cs[t, :n]*f*(1-f)
+        da[:, 2*H:3*H] = dnext_h*tanh_cs[t, :n]*o*(1-o)
+        da[:, 3*H:]    = dnext_c*i*(1-g*g)
+
+        dprev_c[:n] = dnext_c*f
+        dprev_h[:n] = da.dot(Wh.T)
+
+    # Con los gradientes de todas las activaciones calculo los gradientes de los
+    # pesos con un solo producto de matrices cada uno
+    if offsets[-1] == T * N:
+        dx  = dgates.dot(Wx.T).reshape(T, N, D).transpose(1, 0, 2)
+        dWh = hs[:-1].reshape(T * N, H).T.dot(dgates)
+    else:
+        active = np.arange(N) < np.array(sizes)[:, None]
+        dx_t = np.zeros((T, N, D), dtype=dh.dtype)
+        dx_t[active] = dgates.dot(Wx.T)
+        dx  = dx_t.transpose(1, 0, 2)
+        dWh = hs[:-1][active].T.dot(dgates)
+    dWx = x_p.T.dot(dgates)
+    db  = dgates.sum(axis=0)
 
     dh0 = dprev_h
     ##############################################################################
@@ -478,6 +584,97 @@ def lstm_backward(dh, cache):
     return dx, dh0, dWx, dWh, db
 
 
+def truncated_bptt_loss(x, h0, Wx, Wh, b, loss_fn, window, cell_type='rnn',
+                        lengths=None, c0=None):
+    """
+    Run an RNN or LSTM over a long sequence with truncated backpropagation
+    through time: the sequence is processed in windows of at most window
+    timesteps, and each window runs its forward pass, the loss on its hidden
+    states and its backward pass before the next one starts. The hidden (and
+    cell) state is carried from each window to the next, but gradients do not
+    flow back across windows, so only the caches of one window are alive at a
+    time and memory does not grow with T. With window >= T this gives the same
+    loss and gradients as rnn_forward / lstm_forward followed by their backward
+    pass.
+
+    Inputs:
+    - x: Input data of shape (N, T, D)
+    - h0: Initial hidden state of shape (N, H)
+    - Wx, Wh, b: Weights and biases of the RNN or LSTM, as in rnn_forward and
+      lstm_forward.
+    - loss_fn: Function called as loss_fn(start, h) for every window, where h
+      of shape (N, k, H) holds the hidden states of timesteps start to
+      start + k - 1. It returns a tuple (loss, dh) with the loss of those
+      timesteps and its gradient with respect to h, and accumulates the
+      gradients of its own parameters itself.
+    - window: Number of timesteps per window.
+    - cell_type: Either 'rnn' or 'lstm'.
+    - lengths: Optional integer array of shape (N,) of sequence lengths sorted
+      in decreasing order, as in rnn_forward.
+    - c0: Optional initial cell state of shape (N, H) for an LSTM; zero by
+      default.
+
+    Returns a tuple of:
+    - loss: Sum of the losses of all windows
+    - dx: Gradient of the input data, of shape (N, T, D)
+    - dh0: Gradient of the initial hidden state, of shape (N, H), from the
+      first window only
+    - dWx, dWh, db: Gradients of the weights and biases
+    - hT: Hidden state after the last timestep, of shape (N, H), to continue
+      with the next part of the sequences (stateful training); it is zero for
+      sequences that ended before
+    - cT: Cell state after the last timestep for an LSTM, or None
+    """
+    if cell_type not in {'rnn', 'lstm'}:
+        raise ValueError('Invalid cell_type "%s"' % cell_type)
+    N, T, D = x.shape
+    _step_sizes(lengths, N, T)
+
+    loss = 0.0
+    dx = np.zeros_like(x)
+    dh0 = None
+    dWx, dWh, db = np.zeros_like(Wx), np.zeros_like(Wh), np.zeros_like(b)
+    h_prev = h0
+    c_prev = None
+    if cell_type == 'lstm':
+        c_prev = np.zeros_like(h0) if c0 is None else c0
+
+    for start in range(0, T, window):
+        stop = min(start + window, T)
+        lengths_w = None
+        if lengths is not None:
+            lengths_w = np.clip(np.asarray(lengths) - start, 0, stop - start)
+
+        # Forward de la ventana desde el último estado de la anterior, sin
+        # propagar el gradiente hacia ella
+        if cell_type == 'rnn':
+            h, cache = rnn_forward(x[:, start:stop], h_prev, Wx, Wh, b, lengths_w)
+        else:
+            h, cache = lstm_forward(x[:, start:stop], h_prev, Wx, Wh, b, lengths_w, c_prev)
+        loss_w, dh = loss_fn(start, h)
+        loss += loss_w
+
+        # Backward de la ventana; después del backward su cache ya no se usa
+        if cell_type == 'rnn':
+            dx_w, dh0_w, dWx_w, dWh_w, db_w = rnn_backward(dh, cache)
+        else:
+            dx_w, dh0_w, dWx_w, dWh_w, db_w = lstm_backward(dh, cache)
+            c_prev = cache[5][-1].copy()
+        h_prev = h[:, -1].copy()
+        del h, dh, cache
+
+        dx[:, start:stop] = dx_w
+        dWx += dWx_w
+        dWh += dWh_w
+        db  += db_w
+        if dh0 is None:
+            dh0 = dh0_w
+
+    if dh0 is None:
+        dh0 = np.zeros_like(h0)
+    return loss, dx, dh0, dWx, dWh, db, h_prev, c_prev
+
+
 def temporal_affine_forward(x, w, b):
     """
     Forward pass for a temporal affine layer. The input is a set of D-dimensional
@@ -558,6 +755,7 @@ def temporal_softmax_loss(x, y, mask, verbose=False):
     y_flat = y.reshape(N * T)
     mask_flat = mask.reshape(N * T)
 
+    x_flat = x_flat.astype(accum_dtype(x.dtype), copy=False)
     probs = np.exp(x_flat - np.max(x_flat, axis=1, keepdims=True))
     probs /= np.sum(probs, axis=1, keepdims=True)
     loss = -np.sum(mask_flat * np.log(probs[np.arange(N * T), y_flat])) / N
@@ -565,9 +763,103 @@ def temporal_softmax_loss(x, y, mask, verbose=False):
     dx_flat[np.arange(N * T), y_flat] -= 1
     dx_flat /= N
     dx_flat *= mask_flat[:, None]
+    scale_loss_grad(dx_flat)
 
     if verbose: print('dx_flat: ', dx_flat.shape)
 
-    dx = dx_flat.reshape(N, T, V)
+    dx = dx_flat.reshape(N, T, V).astype(x.dtype, copy=False)
 
     return loss, dx
+
+
+def temporal_sampled_softmax_loss(x, w, b, y, mask, num_sampled, probs=None,
+                                  sparse=False):
+    """
+    A sampled version of temporal_affine_forward followed by
+    temporal_softmax_loss, for training with large vocabularies.
+
+    Instead of computing scores for all V words at every timestep, only the
+    score of the ground-truth word and the scores of num_sampled words drawn
+    from the distribution probs are computed. The sampled words are shared by
+    all timesteps of the minibatch, and every score is corrected by the log of
+    the expected number of times its word is drawn, so that the gradient is an
+    estimate of the gradient of the full softmax loss (Jean et al., "On Using
+    Very Large Target Vocabulary for Neural Machine Translation", 2015).
+    Sampled words that happen to be the ground-truth word are ignored.
+
+    The loss is not the full softmax loss and is only meant for training; at
+    test time compute all scores with temporal_affine_forward.
+
+    Inputs:
+    - x: Input data of shape (N, T, D)
+    - w: Weights of shape (D, V)
+    - b: Biases of shape (V,)
+    - y: Ground-truth indices, of shape (N, T) where each element is in the range
+         0 <= y[i, t] < V
+    - mask: Boolean array of shape (N, T) where mask[i, t] tells whether or not
+      the scores at timestep t of sequence i should contribute to the loss.
+    - num_sampled: Number of words to sample.
+    - probs: Optional array of shape (V,) giving the distribution the words are
+      sampled from; uniform by default.
+    - sparse: If True, return dw as a RowSparseGrad holding only the columns of
+      the ground-truth and sampled words, so that neither the backward pass
+      nor an update of w with optim.py touches the other columns.
+
+    Returns a tuple of:
+    - loss: Scalar giving loss
+    - dx: Gradient of loss with respect to x, of shape (N, T, D)
+    - dw: Gradient of loss with respect to w, of shape (D, V)
+    - db: Gradient of loss with respect to b, of shape (V,)
+    """
+    N, T, D = x.shape
+    V = b.shape[0]
+    dtype = accum_dtype(x.dtype)
+
+    # Only the timesteps that contribute to the loss are scored
+    mask_flat = mask.reshape(N * T)
+    xs = x.reshape(N * T, D)[mask_flat].astype(dtype, copy=False)
+    ys = y.reshape(N * T)[mask_flat]
+
+    if probs is None:
+        sampled = np.random.randint(V, size=num_sampled)
+        log_q_true = log_q_sampled = np.log(num_sampled / V)
+    else:
+        sampled = np.random.choice(V, size=num_sampled, p=probs)
+        log_q_true = np.log(num_sampled * probs[ys])
+        log_q_sampled = np.log(num_sampled * probs[sampled])
+
+    # Column 0 holds the score of the ground-truth word, the others the scores
+    # of the sampled words
+    w_true = w[:, ys].T.astype(dtype, copy=False)
+    w_sampled = w[:, sampled].astype(dtype, copy=False)
+    scores = np.empty((xs.shape[0], num_sampled + 1), dtype=dtype)
+    scores[:, 0] = np.einsum('ij,ij->i', xs, w_true) + b[ys] - log_q_true
+    scores[:, 1:] = xs.dot(w_sampled) + b[sampled] - log_q_sampled
+    scores[:, 1:][sampled == ys[:, None]] = -np.inf
+
+    probs_s = np.exp(scores - np.max(scores, axis=1, keepdims=True))
+    probs_s /= np.sum(probs_s, axis=1, keepdims=True)
+    loss = -np.sum(np.log(probs_s[:, 0])) / N
+    dscores = probs_s
+    dscores[:, 0] -= 1
+    dscores /= N
+    scale_loss_grad(dscores)
+    dtrue, dsampled = dscores[:, 0], dscores[:, 1:]
+
+    dxs = dtrue[:, None] * w_true + dsampled.dot(w_sampled.T)
+    dx = np.zeros((N * T, D), dtype=x.dtype)
+    dx[mask_flat] = dxs
+    dx = dx.reshape(N, T, D)
+
+    # Words can appear more than once among the targets and the samples; their
+    # gradients are summed as in word_embedding_backward
+    dw = RowSparseGrad.from_rows(np.concatenate((ys, sampled)),
+                                 np.concatenate((dtrue[:, None] * xs, dsampled.T.dot(xs))),
+                                 w.shape, axis=1, dtype=w.dtype)
+    if not sparse:
+        dw = dw.to_dense()
+    db = (np.bincount(ys, weights=dtrue, minlength=V) +
+          np.bincount(sampled, weights=dsampled.sum(axis=0), minlength=V))
+    db = db.astype(b.dtype, copy=False)
+
+    return loss, dx, dw, db
@@ -0,0 +1,105 @@
+import numpy as np
+
+"""
+This file implements row-sparse gradients, for parameters of which only a few
+rows take part in each minibatch, like the word embedding matrix: a minibatch
+of N captions of length T only touches the rows of at most N * T of the V words
+of the vocabulary.
+
+A RowSparseGrad holds the indices of those rows and their gradients, so that
+building it and applying an update with it cost O(N * T * D) rather than
+O(V * D). The update rules in optim.py update only those rows; sgd gives the
+same result as with the dense gradient, and adam becomes a lazy Adam that only
+updates the moment estimates of the rows that were seen.
+
+The same class holds gradients that are zero except on some columns, like the
+gradient of the output weights of shape (H, V) under a sampled softmax loss,
+with axis=1; rows_of gives the view of an array in which those columns are rows,
+so the update rules handle both cases with the same code.
+
+Wherever a dense array is needed, for example to copy the gradient into a
+flat buffer or to compare it with a numeric gradient, np.asarray turns a
+RowSparseGrad into the equivalent dense array.
+"""
+
+
+class RowSparseGrad(object):
+    """
+    The gradient of a 2-dimensional parameter that is zero except on some rows,
+    or on some columns if axis is 1.
+
+    Attributes:
+    - indices: Sorted integer array of shape (R,) of distinct row indices.
+    - rows: Array of shape (R, D); rows[i] is the gradient of row indices[i].
+    - shape: Shape of the dense gradient; (V, D), or (D, V) if axis is 1.
+    - axis: 0 if indices are rows of the parameter, 1 if they are columns.
+    """
+
+    def __init__(self, indices, rows, shape, axis=0):
+        self.indices = indices
+        self.rows = rows
+        self.shape = tuple(shape)
+        self.axis = axis
+        self.dtype = rows.dtype
+
+
+    @classmethod
+    def from_rows(cls, idx, grads, shape, axis=0, dtype=None):
+        """
+        Sum gradients given for possibly repeated rows.
+
+        Inputs:
+        - idx: Integer array of shape (M,) of row (or column) indices.
+        - grads: Array of shape (M, D); grads[i] is a gradient for row idx[i].
+        - shape: Shape of the dense gradient; (V, D), or (D, V) if axis is 1.
+        - axis: 0 if idx are rows of the parameter, 1 if they are columns.
+        - dtype: Datatype of the summed gradients; by default that of grads.
+        """
+        dtype = dtype or grads.dtype
+        if len(idx) == 0:
+            return cls(idx[:0], grads[:0].astype(dtype), shape, axis)
+
+        # Sorting puts the gradients of each row together, so that each group
+        # can be summed with a single np.add.reduceat. The reduction runs along
+        # the last axis of the transposed gradients, which is several times
+        # faster than reducing groups of rows
+        order = np.argsort(idx, kind='stable')
+        sorted_idx = idx[order]
+        starts = np.flatnonzero(np.concatenate(([True], sorted_idx[1:] != sorted_idx[:-1])))
+        rows = np.add.reduceat(grads.T[:, order], starts, axis=1).T
+        rows = np.ascontiguousarray(rows, dtype=dtype)
+        return cls(sorted_idx[starts], rows, shape, axis)
+
+
+    def rows_of(self, a):
+        """
+        Return a view of an array of the shape of the dense gradient whose rows
+        are indexed by self.indices; a itself, or a.T if axis is 1.
+        """
+        return a if self.axis == 0 else a.T
+
+
+    def to_dense(self, dtype=None):
+        """
+        Return the gradient as a dense array.
+        """
+        # For a column gradient the rows are written into a (V, D) array, and
+        # its transpose is returned, so that every row is a contiguous write
+        shape = self.shape if self.axis == 0 else self.shape[::-1]
+        dense = np.zeros(shape, dtype=dtype or self.dtype)
+        dense[self.indices] = self.rows
+        return self.rows_of(dense)
+
+
+    def __array__(self, dtype=None, copy=None):
+        return self.to_dense(dtype)
+
+
+    def __imul__(self, scale):
+        self.rows *= scale
+        return self
+
+
+    def __repr__(self):
+        return 'RowSparseGrad(%d of %d %s)' % (len(self.indices), self.shape[self.axis],
+                                               'columns' if self.axis else 'rows')